@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 from pathlib import Path
+from time import perf_counter
 from typing import TYPE_CHECKING
 from collections import deque
 
@@ -12,12 +13,16 @@ from rich import print
 
 from alfbote.people import People
 from alfbote.emojis import Emojis
+from alfbote.metrics import metrics
 from alfbote.bots import Alfbote, GuildDB, CLICog
 
 if TYPE_CHECKING:
     from discord import Message, Guild
     from typing import Any, Callable
 
+STARTED = perf_counter()
+startup_time: float | None = None  # Seconds from starting to the first on_ready, the models load after it
+
 load_dotenv()
 
 DISCORD_API_KEY = os.getenv("DISCORD_API_KEY")
@@ -32,6 +37,24 @@ CHATGEN = bool(int(os.getenv("CHATGEN", "0")))
 TTSGEN = bool(int(os.getenv("TTSGEN", "0")))
 MUSIC = bool(int(os.getenv("MUSIC", "0")))
 ALLOWED_CHANNEL = os.getenv("ALLOWED_CHANNEL", "bot-channel")
+CHAT_QUEUE_DEPTH = int(os.getenv("CHAT_QUEUE_DEPTH", "8"))
+CHAT_POOL_SIZE = int(os.getenv("CHAT_POOL_SIZE", "1"))  # LLaMA contexts generating replies in parallel
+CHAT_THREADS = int(os.getenv("CHAT_THREADS", "12"))  # CPU threads per context
+CHAT_DRAFT_MODEL = os.getenv("CHAT_DRAFT_MODEL")  # Small model with the same vocabulary for speculative decoding
+IMAGE_BATCH = int(os.getenv("IMAGE_BATCH", "4"))  # Queued prompts drawn together in one pipeline call
+IMAGE_BATCH_MEMORY_MB = int(os.getenv("IMAGE_BATCH_MEMORY_MB", "2048"))  # Memory for the images of a batch
+IMAGE_GC_WATERMARK = float(os.getenv("IMAGE_GC_WATERMARK", "0.85"))  # Empty the allocator cache above this VRAM use
+IMAGE_GC_IDLE = float(os.getenv("IMAGE_GC_IDLE", "120"))  # or after this many seconds without images
+IMAGE_EMBED_CACHE = int(os.getenv("IMAGE_EMBED_CACHE", "256"))  # Prompts whose text encoding is kept
+CHAT_IDLE_UNLOAD = float(os.getenv("CHAT_IDLE_UNLOAD", "0"))  # Unload the chat model after this many idle seconds
+IMAGE_IDLE_UNLOAD = float(os.getenv("IMAGE_IDLE_UNLOAD", "0"))  # and the image pipeline, 0 keeps them loaded
+DEVICE_MEMORY_MB = float(os.getenv("DEVICE_MEMORY_MB", "8192"))  # GPU memory ChatGen and ImageGen share
+CHAT_DEVICE_MB = float(os.getenv("CHAT_DEVICE_MB", "5000"))  # of which the LLaMA layers take
+IMAGE_DEVICE_MB = float(os.getenv("IMAGE_DEVICE_MB", "3500"))  # and the diffusion UNet with a batch of images
+DEVICE_HOLD = float(os.getenv("DEVICE_HOLD", "30"))  # Idle seconds before chat may take the GPU from images
+ISOLATED = bool(int(os.getenv("ISOLATED", "0")))  # Run chat and image models in worker processes
+METRICS = bool(int(os.getenv("METRICS", "0")))  # Collect request timings, see the stats command
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Serve them to Prometheus on localhost:METRICS_PORT
 
 bot = Alfbote()
 
@@ -167,6 +190,17 @@ async def wtf(ctx: discord.ApplicationContext):
             print(f"[red] {exc}")
 
 
+# Request timings, admins only
+@bot.command(pass_context=True)
+async def stats(ctx: discord.ApplicationContext):
+    if ctx.author.id not in People.admins:
+        return
+    if not metrics.enabled:
+        await ctx.send("Metrics are disabled, set METRICS=1")
+        return
+    await ctx.send(metrics.stats_message())
+
+
 # Remove messages sent by the bot on certain emojis
 @bot.event
 async def on_reaction_add(reaction: discord.Reaction, user):
@@ -194,14 +228,31 @@ async def on_message(msg: Message):
 
 @bot.event
 async def on_ready():
+    global startup_time
     print(f"[blue] Logged in as {bot.user}")
+    if startup_time is None:
+        startup_time = perf_counter() - STARTED
+        print(f"[blue] Online {startup_time:.1f}s after starting")
     for guild in bot.guilds:
         bot.guild_db.create(guild, {"last_msg": None, "music_player": MusicPlayer(bot, guild)})
     print(str(bot.guild_db))
+    if METRICS_PORT:
+        await metrics.serve(METRICS_PORT)
+
 
+if METRICS or METRICS_PORT:
+    print("[green] Metrics enabled")
+    metrics.enabled = True
+    metrics.gauge("bot_startup_seconds", "Seconds from starting to connected", lambda: startup_time or 0)
 
+
+device = None
 if GPU:
     print("[green] GPU enabled")
+    from alfbote.device import DeviceScheduler
+
+    # ChatGen and ImageGen take turns on the GPU when their models don't fit on it together
+    device = DeviceScheduler(DEVICE_MEMORY_MB, hold=DEVICE_HOLD)
 
 if CHATGEN:
     print("[green] ChatGen enabled")
@@ -209,21 +260,44 @@ if CHATGEN:
 
     if TTSGEN:
         print("[green] TTS enabled")
-    
-    chatgen_gpu = GPU
-    if IMAGEGEN and GPU:
-        # Too much VRAM to run both, and Stable Diffusion
-        # is WAY too slow to run on CPU
-        print("[yellow] Warning: ImageGen and ChatGen enabled while using GPU. Disabling GPU for ChatGen.")
-        chatgen_gpu = False
 
-    bot.add_cog(ChatGen(bot, tts=TTSGEN, gpu=GPU))
+    bot.add_cog(
+        ChatGen(
+            bot,
+            tts=TTSGEN,
+            gpu=GPU,
+            queue_depth=CHAT_QUEUE_DEPTH,
+            pool_size=CHAT_POOL_SIZE,
+            n_threads=CHAT_THREADS,
+            draft_model_file=CHAT_DRAFT_MODEL,
+            isolated=ISOLATED,
+            idle_unload=CHAT_IDLE_UNLOAD,
+            device=device,
+            device_mb=CHAT_DEVICE_MB,
+        )
+    )
 
 if IMAGEGEN:
     print("[green] ImageGen enabled")
     from alfbote.imagegen import ImageGen
 
-    bot.add_cog(ImageGen(bot, gpu=GPU, low_vram=True, ROCM=True))
+    bot.add_cog(
+        ImageGen(
+            bot,
+            gpu=GPU,
+            low_vram=True,
+            ROCM=True,
+            isolated=ISOLATED,
+            max_batch=IMAGE_BATCH,
+            memory_budget_mb=IMAGE_BATCH_MEMORY_MB,
+            gc_watermark=IMAGE_GC_WATERMARK,
+            gc_idle=IMAGE_GC_IDLE,
+            idle_unload=IMAGE_IDLE_UNLOAD,
+            device=device,
+            device_mb=IMAGE_DEVICE_MB,
+            embed_cache_size=IMAGE_EMBED_CACHE,
+        )
+    )
 
 
 if MUSIC:
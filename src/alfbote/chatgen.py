@@ -1,19 +1,60 @@
 from __future__ import annotations
 
+import asyncio
+from contextlib import nullcontext
 from tempfile import TemporaryDirectory
-from threading import Lock
-from typing import TYPE_CHECKING, Iterable
+from time import perf_counter
+from typing import TYPE_CHECKING, AsyncContextManager, Iterable
 
 import discord
 from discord.ext import commands
 from rich import print
 
-from alfbote.llamacpp.chat import Llama2
+from alfbote.lazy import LazyModel
+from alfbote.metrics import RATE_BUCKETS, TOKEN_BUCKETS, metrics
 from alfbote.people import People
+from alfbote.pool import ModelPool
+from alfbote.scheduler import Job, RequestScheduler
+from alfbote.streaming import MessageStreamer, channel_bucket
 from alfbote.utils import run_blocking
+from alfbote.workers import ProcessWorker, RemoteObject, WorkerCrashed
 
 if TYPE_CHECKING:
+    from collections.abc import Callable, Hashable
+
     from alfbote.bots import Alfbote
+    from alfbote.device import DeviceScheduler
+    from alfbote.llamacpp.chat import Llama2
+
+REPLIES = metrics.counter("chat_replies_total", "Chat replies generated")
+TOKENS = metrics.counter("chat_tokens_total", "Tokens sampled for chat replies")
+QUEUE_WAIT = metrics.histogram("chat_queue_wait_seconds", "Time a chat request waits in the queue")
+PREFILL_RATE = metrics.histogram("chat_prefill_tokens_per_second", "Input evaluation speed of each reply", RATE_BUCKETS)
+DECODE_SECONDS = metrics.histogram("chat_decode_seconds", "Evaluation time per generated token", TOKEN_BUCKETS)
+SAMPLE_SECONDS = metrics.histogram("chat_sample_seconds", "Sampling time per token", TOKEN_BUCKETS)
+DETOKENIZE_SECONDS = metrics.histogram("chat_detokenize_seconds", "Detokenizing time per token", TOKEN_BUCKETS)
+FIRST_TOKEN = metrics.histogram("chat_first_token_seconds", "From the chat command to the first token of the reply")
+
+
+# A Llama2 context living in a worker process
+class RemoteLlama2(RemoteObject):
+    def __init__(self, worker: ProcessWorker, slot: int):
+        super().__init__(worker, slot)
+        self.active_session: Hashable | None = None
+        # The first reply's metrics are measured from what the process had counted before it
+        self.last_counters: dict = worker.call(slot, "counters")
+        self.n_sampled = self.last_counters["n_sampled"]
+
+    def generate(self, msg: str, session: Hashable | None = None):
+        self.active_session = session
+        counters = yield from self.worker.call(self.slot, "generate", msg, session=session)
+        if counters is not None:
+            self.n_sampled = counters["n_sampled"]
+            self.last_counters = counters
+
+    # As of the end of the last reply, without a round trip to the worker
+    def counters(self) -> dict:
+        return self.last_counters
 
 
 class MyView(discord.ui.View):
@@ -22,6 +63,7 @@ class MyView(discord.ui.View):
     def __init__(self, respondent: discord.User | discord.Member = None):
         super().__init__(timeout=120, disable_on_timeout=True)
         self.respondent_id = None
+        self.on_stop: Callable[[], None] | None = None
         if respondent is not None:
             self.respondent_id = respondent.id  # The person's ID who the bot is responding to
 
@@ -33,6 +75,8 @@ class MyView(discord.ui.View):
     @discord.ui.button(label="stop", style=discord.ButtonStyle.danger)
     async def button_callback(self, button, interaction: discord.Interaction):
         self.stop_pressed = True
+        if self.on_stop is not None:
+            self.on_stop()
         self.clear_items()
         await interaction.response.edit_message(content=f"{self.message.content}—", view=self)
 
@@ -41,29 +85,154 @@ class ChatGen(commands.Cog, name="ChatGen"):
     TTS_MODEL = "tts_models/en/vctk/vits"  # Very good model that is fairly fast
     TTS_SPEAKER = "p273"  # VITS speaker. Change/remove this for other models
 
-    def __init__(self, bot: Alfbote, tts: bool = False, gpu: bool = False):
+    def __init__(
+        self,
+        bot: Alfbote,
+        tts: bool = False,
+        gpu: bool = False,
+        queue_depth: int = 8,
+        pool_size: int = 1,
+        n_threads: int = 12,
+        draft_model_file: str | None = None,
+        isolated: bool = False,
+        idle_unload: float = 0.0,
+        device: DeviceScheduler | None = None,  # Shares the GPU with ImageGen, see place
+        device_mb: float = 5000,  # VRAM of the model's layers
+        **llama_kwargs,  # Passed on to Llama2, e.g. model_file or prompt_cache_dir
+    ):
         self.bot = bot
-        n_gpu_layers = 1000 if gpu else 0
-        self.model = Llama2(n_threads=12, n_gpu_layers=n_gpu_layers)
+        self.gpu = gpu
+        self.isolated = isolated
+        self.pool_size = pool_size
+        self.llama_kwargs = dict(
+            draft_model_file=draft_model_file,
+            n_threads=n_threads,
+            n_gpu_layers=1000 if gpu else 0,
+            timed=metrics.enabled,
+            **llama_kwargs,
+        )
+        self.device = device
+        if gpu and device is not None:
+            # Off the device while the scheduler gives it to ImageGen, replies are generated on the CPU meanwhile
+            tenant = device.register("chat", device_mb, self.place, lambda: len(self.scheduler), cpu_fallback=True)
+            self.llama_kwargs.update(n_gpu_layers=1000 if tenant.on_device else 0)
+        # Loaded in the background once the bot is connected, see on_ready, and unloaded after idle_unload
+        # seconds without a request (0 keeps it loaded)
+        self.models = LazyModel("chatgen", self.load, self.unload, idle_unload=idle_unload)
 
         self.tts_enabled = tts
 
-        self.chat_lock = Lock()
+        # One reply per context is generated at a time, the rest wait their turn
+        self.scheduler = RequestScheduler(max_depth=queue_depth, max_per_user=2, concurrency=pool_size)
+        self.jobs: dict[int, tuple[Job, MyView]] = {}  # Prompt message id -> queued or running job
+        metrics.gauge("chat_queue_length", "Chat requests waiting in the queue", lambda: len(self.scheduler))
         if self.tts_enabled:
             from TTS.api import TTS
 
             self.tts = TTS(model_name=self.TTS_MODEL, progress_bar=False, gpu=False)
 
+    # pool_size contexts over one copy of the weights, each with n_threads and its own inference thread.
+    # With a draft model, each context decodes speculatively.
+    # Isolated, the contexts live in a worker process and the threads only relay tokens.
+    def load(self) -> ModelPool:
+        if self.isolated:
+            worker = ProcessWorker(
+                "alfbote.llamacpp.chat:Llama2.pool", self.pool_size, name="chatgen", **self.llama_kwargs
+            )
+            worker.ready.wait()
+            models = [RemoteLlama2(worker, slot) for slot in range(self.pool_size)]
+        else:
+            from alfbote.llamacpp.chat import Llama2
+
+            models = Llama2.pool(self.pool_size, **self.llama_kwargs)
+            # The conversations outlive the pool, every pool loaded after this one (see place) continues them
+            self.llama_kwargs.setdefault("session_store", models[0].sessions.store)
+        return ModelPool(models, name="chatgen", affinity=lambda model: model.active_session)
+
+    def unload(self, pool: ModelPool):
+        pool.close()
+        models = [slot.model for slot in pool.slots]
+        if self.isolated:
+            models[0].worker.stop()
+        else:
+            from alfbote.llamacpp.chat import Llama2
+
+            Llama2.close_pool(models)
+
+    # The layers can't move between devices in place, the contexts are loaded again with the new n_gpu_layers.
+    # The conversations wait in the session store meanwhile. A snapshot is a host copy of the KV cache, laid out
+    # by the model, n_ctx and memory_f16 only, so it restores into a context with any n_gpu_layers.
+    # Isolated, the store lives in the worker process and the conversations go with it.
+    async def place(self, on_device: bool):
+        self.llama_kwargs.update(n_gpu_layers=1000 if on_device else 0)
+        await self.models.drop()
+
+    def reserve_device(self) -> AsyncContextManager[bool]:
+        if self.device is None or not self.gpu:
+            return nullcontext(self.gpu)
+        return self.device.reserve("chat")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.models.start()
+
     # Chat Interaction
     @commands.command()
     async def c(self, ctx: discord.ApplicationContext, *, msg):
-        # Only process one prompt at a time
-        if self.chat_lock.locked():
+        stop_view = MyView(respondent=ctx.message.author)
+        queue_message: discord.Message | None = None
+        queue_message_lock = asyncio.Lock()
+
+        async def on_position(position: int):
+            nonlocal queue_message
+            async with queue_message_lock:
+                if job.started is not None:
+                    return
+                content = f"⏳ queued #{position}"
+                try:
+                    if queue_message is None:
+                        queue_message = await ctx.send(content, view=stop_view)
+                    else:
+                        await queue_message.edit(content=content)
+                except discord.HTTPException:
+                    pass
+
+        async def run():
+            nonlocal queue_message
+            QUEUE_WAIT.observe(job.started - job.submitted)
+            async with queue_message_lock:
+                if queue_message is None and self.models.warming_up:
+                    try:
+                        queue_message = await ctx.send("⏳ warming up", view=stop_view)
+                    except discord.HTTPException:
+                        pass
+                message = queue_message
+            return await self.run_chat_message(
+                ctx=ctx, msg=msg, stop_view=stop_view, message=message, submitted=job.submitted
+            )
+
+        job = self.scheduler.submit(ctx.author.id, run, on_position=on_position)
+        if job is None:
+            try:
+                await ctx.message.add_reaction(emoji="⏳")
+            except (discord.HTTPException, discord.Forbidden):
+                pass
             return
 
-        output = None
-        with self.chat_lock:
-            output = await self.run_chat_message(ctx=ctx, msg=msg)
+        # The stop button only drops queued jobs, a running reply checks stop_pressed itself
+        stop_view.on_stop = lambda: self.scheduler.cancel(job) if job.started is None else None
+        self.jobs[ctx.message.id] = (job, stop_view)
+        try:
+            output = await job.result()
+        finally:
+            self.jobs.pop(ctx.message.id, None)
+
+        # Cancelled while queued because the prompt was deleted, clean up the queue message too
+        if job.started is None and queue_message is not None and not stop_view.stop_pressed:
+            try:
+                await queue_message.delete()
+            except discord.HTTPException:
+                pass
 
         if self.tts_enabled and self.tts is not None and output is not None:
             # Only play TTS for users in a channel
@@ -100,37 +269,87 @@ class ChatGen(commands.Cog, name="ChatGen"):
                 except discord.ClientException:
                     pass
 
-    async def run_chat_message(self, ctx, msg):
+    # Cancel the reply when the prompt or the reply is deleted
+    @commands.Cog.listener()
+    async def on_message_delete(self, message: discord.Message):
+        for prompt_id, (job, stop_view) in list(self.jobs.items()):
+            if message.id == prompt_id or (stop_view.message is not None and message.id == stop_view.message.id):
+                self.scheduler.cancel(job)
+
+    async def run_chat_message(
+        self, ctx, msg, stop_view: MyView = None, message: discord.Message = None, submitted: float | None = None
+    ):
         """Generate and edit message one word at a time just like ChatGPT"""
-        output = []
-        message: discord.Message = None
-        stop_view = MyView(respondent=ctx.message.author)
-        async with ctx.typing():
-            try:
-                TOKEN_EDIT_THRESHOLD = 15
-                for num_token, token in enumerate(self.generate_response(msg), 0):
-                    output.append(token)
-                    current_msg = "".join(output)
-                    if message is None:
-                        message = await ctx.send(current_msg, view=stop_view)
-                    else:
-                        if num_token % TOKEN_EDIT_THRESHOLD == 0:
-                            await message.edit(content=" " + current_msg + " ")
-
-                    if stop_view.stop_pressed:
-                        await message.edit(content=f"{current_msg} —")
-                        return None
-
-                output = current_msg
-                # Remove stop button
-                stop_view.clear_items()
-                if message is not None:
-                    await message.edit(content=current_msg, view=stop_view)
-            # If the message is removed with the stop button or the wtf command, ignore the error
-            except commands.errors.CommandInvokeError:
-                pass
+        output = None
+        submitted = submitted if submitted is not None else perf_counter()
+        if stop_view is None:
+            stop_view = MyView(respondent=ctx.message.author)
+
+        session = self.session_key(ctx)
+        async with self.reserve_device() as on_device:
+            # Image generation on the same GPU gives back the memory its allocator holds on to
+            image_gen = self.bot.get_cog("ImageGen") if on_device else None
+            if image_gen is not None and image_gen.gpu:
+                await image_gen.reclaim("handoff")
+            async with self.models.use() as pool, pool.acquire(session) as slot:
+                n_sampled = slot.model.n_sampled
+                counters = slot.model.counters() if metrics.enabled else None
+                # Tokens are generated on the slot's inference thread, the stop button cancels it between tokens
+                stream = slot.worker.stream(lambda: self.generate_response(slot.model, msg, session))
+                stop_view.on_stop = stream.cancel
+                # Edits are coalesced to stay under the channel's rate limit
+                streamer = MessageStreamer(
+                    send=lambda content: ctx.send(content, view=stop_view),
+                    message=message,
+                    bucket=channel_bucket(ctx.channel.id),
+                )
+                async with ctx.typing():
+                    try:
+                        async for token in stream:
+                            if submitted is not None:
+                                FIRST_TOKEN.observe(perf_counter() - submitted)
+                                self.models.responded()
+                                submitted = None
+                            # The reply is only joined when an edit goes out
+                            await streamer.append(token)
+
+                            if stop_view.stop_pressed:
+                                await streamer.finish(f"{streamer.text} —")
+                                return None
+
+                        output = str(streamer.text)
+                        # Remove stop button
+                        stop_view.clear_items()
+                        await streamer.finish(view=stop_view)
+                    # If the message is removed with the stop button or the wtf command, ignore the error
+                    except commands.errors.CommandInvokeError:
+                        pass
+                    except WorkerCrashed as exc:
+                        print(f"[red] {exc}")
+                        await streamer.finish(f"{streamer.text} —")
+                    finally:
+                        # The context is only handed to the next request once generation has really stopped
+                        await stream.aclose()
+                        slot.n_tokens += slot.model.n_sampled - n_sampled
+                        if counters is not None:
+                            self.observe(counters, slot.model.counters())
         return output
 
+    # Metrics of a reply from the model's counters before and after it
+    def observe(self, before: dict, after: dict):
+        delta = {key: value - before.get(key, 0) for key, value in after.items()}
+        n_sampled = delta.get("n_sampled", 0)
+        if n_sampled <= 0:
+            return
+        REPLIES.inc()
+        TOKENS.inc(n_sampled)
+        if delta["n_prefill"] > 0 and delta["t_prefill"] > 0:
+            PREFILL_RATE.observe(delta["n_prefill"] / delta["t_prefill"])
+        if delta["n_decode"] > 0:
+            DECODE_SECONDS.observe(delta["t_decode"] / delta["n_decode"], delta["n_decode"])
+        SAMPLE_SECONDS.observe(delta["t_sample"] / n_sampled, n_sampled)
+        DETOKENIZE_SECONDS.observe(delta["t_detokenize"] / n_sampled, n_sampled)
+
     # Stop all voice output including TTS
     @commands.command()
     async def stfu(self, ctx: discord.ApplicationContext):
@@ -139,8 +358,13 @@ class ChatGen(commands.Cog, name="ChatGen"):
         elif ctx.author.voice.channel and (ctx.author.voice.channel == ctx.voice_client.channel):
             ctx.voice_client.stop()
 
-    def generate_response(self, msg: str) -> str | Iterable:
-        return self.model.generate(msg)
+    # Every user gets their own conversation per channel
+    def session_key(self, ctx: discord.ApplicationContext) -> tuple:
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        return (guild_id, ctx.channel.id, ctx.author.id)
+
+    def generate_response(self, model: Llama2, msg: str, session: tuple | None = None) -> str | Iterable:
+        return model.generate(msg, session=session)
 
     def generate_speech(self, text: str, audio_file: str):
         if self.tts is not None:
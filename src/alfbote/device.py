@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING
+
+from rich import print
+
+from alfbote.metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Awaitable, Callable
+
+PLACEMENTS = metrics.counter("device_placements_total", "Reservations by tenant and where they ran", ("tenant", "on"))
+MOVES = metrics.counter("device_moves_total", "Models moved on or off the device", ("tenant", "to"))
+WAIT_SECONDS = metrics.histogram("device_wait_seconds", "Time to get a placement, moves included")
+MOVE_SECONDS = metrics.histogram("device_move_seconds", "Time to move a model on or off the device")
+
+
+# A model that shares the device, e.g. ChatGen's LLaMA layers or ImageGen's UNet
+@dataclass(eq=False)
+class Tenant:
+    name: str
+    memory_mb: float  # on the device while resident
+    place: Callable[[bool], Awaitable[None]]  # moves the model on (True) or off the device
+    demand: Callable[[], int]  # queued requests
+    cpu_fallback: bool = False  # runs off the device rather than waiting for it
+    on_device: bool = False
+    moving: bool = False  # other reservations leave it alone until it is done
+    active: int = 0  # reservations in progress
+    waiting: int = 0
+    last_used: float = 0.0
+
+
+# Decides which models live on the accelerator, for cogs that would not fit on it together.
+# Each request reserves the device first and learns whether its model is on it:
+# - a resident model runs there, unless a tenant that can only run on the device waits for it,
+#   then the device drains first,
+# - a model that fits next to the residents moves on,
+# - residents nobody is using are moved off for a tenant that can only run on the device,
+#   or for one with at least as much queued work once they have been idle for hold seconds,
+# - otherwise it runs off the device (cpu_fallback) or waits for a reservation to end.
+# A model is only moved while none of its reservations are in progress, and without holding up the reservations
+# of the tenants that aren't moving.
+class DeviceScheduler:
+    def __init__(self, capacity_mb: float, hold: float = 30.0, clock: Callable[[], float] = monotonic):
+        self.capacity_mb = capacity_mb
+        self.hold = hold
+        self.clock = clock
+        self.tenants: dict[str, Tenant] = {}
+        self.changed = asyncio.Condition()
+        metrics.gauge("device_resident_mb", "Device memory of the resident models", lambda: self.resident_mb)
+
+    # Tenants registered first start on the device while they fit, their place isn't called for that
+    def register(
+        self,
+        name: str,
+        memory_mb: float,
+        place: Callable[[bool], Awaitable[None]],
+        demand: Callable[[], int] = lambda: 0,
+        cpu_fallback: bool = False,
+    ) -> Tenant:
+        tenant = Tenant(name, memory_mb, place, demand, cpu_fallback, last_used=self.clock())
+        tenant.on_device = self.resident_mb + memory_mb <= self.capacity_mb
+        self.tenants[name] = tenant
+        print(f"[green] {name}: {'on' if tenant.on_device else 'off'} the device ({memory_mb:.0f} MB)")
+        return tenant
+
+    @property
+    def resident_mb(self) -> float:
+        # a model moving either way may be on the device until the move is done
+        return sum(tenant.memory_mb for tenant in self.tenants.values() if tenant.on_device or tenant.moving)
+
+    # Whether the tenant's model is on the device for the duration of the block
+    @asynccontextmanager
+    async def reserve(self, name: str) -> AsyncIterator[bool]:
+        tenant = self.tenants[name]
+        start = perf_counter()
+        async with self.changed:
+            tenant.waiting += 1
+            try:
+                while True:
+                    on_device, moves = self._place(tenant)
+                    if moves:
+                        await self._move_all(moves)
+                    if on_device is not None:
+                        break
+                    await self.changed.wait()
+            finally:
+                tenant.waiting -= 1
+            tenant.active += 1
+        WAIT_SECONDS.observe(perf_counter() - start)
+        PLACEMENTS.labels(tenant=name, on="device" if on_device else "cpu").inc()
+        try:
+            yield on_device
+        finally:
+            async with self.changed:
+                tenant.active -= 1
+                tenant.last_used = self.clock()
+                self.changed.notify_all()
+
+    # True on the device, False off it, None to wait, and the moves to make first. Called with the lock held.
+    def _place(self, tenant: Tenant) -> tuple[bool | None, list[tuple[Tenant, bool]]]:
+        if tenant.moving:
+            return None, []
+        others = [other for other in self.tenants.values() if other is not tenant]
+        if tenant.on_device:
+            blocked = any(
+                other.waiting and not other.on_device and not other.moving and not other.cpu_fallback
+                for other in others
+            )
+            return None if blocked else True, []
+        if tenant.active > 0:
+            # already running off the device, its model can't move under it
+            return False, []
+
+        moves = []
+        free = self.capacity_mb - self.resident_mb
+        if free < tenant.memory_mb:
+            now = self.clock()
+            victims = [
+                other
+                for other in others
+                if other.on_device
+                and not other.moving
+                and other.active == 0
+                and (
+                    not tenant.cpu_fallback
+                    or (now - other.last_used >= self.hold and other.demand() <= tenant.demand())
+                )
+            ]
+            if free + sum(other.memory_mb for other in victims) < tenant.memory_mb:
+                return False if tenant.cpu_fallback else None, []
+            for other in sorted(victims, key=lambda other: other.last_used):
+                moves.append((other, False))
+                free += other.memory_mb
+                if free >= tenant.memory_mb:
+                    break
+        moves.append((tenant, True))
+        return True, moves
+
+    # Called with the lock held, released while the models move so the other tenants' reservations go on
+    async def _move_all(self, moves: list[tuple[Tenant, bool]]):
+        for tenant, _ in moves:
+            tenant.moving = True
+        self.changed.release()
+        try:
+            for tenant, on_device in moves:
+                await self._move(tenant, on_device)
+        finally:
+            await self.changed.acquire()
+            for tenant, _ in moves:
+                tenant.moving = False
+            self.changed.notify_all()
+
+    async def _move(self, tenant: Tenant, on_device: bool):
+        start = perf_counter()
+        await tenant.place(on_device)
+        tenant.on_device = on_device
+        MOVE_SECONDS.observe(perf_counter() - start)
+        MOVES.labels(tenant=tenant.name, to="device" if on_device else "cpu").inc()
+        print(f"[yellow] {tenant.name}: moved {'on' if on_device else 'off'} the device")
+
+    def stats(self) -> dict:
+        return {
+            name: {"on_device": tenant.on_device, "active": tenant.active, "waiting": tenant.waiting}
+            for name, tenant in self.tenants.items()
+        }
+
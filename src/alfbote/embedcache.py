@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from typing import Any
+
+
+# The CLIP tokenizer lowercases and collapses whitespace, so texts that only differ in those encode the same
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+# Text-encoder outputs of the most recently used prompts, e.g. the negative prompt every image shares.
+# Texts missing from the cache are encoded together in one call.
+class EmbeddingCache:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, Any] = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # One embedding per text, encode gets the texts that aren't cached and returns theirs in order
+    def lookup(self, texts: list[str], encode: Callable[[list[str]], list[Any]]) -> list[Any]:
+        keys = [normalize(text) for text in texts]
+        found = {}
+        for key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            for key, embedding in zip(missing, encode(missing)):
+                found[key] = embedding
+                self._add(key, embedding)
+
+        self.n_misses += len(missing)
+        self.n_hits += len(keys) - len(missing)
+        return [found[key] for key in keys]
+
+    def _add(self, key: str, embedding: Any):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = embedding
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        n_lookups = self.n_hits + self.n_misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.n_hits,
+            "misses": self.n_misses,
+            "hit_rate": self.n_hits / n_lookups if n_lookups else 0.0,
+        }
+
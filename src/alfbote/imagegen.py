@@ -1,126 +1,230 @@
 from __future__ import annotations
 
-import os
-from random import randint
-from tempfile import SpooledTemporaryFile
-from threading import Lock
-from typing import TYPE_CHECKING
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, AsyncContextManager
 from rich import print
 from io import BytesIO
+from time import perf_counter
 
+import discord
+
+from alfbote.imagequeue import ImageQueue, ImageRequest
+from alfbote.lazy import LazyModel
+from alfbote.metrics import RATE_BUCKETS, metrics
 from alfbote.utils import run_blocking
+from alfbote.workers import ProcessWorker, RemoteObject, WorkerCrashed
 
 if TYPE_CHECKING:
     from alfbote.bots import Alfbote
+    from alfbote.device import DeviceScheduler
+    from alfbote.imagepipeline import ImagePipeline
 
 from discord import ApplicationContext
 
-import torch
-from diffusers import (
-    StableDiffusionPipeline,
-)
 from discord import File
 from discord.ext import commands
 
+IMAGES = metrics.counter("image_generated_total", "Images generated")
+STEP_RATE = metrics.histogram(
+    "image_diffusion_steps_per_second",
+    "Diffusion steps per second of each batch, times its images",
+    (0.1, 0.25, 0.5) + RATE_BUCKETS,
+)
+ENCODE_SECONDS = metrics.histogram("image_encode_seconds", "JPEG encoding time per image")
+QUEUE_WAIT = metrics.histogram("image_queue_wait_seconds", "Time an image request waits in the queue")
+BATCH_SIZE = metrics.histogram("image_batch_size", "Images per pipeline call", (1, 2, 3, 4, 6, 8))
+ALLOC_REQUESTS = metrics.counter("image_allocator_requests_total", "Device allocations by the pipeline")
+ALLOC_HITS = metrics.counter("image_allocator_hits_total", "Device allocations served from the allocator cache")
+RECLAIMS = metrics.counter("image_memory_reclaims_total", "Allocator cache emptied, by reason", ("reason",))
+UPLOAD_SECONDS = metrics.histogram("image_upload_seconds", "Time to send an image to Discord")
+EMBED_HITS = metrics.counter("image_embedding_cache_hits_total", "Prompts whose text encoding was cached")
+EMBED_MISSES = metrics.counter("image_embedding_cache_misses_total", "Prompts run through the text encoder")
+TEXT_SECONDS = metrics.histogram("image_text_encode_seconds", "Text encoder time per prompt it encoded")
+REQUEST_SECONDS = metrics.histogram("image_request_seconds", "From the image command to the image being sent")
+
 
 class ImageGen(commands.Cog, name="ImageGen"):
-    # I don't have enough VRAM to run 768x768 on a RX 6600XT
-    IMAGE_DIM = 512
-    MODEL_ID = "SG161222/Realistic_Vision_V5.1_noVAE"
-    DEFAULT_PROMPT = ""
-    DEFAULT_NEGATIVE_PROMPT = "visual artifacts, nsfw, nude, naked, (deformed eyes, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3), poorly drawn, bad anatomy, wrong anatomy, extra limb, missing limb, floating limbs, disconnected limbs, mutation, mutated, ugly, disgusting, amputation"
-
-    def __init__(self, bot: Alfbote, gpu: bool = False, low_vram: bool = True, ROCM: bool = False):
+    IMAGE_MEMORY_MB = 768  # Rough peak memory of one more 512x512 image in a batch
+
+    def __init__(
+        self,
+        bot: Alfbote,
+        gpu: bool = False,
+        low_vram: bool = True,
+        ROCM: bool = False,
+        isolated: bool = False,
+        queue_depth: int = 8,
+        max_batch: int = 4,
+        memory_budget_mb: int = 2048,  # Memory for the images of a batch
+        gc_watermark: float = 0.85,  # Device memory in use above which the allocator cache is emptied
+        gc_idle: float = 120.0,  # Seconds idle after which it is emptied
+        idle_unload: float = 0.0,  # Seconds idle after which the pipeline is unloaded, 0 keeps it loaded
+        device: DeviceScheduler | None = None,  # Shares the GPU with ChatGen, see place
+        device_mb: float = 3500,  # VRAM of the UNet and the images of a batch
+        embed_cache_size: int = 256,  # Prompts whose text encoding is kept
+    ):
         self.bot: Alfbote = bot
-        self.image_lock = Lock()
-        self.GPU: bool = gpu
-        self.low_vram: bool = low_vram
-
-        if gpu:
-            if not torch.cuda.is_available():
-                print("[red] ERROR: CUDA not detected in ImageGen. Falling back to CPU.")
-                self.GPU = False
-            else:
-                # enabling benchmark option seems to enable a range of cards to do fp16 when they otherwise can't
-                # see https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/4407
-                if any(
-                    torch.cuda.get_device_capability(devid) == (7, 5) for devid in range(0, torch.cuda.device_count())
-                ):
-                    torch.backends.cudnn.benchmark = True
-
-                torch.backends.cuda.matmul.allow_tf32 = True
-                torch.backends.cudnn.allow_tf32 = True
-
-        torch.set_float32_matmul_precision('medium')
-        torch_dtype = torch.float16 if self.GPU else torch.float32
-        self.pipe = StableDiffusionPipeline.from_pretrained(
-            ImageGen.MODEL_ID,
-            use_safetensors=True,
-            torch_dtype=torch_dtype,
+        self.gpu = gpu
+        self.cached = False  # batches since the last handoff, see reclaim
+        self.last_counters: dict = {}
+        self.isolated = isolated
+        self.pipeline_kwargs = dict(
+            gpu=gpu,
+            low_vram=low_vram,
+            ROCM=ROCM,
+            gc_watermark=gc_watermark,
+            gc_idle=gc_idle,
+            embed_cache_size=embed_cache_size,
+        )
+        self.device = device
+        self.tenant = None
+        if gpu and device is not None:
+            # Images only run on the device, they wait for it while ChatGen has it
+            self.tenant = device.register("image", device_mb, self.place, lambda: len(self.queue))
+            self.pipeline_kwargs.update(on_device=self.tenant.on_device)
+        # Loaded in the background once the bot is connected, see on_ready
+        self.models = LazyModel("imagegen", self.load, self.unload, idle_unload=idle_unload)
+
+        # Prompts that come in while the pipeline is busy are drawn together in the next call
+        self.queue = ImageQueue(
+            self.run_batch,
+            max_batch=max_batch,
+            memory_budget=memory_budget_mb,
+            image_memory=self.IMAGE_MEMORY_MB,
+            max_depth=queue_depth,
+        )
+        metrics.gauge("image_queue_length", "Image requests waiting in the queue", lambda: len(self.queue))
+        metrics.gauge(
+            "image_memory_reserved_bytes",
+            "Device memory held by the allocator, as of the last batch",
+            lambda: self.last_counters.get("reserved_bytes", 0),
         )
 
-        if self.GPU:
-            if ROCM:
-                print("[green] ImageGen: ROCM enabled")
-                os.environ["HSA_OVERRIDE_GFX_VERSION"] = "10.3.0"
-            else:
-                print("[green] ImageGen: CUDA enabled")
-
-            self.device = torch.device("cuda")
-            self.pipe.enable_attention_slicing()
-            self.pipe.enable_vae_tiling()
-            if self.low_vram:
-                print("[yellow] ImageGen: Low VRAM enabled")
-                self.pipe.enable_model_cpu_offload()
-            else:
-                # Below does not work for me currently. Maybe an ROCM issue?
-                # from platform import python_version_tuple
-                # if int(python_version_tuple()[1]) < 11:
-                # Use torch compile if <3.11 because it's not supported for 3.11
-                #     self.pipe.unet.to(memory_format=torch.channels_last)
-                #     self.pipe.unet = torch.compile(self.pipe.unet, mode="reduce-overhead", fullgraph=True)
-                self.pipe = self.pipe.to(self.device)
+    # Isolated, torch and the pipeline live in a worker process and only jpeg bytes come back
+    def load(self) -> ImagePipeline | RemoteObject:
+        if self.isolated:
+            worker = ProcessWorker("alfbote.imagepipeline:ImagePipeline", name="imagegen", **self.pipeline_kwargs)
+            worker.ready.wait()
+            return RemoteObject(worker)
+        from alfbote.imagepipeline import ImagePipeline
+
+        return ImagePipeline(**self.pipeline_kwargs)
+
+    async def place(self, on_device: bool):
+        self.pipeline_kwargs.update(on_device=on_device)
+        if (pipeline := await self.models.current()) is not None:
+            self.cached = False
+            if self.isolated:
+                pipeline.worker.kwargs.update(on_device=on_device)  # a restarted worker starts where it was
+            await run_blocking(self.bot, pipeline.place, on_device)
+
+    def reserve_device(self) -> AsyncContextManager[bool]:
+        if self.tenant is None:
+            return nullcontext(self.gpu)
+        return self.device.reserve("image")
+
+    def unload(self, pipeline: ImagePipeline | RemoteObject):
+        self.cached = False
+        self.last_counters = {}
+        if self.isolated:
+            pipeline.worker.stop()
         else:
-            self.device = torch.device("cpu")
+            pipeline.close()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.models.start()
 
     # Image generation
     @commands.command()
     async def i(self, ctx: ApplicationContext, *, msg: str = None):
-        # Only process one prompt at a time
-        if msg is None or self.image_lock.locked():
+        if msg is None:
+            return
+
+        request = self.queue.submit(ctx.author.id, msg)
+        if request is None:
+            try:
+                await ctx.message.add_reaction(emoji="⏳")
+            except (discord.HTTPException, discord.Forbidden):
+                pass
             return
 
-        async with ctx.typing():
-            with self.image_lock:
-                with SpooledTemporaryFile(mode="w+b") as file:
-                    images = await run_blocking(self.bot, ImageGen.generate_image, self, msg)
-                    images[0].save(file, "jpeg")
-                    file.seek(0)
-                    discord_file = File(BytesIO(file.read()), filename=f"{msg[:64]}.jpg")
-                    await ctx.send(f"{ctx.message.author.mention} {msg}", file=discord_file)
-
-    def generate_image(self, prompt: str, iterations: int = 25, negative_prompt: str | None = DEFAULT_NEGATIVE_PROMPT):
-        prompt = prompt + " , " + ImageGen.DEFAULT_PROMPT
-        iterations = max(min(iterations, 60), 5)  # Get iterations in range (5, 60)
-
-        seed = randint(0, 2147483647)
-        generator = torch.Generator(self.device).manual_seed(seed)
-
-        images = self.pipe(
-            prompt,
-            height=ImageGen.IMAGE_DIM,
-            width=ImageGen.IMAGE_DIM,
-            num_inference_steps=iterations,
-            guidance_scale=7,
-            num_images_per_prompt=1,
-            negative_prompt=negative_prompt,
-            generator=generator,
-        ).images
-        self.torch_gc()
+        warming_up: discord.Message | None = None
+        if self.models.warming_up:
+            try:
+                warming_up = await ctx.send("⏳ warming up")
+            except discord.HTTPException:
+                pass
+        try:
+            async with ctx.typing():
+                try:
+                    image = await request.result()
+                except WorkerCrashed as exc:
+                    print(f"[red] {exc}")
+                    return
+        finally:
+            if warming_up is not None:
+                try:
+                    await warming_up.delete()
+                except discord.HTTPException:
+                    pass
+        if image is None:
+            return
+        discord_file = File(BytesIO(image), filename=f"{msg[:64]}.jpg")
+        with UPLOAD_SECONDS.time():
+            await ctx.send(f"{ctx.message.author.mention} {msg}", file=discord_file)
+        REQUEST_SECONDS.observe(perf_counter() - request.submitted)
+        self.models.responded()
+
+    async def run_batch(self, batch: list[ImageRequest]) -> list[bytes]:
+        for request in batch:
+            QUEUE_WAIT.observe(request.started - request.submitted)
+        BATCH_SIZE.observe(len(batch))
+        async with self.reserve_device(), self.models.use() as pipeline:
+            self.cached = True
+            images = await run_blocking(
+                self.bot,
+                pipeline.generate_jpegs,
+                [request.prompt for request in batch],
+                [request.seed for request in batch],
+                iterations=batch[0].iterations,
+            )
+            if metrics.enabled:
+                self.observe(await run_blocking(self.bot, pipeline.counters))
         return images
 
-    def torch_gc(self):
-        if torch.cuda.is_available():
-            with torch.cuda.device(self.device):
-                torch.cuda.empty_cache()
-                torch.cuda.ipc_collect()
+    # Give the pipeline's cached device memory back, e.g. before ChatGen uses the same GPU.
+    # A batch that is being drawn keeps it, the next reclaim after it will do.
+    async def reclaim(self, reason: str = "handoff"):
+        # an unloaded pipeline holds nothing, and isn't loaded just to reclaim
+        if not self.cached or self.queue.running or self.models.model is None:
+            return
+        self.cached = False
+        try:
+            async with self.models.use() as pipeline:
+                await run_blocking(self.bot, pipeline.reclaim, reason)
+        except WorkerCrashed as exc:
+            print(f"[red] {exc}")
+
+    # Metrics since the last batch from the pipeline's counters, which also count reclaims in between
+    def observe(self, counters: dict):
+        last = self.last_counters
+        if counters["n_images"] < last.get("n_images", 0):
+            last = {}  # the worker process was restarted
+        self.last_counters = counters
+        delta = {key: value - last.get(key, 0) for key, value in counters.items()}
+        n_images = delta["n_images"]
+        if n_images > 0:
+            IMAGES.inc(n_images)
+            ENCODE_SECONDS.observe(delta["t_encode"] / n_images, n_images)
+        if delta["t_diffusion"] > 0:
+            STEP_RATE.observe(delta["n_steps"] / delta["t_diffusion"])
+        EMBED_HITS.inc(delta["n_embed_hits"])
+        EMBED_MISSES.inc(delta["n_embed_misses"])
+        if delta["n_embed_misses"] > 0:
+            TEXT_SECONDS.observe(delta["t_text"] / delta["n_embed_misses"], delta["n_embed_misses"])
+        ALLOC_REQUESTS.inc(delta["n_alloc_requests"])
+        ALLOC_HITS.inc(delta["n_alloc_hits"])
+        for key, n in delta.items():
+            if key.startswith("n_reclaim_") and n > 0:
+                RECLAIMS.labels(reason=key.removeprefix("n_reclaim_")).inc(n)
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import gc
+import os
+from io import BytesIO
+from random import randint
+from threading import Lock, Timer
+from time import perf_counter
+
+import torch
+from diffusers import (
+    StableDiffusionPipeline,
+)
+from rich import print
+
+from alfbote.embedcache import EmbeddingCache
+from alfbote.memory import ReclaimPolicy
+
+
+# The Stable Diffusion pipeline behind ImageGen, kept apart from the cog so it can also run in a worker process
+class ImagePipeline:
+    # I don't have enough VRAM to run 768x768 on a RX 6600XT
+    IMAGE_DIM = 512
+    MODEL_ID = "SG161222/Realistic_Vision_V5.1_noVAE"
+    DEFAULT_PROMPT = ""
+    DEFAULT_NEGATIVE_PROMPT = "visual artifacts, nsfw, nude, naked, (deformed eyes, mutated hands and fingers:1.4), (deformed, distorted, disfigured:1.3), poorly drawn, bad anatomy, wrong anatomy, extra limb, missing limb, floating limbs, disconnected limbs, mutation, mutated, ugly, disgusting, amputation"
+
+    def __init__(
+        self,
+        gpu: bool = False,
+        low_vram: bool = True,
+        ROCM: bool = False,
+        gc_watermark: float = 0.85,  # Device memory in use above which the allocator cache is emptied after a batch
+        gc_idle: float = 120.0,  # Seconds without a batch after which it is emptied
+        on_device: bool = True,  # Start with the UNet on the GPU, see place
+        embed_cache_size: int = 256,  # Prompts whose text-encoder outputs are kept, see encode
+    ):
+        self.GPU: bool = gpu
+        self.low_vram: bool = low_vram
+        self.memory = ReclaimPolicy(watermark=gc_watermark, idle=gc_idle)
+        self.lock = Lock()  # generating and reclaiming take turns
+        self.idle_timer: Timer | None = None
+        self.embeddings = EmbeddingCache(embed_cache_size)
+        self.n_images = 0
+        self.n_steps = 0
+        self.t_diffusion = 0.0
+        self.t_encode = 0.0
+        self.t_text = 0.0
+
+        if gpu:
+            if not torch.cuda.is_available():
+                print("[red] ERROR: CUDA not detected in ImageGen. Falling back to CPU.")
+                self.GPU = False
+            else:
+                # enabling benchmark option seems to enable a range of cards to do fp16 when they otherwise can't
+                # see https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/4407
+                if any(
+                    torch.cuda.get_device_capability(devid) == (7, 5) for devid in range(0, torch.cuda.device_count())
+                ):
+                    torch.backends.cudnn.benchmark = True
+
+                torch.backends.cuda.matmul.allow_tf32 = True
+                torch.backends.cudnn.allow_tf32 = True
+
+        torch.set_float32_matmul_precision('medium')
+        torch_dtype = torch.float16 if self.GPU else torch.float32
+        self.pipe = StableDiffusionPipeline.from_pretrained(
+            ImagePipeline.MODEL_ID,
+            use_safetensors=True,
+            torch_dtype=torch_dtype,
+        )
+
+        if self.GPU:
+            if ROCM:
+                print("[green] ImageGen: ROCM enabled")
+                os.environ["HSA_OVERRIDE_GFX_VERSION"] = "10.3.0"
+            else:
+                print("[green] ImageGen: CUDA enabled")
+
+            self.device = torch.device("cuda")
+            self.pipe.enable_attention_slicing()
+            self.pipe.enable_vae_tiling()
+            if self.low_vram:
+                print("[yellow] ImageGen: Low VRAM enabled")
+                self.pipe.enable_model_cpu_offload()
+            else:
+                # Below does not work for me currently. Maybe an ROCM issue?
+                # from platform import python_version_tuple
+                # if int(python_version_tuple()[1]) < 11:
+                # Use torch compile if <3.11 because it's not supported for 3.11
+                #     self.pipe.unet.to(memory_format=torch.channels_last)
+                #     self.pipe.unet = torch.compile(self.pipe.unet, mode="reduce-overhead", fullgraph=True)
+                self.pipe = self.pipe.to(self.device)
+                if not on_device:
+                    self.pipe.unet.to("cpu")
+        else:
+            self.device = torch.device("cpu")
+
+    # One image per prompt in a single pipeline call, each from its own seed (random if None).
+    # An image only depends on its prompt and seed, not on the rest of the batch.
+    def generate_images(
+        self,
+        prompts: list[str],
+        seeds: list[int | None] | None = None,
+        iterations: int = 25,
+        negative_prompt: str | None = DEFAULT_NEGATIVE_PROMPT,
+    ):
+        prompts = [prompt + " , " + ImagePipeline.DEFAULT_PROMPT for prompt in prompts]
+        iterations = max(min(iterations, 60), 5)  # Get iterations in range (5, 60)
+
+        seeds = seeds if seeds is not None else [None] * len(prompts)
+        generators = [
+            torch.Generator(self.device).manual_seed(seed if seed is not None else randint(0, 2147483647))
+            for seed in seeds
+        ]
+
+        with self.lock:
+            # The pipeline would encode the negative prompt (no negative prompt encodes "") for every image
+            *embeds, negative_embeds = self.embeddings.lookup(prompts + [negative_prompt or ""], self.encode)
+            device, dtype = self.pipe._execution_device, self.pipe.text_encoder.dtype
+            start = perf_counter()
+            images = self.pipe(
+                prompt_embeds=torch.stack(embeds).to(device, dtype),
+                negative_prompt_embeds=negative_embeds.repeat(len(prompts), 1, 1).to(device, dtype),
+                height=ImagePipeline.IMAGE_DIM,
+                width=ImagePipeline.IMAGE_DIM,
+                num_inference_steps=iterations,
+                guidance_scale=7,
+                num_images_per_prompt=1,
+                generator=generators,
+            ).images
+            self.t_diffusion += perf_counter() - start
+            self.n_steps += iterations * len(images)
+            self.n_images += len(images)
+            # the allocator keeps its cache for the next batch unless memory is getting tight
+            if (reason := self.memory.after_batch(*self.memory_info())) is not None:
+                self._reclaim(reason)
+
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = Timer(self.memory.idle, self.reclaim, args=("idle",))
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+        return images
+
+    # CLIP text-encoder outputs of the texts, as the pipeline computes them from prompt and negative_prompt.
+    # They are kept on the CPU, so the cache takes no device memory.
+    def encode(self, texts: list[str]) -> list[torch.Tensor]:
+        start = perf_counter()
+        tokens = self.pipe.tokenizer(
+            texts,
+            padding="max_length",
+            max_length=self.pipe.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        with torch.no_grad():
+            embeds = self.pipe.text_encoder(tokens.input_ids.to(self.pipe._execution_device))[0]
+        self.t_text += perf_counter() - start
+        return list(embeds.to("cpu"))
+
+    def generate_image(self, prompt: str, seed: int | None = None, **kwargs):
+        return self.generate_images([prompt], [seed], **kwargs)
+
+    # The images as jpeg bytes, cheap to send back from a worker process
+    def generate_jpegs(self, prompts: list[str], seeds: list[int | None] | None = None, **kwargs) -> list[bytes]:
+        jpegs = []
+        for image in self.generate_images(prompts, seeds, **kwargs):
+            file = BytesIO()
+            start = perf_counter()
+            image.save(file, "jpeg")
+            self.t_encode += perf_counter() - start
+            jpegs.append(file.getvalue())
+        return jpegs
+
+    def generate_jpeg(self, prompt: str, seed: int | None = None, **kwargs) -> bytes:
+        return self.generate_jpegs([prompt], [seed], **kwargs)[0]
+
+    # Device memory in use (by anyone) and in total, zeros off the GPU
+    def memory_info(self) -> tuple[int, int]:
+        if self.device.type != "cuda":
+            return 0, 0
+        free, total = torch.cuda.mem_get_info(self.device)
+        return total - free, total
+
+    # Empty the allocator cache if the policy finds it worth it for reason (see ReclaimPolicy), e.g. "handoff"
+    # before ChatGen uses the device. Returns whether it did.
+    def reclaim(self, reason: str = "handoff") -> bool:
+        with self.lock:
+            if not self.memory.wants(reason):
+                return False
+            self._reclaim(reason)
+            return True
+
+    def _reclaim(self, reason: str):
+        self.torch_gc()
+        self.memory.reclaimed(reason)
+
+    # Totals over the lifetime of the pipeline, the t_ ones in seconds. n_steps counts a step once per image.
+    # Allocations that didn't need a new device segment from the caching allocator count as hits.
+    def counters(self) -> dict:
+        stats = torch.cuda.memory_stats(self.device) if self.device.type == "cuda" else {}
+        n_alloc_requests = stats.get("allocation.all.allocated", 0)
+        return {
+            "n_images": self.n_images,
+            "n_steps": self.n_steps,
+            "t_diffusion": self.t_diffusion,
+            "t_encode": self.t_encode,
+            "t_text": self.t_text,
+            "n_embed_hits": self.embeddings.n_hits,
+            "n_embed_misses": self.embeddings.n_misses,
+            "n_alloc_requests": n_alloc_requests,
+            "n_alloc_hits": n_alloc_requests - stats.get("segment.all.allocated", 0),
+            "reserved_bytes": stats.get("reserved_bytes.all.current", 0),
+            **{f"n_reclaim_{reason}": n for reason, n in self.memory.n_reclaims.items()},
+        }
+
+    # Moves the UNet, most of the weights, on or off the GPU for the device scheduler (see ImageGen.place).
+    # With low_vram, model offloading already moves it for each call, so there is only memory to give back.
+    def place(self, on_device: bool):
+        if self.device.type != "cuda":
+            return
+        with self.lock:
+            if not self.low_vram:
+                self.pipe.unet.to(self.device if on_device else "cpu")
+            if not on_device:
+                self.torch_gc()
+
+    # Drops the weights and gives their memory back, the pipeline can't be used afterwards
+    def close(self):
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+            del self.pipe
+            gc.collect()
+            self.torch_gc()
+
+    def torch_gc(self):
+        if torch.cuda.is_available():
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+                torch.cuda.ipc_collect()
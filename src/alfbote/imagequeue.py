@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from random import randint
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Hashable
+    from typing import Any
+
+
+@dataclass(eq=False)
+class ImageRequest:
+    user: Hashable
+    prompt: str
+    seed: int
+    iterations: int = 25
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+    submitted: float = field(default_factory=perf_counter)
+    started: float | None = None
+
+    # The image, None if the request was cancelled. Raises whatever the batch it was in raised.
+    async def result(self) -> Any | None:
+        await asyncio.wait({self.future})
+        if self.future.cancelled():
+            return None
+        return self.future.result()
+
+
+# Image requests waiting for the pipeline, run in batches: one pipeline call for up to max_batch prompts
+# (as many as fit in memory_budget at image_memory each) that share the number of iterations.
+# Every request has its own seed, so an image doesn't depend on what else was in its batch.
+# Requests queued while a batch runs make up the next one, an idle queue starts a lone request right away.
+class ImageQueue:
+    def __init__(
+        self,
+        run_batch: Callable[[list[ImageRequest]], Awaitable[list[Any]]],
+        max_batch: int = 4,
+        memory_budget: float = float("inf"),
+        image_memory: float = 1.0,
+        max_depth: int = 8,
+        max_per_user: int = 2,
+    ):
+        self.run_batch = run_batch
+        if memory_budget < max_batch * image_memory:
+            max_batch = int(memory_budget / image_memory)
+        self.max_batch = max(1, max_batch)
+        self.max_depth = max_depth
+        self.max_per_user = max_per_user
+        self.pending: deque[ImageRequest] = deque()
+        self.running: list[ImageRequest] = []
+        self.worker: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+
+        self.n_rejected = 0
+        self.n_batches = 0
+        self.n_images = 0
+        self.started: float | None = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Queue a prompt, returns None if the queue (or the user's share of it) is full
+    def submit(self, user: Hashable, prompt: str, seed: int | None = None, iterations: int = 25) -> ImageRequest | None:
+        n_user = sum(1 for request in self.pending if request.user == user)
+        if len(self.pending) >= self.max_depth or n_user >= self.max_per_user:
+            self.n_rejected += 1
+            return None
+
+        if self.worker is None:
+            self.worker = asyncio.create_task(self._worker())
+
+        seed = seed if seed is not None else randint(0, 2147483647)
+        request = ImageRequest(user=user, prompt=prompt, seed=seed, iterations=iterations)
+        self.pending.append(request)
+        self.wakeup.set()
+        return request
+
+    def cancel(self, request: ImageRequest):
+        if request in self.pending:
+            self.pending.remove(request)
+            request.future.cancel()
+
+    # The oldest request and the ones after it that can share its pipeline call
+    def _take(self) -> list[ImageRequest]:
+        first = self.pending.popleft()
+        batch = [first]
+        for request in list(self.pending):
+            if len(batch) >= self.max_batch:
+                break
+            if request.iterations == first.iterations:
+                self.pending.remove(request)
+                batch.append(request)
+        return batch
+
+    async def _worker(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            batch = self.running = self._take()
+            start = perf_counter()
+            if self.started is None:
+                self.started = start
+            for request in batch:
+                request.started = start
+            try:
+                results = await self.run_batch(batch)
+            except Exception as exc:
+                for request in batch:
+                    request.future.set_exception(exc)
+            else:
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+                self.n_images += len(batch)
+            finally:
+                self.running = []
+            self.n_batches += 1
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    def stats(self) -> dict:
+        elapsed = perf_counter() - self.started if self.started is not None else 0.0
+        return {
+            "queued": len(self.pending),
+            "running": len(self.running),
+            "rejected": self.n_rejected,
+            "batches": self.n_batches,
+            "images": self.n_images,
+            "mean_batch": self.n_images / self.n_batches if self.n_batches else 0.0,
+            "images_per_minute": self.n_images / elapsed * 60 if elapsed > 0 else 0.0,
+        }
+
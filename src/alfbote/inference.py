@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from typing import Any
+
+_END = object()
+
+
+# Async iterator over the items a worker thread produces
+class TokenStream:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.closed = False
+
+    # Ask the worker to stop, it checks between tokens
+    def cancel(self):
+        self.cancelled.set()
+
+    # Cancel and wait until the worker has let go of the generator
+    async def aclose(self):
+        self.cancel()
+        while not self.closed:
+            try:
+                await self.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                pass
+
+    # Called from the worker thread
+    def put(self, item: Any):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        item = await self.queue.get()
+        if item is _END:
+            self.closed = True
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+# A dedicated thread that runs blocking generators (LLaMA inference) one at a time, off the event loop.
+# The model is only ever touched from this thread.
+class InferenceWorker:
+    def __init__(self, name: str = "inference"):
+        self.jobs: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def stream(self, generate: Callable[[], Iterable[Any]]) -> TokenStream:
+        stream = TokenStream(asyncio.get_running_loop())
+        self.jobs.put((generate, stream))
+        return stream
+
+    # The thread exits once the jobs queued before this are done
+    def close(self):
+        self.jobs.put((None, None))
+
+    def _run(self):
+        while True:
+            generate, stream = self.jobs.get()
+            if generate is None:
+                return
+            if stream.cancelled.is_set():
+                stream.put(_END)
+                continue
+
+            tokens = None
+            try:
+                tokens = iter(generate())
+                for token in tokens:
+                    stream.put(token)
+                    if stream.cancelled.is_set():
+                        break
+            except Exception as exc:
+                stream.put(exc)
+            finally:
+                # Close the generator here, on the thread that owns the model
+                if tokens is not None and hasattr(tokens, "close"):
+                    tokens.close()
+                stream.put(_END)
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING
+
+from rich import print
+
+from alfbote.metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Callable
+    from typing import Any
+
+LOAD_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+# A model that isn't loaded until it is needed: start() loads it in the background (e.g. once the bot is
+# connected), and so does the first use() if nothing did. Requests meanwhile see warming_up and wait.
+# With idle_unload, it is unloaded again after that many seconds without use and loads on the next one.
+# load and unload are blocking and run off the event loop.
+class LazyModel:
+    def __init__(
+        self,
+        name: str,
+        load: Callable[[], Any],
+        unload: Callable[[Any], None] | None = None,
+        idle_unload: float = 0.0,
+    ):
+        self.name = name
+        self.load = load
+        self.unload = unload
+        self.idle_unload = idle_unload
+        self.model: Any | None = None
+        self.loading: asyncio.Task | None = None
+        self.unloading: asyncio.Task | None = None
+        self.unloader: asyncio.Task | None = None
+        self.users = 0
+        self.last_used = monotonic()
+
+        self.n_loads = 0
+        self.n_unloads = 0
+        self.load_started: float | None = None
+        self.load_time: float | None = None  # of the last load
+        self.waited = False  # a request is waiting for a load, and hasn't responded yet
+        self.first_response: float | None = None  # seconds from the start of the last load to the response after it
+        self.load_seconds = metrics.histogram(f"{name}_load_seconds", f"Time to load the {name} model", LOAD_BUCKETS)
+        self.first_response_seconds = metrics.histogram(
+            f"{name}_first_response_seconds", f"From the start of a {name} load to the first response", LOAD_BUCKETS
+        )
+
+    @property
+    def state(self) -> str:
+        if self.model is not None:
+            return "ready"
+        if self.loading is not None:
+            return "loading"
+        return "unloaded"
+
+    @property
+    def warming_up(self) -> bool:
+        return self.model is None
+
+    # Start loading in the background, if it isn't loaded or loading already
+    def start(self) -> asyncio.Task | None:
+        if self.model is None and self.loading is None:
+            self.loading = asyncio.create_task(self._load())
+            self.loading.add_done_callback(self._loaded)
+        return self.loading
+
+    # The model, loading it first if needed
+    async def get(self) -> Any:
+        while self.model is None:
+            # a request that gives up waiting doesn't stop the load for everyone else
+            await asyncio.shield(self.start())
+        return self.model
+
+    # Hold the model for a request, it isn't unloaded while in use
+    @asynccontextmanager
+    async def use(self) -> AsyncIterator[Any]:
+        self.users += 1
+        if self.model is None:
+            self.waited = True
+        try:
+            yield await self.get()
+        finally:
+            self.users -= 1
+            self.last_used = monotonic()
+
+    # A request got its response, e.g. the first token was sent. The first one that had to wait for a load
+    # measures the cold start.
+    def responded(self):
+        if self.waited and self.load_started is not None:
+            self.waited = False
+            self.first_response = perf_counter() - self.load_started
+            self.first_response_seconds.observe(self.first_response)
+            print(f"[green] {self.name}: first response {self.first_response:.1f}s after starting to load")
+
+    async def _load(self):
+        if self.unloading is not None:
+            await self.unloading
+        self.load_started = perf_counter()
+        model = await asyncio.get_running_loop().run_in_executor(None, self.load)
+        self.load_time = perf_counter() - self.load_started
+        self.load_seconds.observe(self.load_time)
+        self.n_loads += 1
+        self.model = model
+        self.last_used = monotonic()
+        print(f"[green] {self.name}: loaded in {self.load_time:.1f}s")
+        if self.idle_unload > 0 and self.unloader is None:
+            self.unloader = asyncio.create_task(self._unload_when_idle())
+
+    def _loaded(self, task: asyncio.Task):
+        self.loading = None
+        # a failed load is retried by the next request
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[red] {self.name}: failed to load: {task.exception()}")
+
+    async def _unload_when_idle(self):
+        while True:
+            wait = self.last_used + self.idle_unload - monotonic()
+            if self.model is None or self.users > 0 or wait > 0:
+                await asyncio.sleep(max(wait, 1.0))
+                continue
+            await self.drop()
+            print(f"[yellow] {self.name}: unloaded after {self.idle_unload:g}s idle")
+
+    # The model if it is loaded, after a load in progress, without starting one
+    async def current(self) -> Any | None:
+        if self.loading is not None:
+            try:
+                await asyncio.shield(self.loading)
+            except Exception:
+                pass
+        return self.model
+
+    # Unload now, e.g. to load it again with other settings. The next use loads it.
+    async def drop(self):
+        if (model := await self.current()) is None:
+            return
+        self.model = None
+        self.unloading = asyncio.create_task(self._unload(model))
+        try:
+            await self.unloading
+        finally:
+            self.unloading = None
+
+    async def _unload(self, model: Any):
+        if self.unload is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.unload, model)
+        self.n_unloads += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "loads": self.n_loads,
+            "unloads": self.n_unloads,
+            "load_time": self.load_time,
+            "first_response": self.first_response,
+        }
+
@@ -1,20 +1,27 @@
 import sys
 import datetime
+import llama_cpp
 from alfbote.llamacpp.common import GptParams
+from alfbote.llamacpp.context import TurnWindow
 from alfbote.llamacpp.low_level_api_chat_cpp import LLaMAInteract
+from alfbote.llamacpp import util
+from alfbote.llamacpp.prompt_cache import PromptCache
+from alfbote.llamacpp.sessions import SessionManager, SessionStore
 from pathlib import Path
+from typing import Hashable
 
 DIR = Path(__file__).parent
 AI_NAME = "alfbote"
 DEFAULT_MODEL_DIR = DIR / "models"
 DEFAULT_MODEL = DEFAULT_MODEL_DIR / "llama2_7b_chat_uncensored.ggmlv3.q4_K_M.bin"
+DEFAULT_CACHE_DIR = DIR / "cache"
 USER_NAME = "user"
 
 today = datetime.datetime.today()
 DATE_YEAR = today.strftime("%Y")
 DATE_TIME = today.strftime("%H:%M")
 
-prompt = f"""Text transcript of a never ending dialog, where {USER_NAME} interacts with an AI assistant named {AI_NAME}.
+static_prompt = f"""Text transcript of a never ending dialog, where {USER_NAME} interacts with an AI assistant named {AI_NAME}.
 {AI_NAME} is helpful, kind, honest, friendly, good at writing and never fails to answer {USER_NAME}'s requests immediately and with details and precision.
 There are no annotations like (30 seconds passed...) or (to himm), just what {USER_NAME} and {AI_NAME} say aloud to each other.
 The dialog lasts for years, the entirety of it is shared below. It's 10000 pages long.
@@ -39,10 +46,14 @@ The transcript only includes text, it does not include markup like HTML and Mark
     argv[3] is the second argument passed to the script and so on.
 {USER_NAME}: Name a color.
 {AI_NAME}: Blue.
-{USER_NAME}: What time is it?
+"""
+# The time changes every minute, so it goes after the part of the prompt the prompt cache is keyed on
+prompt = (
+    static_prompt
+    + f"""{USER_NAME}: What time is it?
 {AI_NAME}: It is {DATE_TIME}.
-{USER_NAME}:""" + " ".join(
-    sys.argv[1:]
+{USER_NAME}:"""
+    + " ".join(sys.argv[1:])
 )
 
 
@@ -52,10 +63,20 @@ class Llama2:
         model_file: Path | str = DEFAULT_MODEL,
         n_threads: int = 4,  # Number of CPU threads
         n_predict: int = 256,
+        n_batch: int = 512,  # Max tokens per llama_eval call when evaluating the prompt and user input
         n_gpu_layers: int = 1000,  # Set this high to use only GPU. Set to 0 to use only CPU.
         low_vram: bool = True,
         temp: float = 0.8,
         repeat_penalty: float = 1.2,
+        prompt_cache_dir: Path | str | None = DEFAULT_CACHE_DIR,  # Reuse the evaluated prompt across restarts
+        session_budget_mb: int = 2048,  # Memory for inactive conversation snapshots
+        context_turns: int = 4,  # Most recent turns kept when a conversation outgrows the context
+        model=None,  # Weights loaded by another Llama2 (self.m.model) to share instead of loading again
+        session_store: SessionStore | None = None,  # Conversations shared with other Llama2 of the same model
+        draft_model_file: Path | str | None = None,  # Small model with the same vocabulary for speculative decoding
+        n_draft: int = 5,  # Tokens the draft model guesses ahead
+        draft_model=None,  # Draft weights loaded by another Llama2 (self.m.draft.model)
+        timed: bool = False,  # Measure the time spent in each phase of generation, see counters
     ):
         self.params = GptParams(
             n_ctx=2048,
@@ -63,7 +84,8 @@ class Llama2:
             top_k=40,
             top_p=0.5,
             repeat_last_n=256,
-            n_batch=1024,
+            n_batch=n_batch,
+            n_keep=-1,  # Pin the whole prompt when the context fills up
             repeat_penalty=repeat_penalty,
             model=str(model_file),
             n_threads=n_threads,
@@ -76,33 +98,94 @@ class Llama2:
             prompt=prompt,
             n_gpu_layers=n_gpu_layers,
             low_vram=low_vram,
+            model_draft=str(draft_model_file) if draft_model_file is not None else "",
+            n_draft=n_draft,
         )
-        self.m = LLaMAInteract(self.params)
-        # Flush prompt buffer
-        for i in self.m.output():
-            # print(i,end="",flush=True)
-            pass
+        if prompt_cache_dir is not None:
+            self.params.path_session = PromptCache(prompt_cache_dir).session_path(self.params, static_prompt)
+
+        self.m = LLaMAInteract(
+            self.params,
+            context_policy=TurnWindow(max_turns=context_turns),
+            model=model,
+            draft_model=draft_model,
+        )
+        # Evaluate the prompt, or load it from the prompt cache
+        self.m.prefill()
+        self.m.timed = timed
         self.m.params.input_echo = False
+        self.sessions = SessionManager(self.m, budget_bytes=session_budget_mb * 1024 * 1024, store=session_store)
+
+    @property
+    def n_sampled(self) -> int:
+        return self.m.n_sampled
+
+    # Conversation currently in the context
+    @property
+    def active_session(self) -> Hashable | None:
+        return self.sessions.active
+
+    # Totals over the lifetime of the context, the t_ ones in seconds and only counted when timed
+    def counters(self) -> dict:
+        return {
+            "n_sampled": self.n_sampled,
+            "n_drafted": self.m.n_drafted,
+            "n_accepted": self.m.n_accepted,
+            "n_prefill": self.m.n_prefill,
+            "t_prefill": self.m.t_prefill,
+            "n_decode": self.m.n_decode,
+            "t_decode": self.m.t_decode,
+            "t_sample": self.m.t_sample,
+            "t_detokenize": self.m.t_detokenize,
+        }
 
-    def generate(self, msg: str):
+    # size independent contexts over one copy of the weights, with conversations shared between them
+    @classmethod
+    def pool(cls, size: int, **kwargs) -> list["Llama2"]:
+        first = cls(**kwargs)
+        kwargs.update(model=first.m.model, session_store=first.sessions.store)
+        if first.m.draft is not None:
+            kwargs.update(draft_model=first.m.draft.model)
+        return [first] + [cls(**kwargs) for _ in range(size - 1)]
+
+    # Frees the contexts of a pool, then the weights they share. Their conversations stay in the session store.
+    @staticmethod
+    def close_pool(models: list["Llama2"]):
+        for model in models:
+            model.sessions.close()
+            model.m.exit()
+        first = models[0].m
+        if hasattr(llama_cpp, "llama_free_model"):
+            if first.model is not None:
+                llama_cpp.llama_free_model(first.model)
+            if first.draft is not None and first.draft.model is not None:
+                llama_cpp.llama_free_model(first.draft.model)
+
+    # session is any hashable conversation key, e.g. (guild id, channel id, user id)
+    def generate(self, msg: str, session: Hashable | None = None):
+        if session is not None:
+            self.sessions.activate(session)
         self.m.input(f"{msg}\n")
 
+        # Hold back partial speaker tags and drop complete ones at the start of the reply or of a line
+        tags = util.IterSearch(f"{USER_NAME}:", f"{AI_NAME}:", line_start=True)
         buffered_tokens = []
         for token in self.m.output():
-            buffered_tokens.append(token)
+            text = tags.feed(token)
+            if not text:
+                continue
+            buffered_tokens.append(text)
 
-            buffered_string = ''.join(buffered_tokens)
-
-            # If the buffered string forms a complete word (or phrase) we're looking for
-            if buffered_string in [USER_NAME + ":", AI_NAME + ":"]:
-                buffered_tokens = []  # clear the buffer without printing
-            elif buffered_string.endswith(' ') or buffered_string.endswith('\n'):
-                # If we reach a space or newline, we output the buffered tokens if it's not empty
+            # If we reach a space or newline, we output the buffered tokens if it's not empty
+            if text.endswith(' ') or text.endswith('\n'):
+                buffered_string = ''.join(buffered_tokens)
                 if buffered_string.strip():  # check if the string is not empty
                     yield buffered_string
                 buffered_tokens = []
-        if buffered_tokens and buffered_string.strip():  # output any remaining tokens after the loop if it's not empty
-            yield ''.join(buffered_tokens)
+
+        buffered_string = ''.join(buffered_tokens + tags.flush())
+        if buffered_string.strip():  # output any remaining tokens after the loop if it's not empty
+            yield buffered_string
 
 
 if __name__ == "__main__":
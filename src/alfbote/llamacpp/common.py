@@ -18,6 +18,7 @@ class GptParams:
     n_batch: int = 8
     n_keep: int = 0
     n_gpu_layers: int = 0
+    n_draft: int = 16
 
     ignore_eos: bool = False
     logit_bias: dict[int, float] = field(default_factory=dict)
@@ -35,6 +36,7 @@ class GptParams:
     mirostat_eta: float = 0.1
 
     model: str = "./models/llama-7B/ggml-model.bin"
+    model_draft: str = ""
     prompt: str = ""
     path_session: str = ""
     input_prefix: str = " "
@@ -149,6 +151,12 @@ def gpt_params_parse(argv=None):
     parser.add_argument(
         "-m", "--model", type=str, default="./models/llama-7B/ggml-model.bin", help="model path", dest="model"
     )
+    parser.add_argument(
+        "-md", "--model-draft", type=str, default="", help="draft model for speculative decoding", dest="model_draft"
+    )
+    parser.add_argument(
+        "--draft", type=int, default=16, help="number of tokens to draft for speculative decoding", dest="n_draft"
+    )
     parser.add_argument("-p", "--prompt", type=str, default="", help="initial prompt", dest="prompt")
     parser.add_argument(
         "-f", "--file", type=str, default=None, help="file containing initial prompt to load", dest="file"
@@ -0,0 +1,60 @@
+"""
+What to keep when a conversation outgrows n_ctx.
+
+The first n_keep tokens (the pinned prompt) stay in the KV cache untouched, because their positions don't change.
+A policy picks how many of the most recent tokens after them are kept, those are the only tokens re-evaluated.
+This llama.cpp API has no KV shift, so kept history always costs one re-evaluation per overflow,
+but the pinned prompt never does.
+"""
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .low_level_api_chat_cpp import LLaMAInteract
+
+
+class ContextPolicy(ABC):
+    # Number of trailing history tokens to keep, at most budget.
+    # history is everything after the pinned prompt that is in the KV cache.
+    @abstractmethod
+    def keep(self, m: "LLaMAInteract", history: list[int], budget: int) -> int:
+        ...
+
+
+# llama.cpp main's context swap: keep the last half of the history
+class HalfContext(ContextPolicy):
+    def keep(self, m: "LLaMAInteract", history: list[int], budget: int) -> int:
+        return min(len(history) // 2, budget)
+
+
+# Keep the latest max_turns whole turns, using at most fraction of the free context so the reply has room.
+# A turn starts right after the turn marker (the first antiprompt by default, e.g. "user:"),
+# so with a prompt ending in the marker the kept history continues it seamlessly.
+# If not even the last turn fits, the last budget tokens are kept.
+class TurnWindow(ContextPolicy):
+    def __init__(self, max_turns: int = 4, fraction: float = 0.5, marker: list[int] | None = None):
+        self.max_turns = max_turns
+        self.fraction = fraction
+        self.marker = marker
+
+    def keep(self, m: "LLaMAInteract", history: list[int], budget: int) -> int:
+        budget = int(budget * self.fraction)
+        marker = self.marker if self.marker is not None else (m.first_antiprompt[0] if m.first_antiprompt else [])
+        k = len(marker)
+        if k == 0:
+            return min(len(history) // 2, budget)
+
+        # turn starts from the newest back, only whole turns that fit
+        n_keep = 0
+        n_turns = 0
+        for i in range(len(history) - k, -1, -1):
+            if history[i : i + k] != marker:
+                continue
+            n = len(history) - (i + k)
+            if n == 0:
+                continue
+            if n > budget or n_turns == self.max_turns:
+                break
+            n_keep = n
+            n_turns += 1
+        return n_keep if n_keep > 0 else min(len(history), budget)
@@ -10,19 +10,52 @@ Quirks:
    You should also still be feeding the model with a "primer" prompt that 
    shows it the expected format.
 """
+import codecs
 import ctypes
 import sys
-from time import time
+from dataclasses import dataclass
+from time import perf_counter, time
 from os import cpu_count, path
 
 import llama_cpp
 from .common import GptParams, gpt_params_parse, gpt_random_prompt
+from .context import ContextPolicy, HalfContext
+from .sampling import SamplerPipeline
+from .speculative import DraftModel
+from .tokenizer import Tokenizer
+from .vocab import Vocab
 from . import util
 
 
+# Snapshot of a conversation in a LLaMAInteract, see get_state/set_state
+@dataclass
+class LLaMAState:
+    n_past: int
+    embd: list[int]
+    embd_inp: list[int]
+    last_n_tokens: util.Circle
+    antiprompt_state: int
+    remaining_tokens: int
+    utf8_state: tuple  # incremental decoder state, bytes of an unfinished character
+    n_context_swaps: int
+    llama_state: bytearray | None = None  # KV cache, logits and rng from llama_copy_state_data
+    kv_tokens: list[int] | None = None  # tokens in the KV cache, tracked for the draft model
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.llama_state) if self.llama_state is not None else 0
+
+
 # A LLaMA interactive session
 class LLaMAInteract:
-    def __init__(self, params: GptParams) -> None:
+    def __init__(
+        self,
+        params: GptParams,
+        vocab: Vocab | None = None,
+        context_policy: ContextPolicy | None = None,
+        model: "llama_cpp.llama_model_p | None" = None,
+        draft_model: "llama_cpp.llama_model_p | None" = None,
+    ) -> None:
         # input args
         self.params = params
 
@@ -63,7 +96,20 @@ specified) expect poor results""",
         self.first_antiprompt = []
         self.remaining_tokens = self.params.n_predict
         self.output_echo = self.params.input_echo
-        self.multibyte_fix = []
+        # token pieces can split a utf8 character, the decoder holds the partial bytes back
+        self.utf8_decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.n_context_swaps = 0
+        self.n_swap_tokens = 0  # tokens re-evaluated after context swaps
+        self.n_sampled = 0  # tokens generated over the lifetime of the context
+        # seconds spent in each phase, only measured while timed is set
+        self.timed = False
+        self.t_prefill = 0.0  # evaluating input, n_prefill tokens of it
+        self.n_prefill = 0
+        self.t_decode = 0.0  # evaluating sampled tokens (with their drafts), n_decode evals
+        self.n_decode = 0
+        self.t_sample = 0.0
+        self.t_detokenize = 0.0
+        self.context_policy = context_policy if context_policy is not None else HalfContext()
 
         # model load
         self.lparams = llama_cpp.llama_context_default_params()
@@ -77,14 +123,51 @@ specified) expect poor results""",
         self.lparams.low_vram = self.params.low_vram
         self.lparams.interactive = self.params.interactive
         self.lparams.interactive_start = self.params.interactive_start
-
-        self.ctx = llama_cpp.llama_init_from_file(self.params.model.encode("utf8"), self.lparams)
+        # speculative decoding checks all the drafted tokens with one eval, so it needs the logits of each
+        self.lparams.logits_all = len(self.params.model_draft) > 0
+
+        # weights are loaded once and can be shared with other contexts (see model),
+        # except with a lora adapter, which is applied to the weights in place
+        if model is None and hasattr(llama_cpp, "llama_load_model_from_file") and not self.params.lora_adapter:
+            model = llama_cpp.llama_load_model_from_file(self.params.model.encode("utf8"), self.lparams)
+            if not model:
+                raise RuntimeError(f"error: failed to load model '{self.params.model}'")
+        self.model = model
+
+        if self.model is not None:
+            self.ctx = llama_cpp.llama_new_context_with_model(self.model, self.lparams)
+        else:
+            self.ctx = llama_cpp.llama_init_from_file(self.params.model.encode("utf8"), self.lparams)
         if not self.ctx:
             raise RuntimeError(f"error: failed to load model '{self.params.model}'")
 
         if self.params.ignore_eos:
             self.params.logit_bias[llama_cpp.llama_token_eos()] = -float("inf")
 
+        # sampling chain for the params, with one candidate buffer refilled in place for every sampled token
+        self.n_vocab = llama_cpp.llama_n_vocab(self.ctx)
+        self.sampler = SamplerPipeline(self.params, self.n_vocab, self.params.n_ctx)
+        # token id -> bytes, shared by every context of this model
+        self.vocab = vocab if vocab is not None else Vocab.for_model(self.ctx, self.params.model)
+        # cached tokenization of repeated strings (antiprompts, markers, instruct prefixes)
+        self.tokenizer = Tokenizer(self.ctx)
+        # llama_copy_state_data target, allocated on the first snapshot and reused: the state size is the whole
+        # KV cache while a copy only fills the part holding tokens
+        self.state_buf = None
+
+        # speculative decoding, a draft model guesses up to n_draft tokens ahead
+        self.draft = None
+        self.kv_tokens: list[int] | None = None
+        self.ahead: list[int] = []  # drafted tokens evaluated past n_past, used while sampling agrees with them
+        self.n_ahead = 0  # rows of the last eval's logits used up
+        self.logits_ptr = None  # logits row to sample from, when there is one per token
+        self.n_drafted = 0
+        self.n_accepted = 0
+        self.n_draft_evals = 0
+        if len(self.params.model_draft) > 0:
+            self.draft = DraftModel(self.params, self.n_vocab, model=draft_model)
+            self.kv_tokens = []
+
         if len(self.params.lora_adapter) > 0:
             if (
                 llama_cpp.llama_apply_lora_from_file(
@@ -141,11 +224,14 @@ specified) expect poor results""",
                     )
                     != 1
                 ):
-                    print(f"error: failed to load session file '{self.params.path_session}'", file=sys.stderr)
-                    return
-                _n_token_count_out = _n_token_count_out.value
-                self.session_tokens = _session_tokens[:_n_token_count_out]
-                print(f"loaded a session with prompt size of {_n_token_count_out} tokens", file=sys.stderr)
+                    print(
+                        f"error: failed to load session file '{self.params.path_session}', will recreate",
+                        file=sys.stderr,
+                    )
+                else:
+                    _n_token_count_out = _n_token_count_out.value
+                    self.session_tokens = _session_tokens[:_n_token_count_out]
+                    print(f"loaded a session with prompt size of {_n_token_count_out} tokens", file=sys.stderr)
             else:
                 print(f"session file does not exist, will create", file=sys.stderr)
 
@@ -169,6 +255,8 @@ specified) expect poor results""",
 
             if self.n_matching_session_tokens >= len(self.embd_inp):
                 print(f"session file has exact match for prompt!")
+                # re-evaluate the last prompt token so the logits are fresh
+                self.session_tokens = self.session_tokens[: len(self.embd_inp) - 1]
             elif self.n_matching_session_tokens < (len(self.embd_inp) / 2):
                 print(
                     f"warning: session file has low similarity to prompt ({self.n_matching_session_tokens} / {len(self.embd_inp)} tokens); will mostly be reevaluated"
@@ -260,8 +348,11 @@ n_keep = {self.params.n_keep}
         # determine antiprompt tokens
         for i in self.params.antiprompt:
             self.first_antiprompt.append(self._tokenize(i, False))
+        self.antiprompt_matcher = util.StopMatcher(self.first_antiprompt)
 
-        self.last_n_tokens = [0] * self.n_ctx  # TODO: deque doesnt support slices
+        # repetition window, O(1) push and a contiguous view of the newest tokens for the penalty
+        self.last_n_tokens = util.Circle(self.n_ctx)
+        self.last_n_tokens.extend([0] * self.n_ctx)
 
         if params.interactive:
             print(
@@ -277,9 +368,205 @@ n_keep = {self.params.n_keep}
 
     # tokenize a prompt
     def _tokenize(self, prompt, bos=True):
-        _arr = (llama_cpp.llama_token * ((len(prompt) + 1) * 4))()
-        _n = llama_cpp.llama_tokenize(self.ctx, prompt.encode("utf8", errors="ignore"), _arr, len(_arr), bos)
-        return _arr[:_n]
+        return self.tokenizer(prompt, bos)
+
+    # evaluate tokens in chunks of at most n_batch, advancing n_past per chunk
+    def _eval(self, tokens):
+        if len(tokens) == 0:
+            return
+        n_batch = max(self.params.n_batch, 1)
+        for i in range(0, len(tokens), n_batch):
+            n_eval = min(n_batch, len(tokens) - i)
+            _arr = (llama_cpp.llama_token * n_eval)(*tokens[i : i + n_eval])
+            if llama_cpp.llama_eval(self.ctx, _arr, n_eval, self.n_past, self.params.n_threads) != 0:
+                raise Exception("Failed to llama_eval!")
+            if self.kv_tokens is not None:
+                del self.kv_tokens[self.n_past :]
+                self.kv_tokens.extend(tokens[i : i + n_eval])
+            self.n_past += n_eval
+        self.ahead = []
+        self.logits_ptr = self._logits_row(n_eval - 1) if self.lparams.logits_all else None
+
+    # evaluate the sampled token id together with the tokens the draft model guesses come next.
+    # Sampling goes on as usual from the logits of each row, and _eval_embd skips evaluating the drafted tokens
+    # for as long as what is sampled agrees with them, so the output is the same as without a draft.
+    def _eval_draft(self, id):
+        remaining = self.remaining_tokens if self.params.n_predict != -1 else self.params.n_draft
+        k = min(self.params.n_draft, remaining, self.n_ctx - self.n_past - 1, max(self.params.n_batch, 1) - 1)
+        if k <= 0:
+            self._eval([id])
+            return
+        del self.kv_tokens[self.n_past :]
+        drafted = self.draft.propose(self.kv_tokens + [id], k)
+        self._eval([id] + drafted)
+        self.n_past -= len(drafted)
+        self.ahead = drafted
+        self.n_ahead = 0
+        self.logits_ptr = self._logits_row(0)
+        self.n_drafted += len(drafted)
+        self.n_draft_evals += 1
+
+    # logits of the last evaluated token
+    def _logits(self):
+        if self.logits_ptr is not None:
+            return self.logits_ptr
+        return llama_cpp.llama_get_logits(self.ctx)
+
+    # with logits_all, llama_get_logits has a row for every token of the last eval
+    def _logits_row(self, i):
+        _base = ctypes.cast(llama_cpp.llama_get_logits(self.ctx), ctypes.c_void_p).value
+        return ctypes.cast(_base + i * self.n_vocab * ctypes.sizeof(ctypes.c_float), ctypes.POINTER(ctypes.c_float))
+
+    # evaluate pending embd (context swapping and session prefix reuse included)
+    def _eval_embd(self):
+        if len(self.embd) > 0:
+            # infinite text generation via context swapping
+            # if we run out of context:
+            # - take the n_keep first tokens from the original prompt (via n_past), they stay in the KV cache
+            # - take the recent tokens the context policy keeps and recompute the logits in a batch
+            if self.n_past + len(self.embd) > self.n_ctx:
+                self.n_context_swaps += 1
+                n_keep = self.params.n_keep
+                _end = self.n_ctx - len(self.embd)
+                history = self.last_n_tokens[max(0, _end - (self.n_past - n_keep)) : _end]
+                n_insert = self.context_policy.keep(self, history, max(0, _end - n_keep))
+                self.n_past = n_keep
+                self.ahead = []
+
+                # insert the kept tokens at the start of embd from last_n_tokens
+                self.embd = history[len(history) - n_insert :] + self.embd
+                self.n_swap_tokens += n_insert
+                self.params.path_session = ""
+                print(
+                    f"LLAMA: Resizing context, kept {n_keep} prompt tokens, re-evaluating {n_insert} of "
+                    f"{len(history)} history tokens",
+                    file=sys.stderr,
+                )
+
+            # try to reuse a matching prefix from the loaded session instead of re-eval (via n_past)
+            if self.n_session_consumed < len(self.session_tokens):
+                i = 0
+                while i < len(self.embd):
+                    if self.embd[i] != self.session_tokens[self.n_session_consumed]:
+                        self.session_tokens = self.session_tokens[: self.n_session_consumed]
+                        break
+
+                    self.n_past += 1
+                    self.n_session_consumed += 1
+                    i += 1
+
+                    if self.n_session_consumed >= len(self.session_tokens):
+                        break
+
+                if self.kv_tokens is not None:
+                    self.kv_tokens[self.n_past - i :] = self.embd[:i]
+                self.embd = self.embd[i:]
+
+            # drafted tokens that are already in the KV cache (see _eval_draft)
+            n_match = 0
+            while n_match < min(len(self.ahead), len(self.embd)) and self.embd[n_match] == self.ahead[n_match]:
+                n_match += 1
+            if n_match > 0:
+                self.n_past += n_match
+                self.n_ahead += n_match
+                self.n_accepted += n_match
+                self.logits_ptr = self._logits_row(self.n_ahead)
+                self.ahead = self.ahead[n_match:]
+                self.embd = self.embd[n_match:]
+
+            # evaluate tokens in batches
+            # embd is typically prepared beforehand to fit within a batch, but not always
+            _start = perf_counter() if self.timed else 0.0
+            if self.draft is not None and len(self.embd) == 1 and len(self.embd_inp) <= self.input_consumed:
+                self._eval_draft(self.embd[0])
+            else:
+                self._eval(self.embd)
+            if self.timed and len(self.embd) > 1:
+                self.t_prefill += perf_counter() - _start
+                self.n_prefill += len(self.embd)
+            elif self.timed and len(self.embd) == 1:
+                self.t_decode += perf_counter() - _start
+                self.n_decode += 1
+
+            if len(self.embd) > 0 and len(self.params.path_session) > 0:
+                self.session_tokens.extend(self.embd)
+                self.n_session_consumed = len(self.session_tokens)
+
+        self.embd = []
+
+    # evaluate all pending input without sampling, e.g. the prompt at startup
+    # tokens matching the loaded session are skipped, and the session is saved if it didn't match
+    def prefill(self):
+        while True:
+            self._eval_embd()
+            if len(self.embd_inp) <= self.input_consumed:
+                break
+            n_eval = min(max(self.params.n_batch, 1), len(self.embd_inp) - self.input_consumed)
+            for id in self.embd_inp[self.input_consumed : self.input_consumed + n_eval]:
+                self.embd.append(id)
+                self._push_last(id)
+            self.input_consumed += n_eval
+
+        if len(self.params.path_session) > 0 and self.need_to_save_session:
+            self.save_session()
+
+    def save_session(self):
+        self.need_to_save_session = False
+        llama_cpp.llama_save_session_file(
+            self.ctx,
+            self.params.path_session.encode("utf8"),
+            (llama_cpp.llama_token * len(self.session_tokens))(*self.session_tokens),
+            len(self.session_tokens),
+        )
+
+    # snapshot the conversation, with the llama state (KV cache) if kv is set
+    def get_state(self, kv: bool = True) -> LLaMAState:
+        llama_state = None
+        if kv:
+            if self.state_buf is None:
+                self.state_buf = (ctypes.c_uint8 * llama_cpp.llama_get_state_size(self.ctx))()
+            _n = llama_cpp.llama_copy_state_data(self.ctx, self.state_buf)
+            llama_state = bytearray(memoryview(self.state_buf)[:_n])
+
+        return LLaMAState(
+            n_past=self.n_past,
+            embd=list(self.embd),
+            embd_inp=self.embd_inp[self.input_consumed :],
+            last_n_tokens=self.last_n_tokens.copy(),
+            antiprompt_state=self.antiprompt_matcher.state,
+            remaining_tokens=self.remaining_tokens,
+            utf8_state=self.utf8_decoder.getstate(),
+            n_context_swaps=self.n_context_swaps,
+            llama_state=llama_state,
+            kv_tokens=list(self.kv_tokens) if self.kv_tokens is not None else None,
+        )
+
+    # restore a snapshot from get_state
+    # without kv, the llama state is left as is, which is only valid if the KV cache still holds the first n_past tokens
+    def set_state(self, state: LLaMAState, kv: bool = True):
+        if kv and state.llama_state is not None:
+            _n = len(state.llama_state)
+            llama_cpp.llama_set_state_data(self.ctx, (ctypes.c_uint8 * _n).from_buffer(state.llama_state))
+
+        self.n_past = state.n_past
+        self.embd = list(state.embd)
+        self.embd_inp = list(state.embd_inp)
+        self.input_consumed = 0
+        self.last_n_tokens = state.last_n_tokens.copy()
+        self.antiprompt_matcher.state = state.antiprompt_state
+        self.antiprompt_matcher.match = self.antiprompt_matcher.out[state.antiprompt_state]
+        self.remaining_tokens = state.remaining_tokens
+        self.utf8_decoder.setstate(state.utf8_state)
+        self.n_context_swaps = state.n_context_swaps
+        if self.kv_tokens is not None:
+            self.kv_tokens = list(state.kv_tokens)
+        self.ahead = []
+        self.logits_ptr = None
+
+    # record a token in the repetition window and the antiprompt matcher
+    def _push_last(self, id):
+        self.last_n_tokens.append(id)
+        self.antiprompt_matcher.push(id)
 
     def set_color(self, c):
         if self.params.use_color:
@@ -288,170 +575,31 @@ n_keep = {self.params.n_keep}
     def use_antiprompt(self):
         return len(self.first_antiprompt) > 0
 
+    # sample the next token from the logits of the last evaluated token
+    def _sample(self) -> int:
+        _last = self.last_n_tokens.tail(min(len(self.last_n_tokens), self.sampler.last_n))
+        return self.sampler(self.ctx, self._logits(), _last)
+
     # generate tokens
     def generate(self):
         while self.remaining_tokens > 0 or self.params.interactive or self.params.n_predict == -1:
             # predict
-            if len(self.embd) > 0:
-                # infinite text generation via context swapping
-                # if we run out of context:
-                # - take the n_keep first tokens from the original prompt (via n_past)
-                # - take half of the last (n_ctx - n_keep) tokens and recompute the logits in a batch
-                if self.n_past + len(self.embd) > self.n_ctx:
-                    print("LLAMA: Resizing context.")
-                    n_left = self.n_past - self.params.n_keep
-                    self.n_past = self.params.n_keep
-
-                    # insert n_left/2 tokens at the start of embd from last_n_tokens
-                    _insert = self.last_n_tokens[self.n_ctx - int(n_left / 2) - len(self.embd) : -len(self.embd)]
-                    self.embd = _insert + self.embd
-                    self.params.path_session = ""
-
-                # try to reuse a matching prefix from the loaded session instead of re-eval (via n_past)
-                if self.n_session_consumed < len(self.session_tokens):
-                    for i in range(len(self.embd)):
-                        if self.embd[i] != self.session_tokens[self.n_session_consumed]:
-                            self.session_tokens = self.session_tokens[: self.n_session_consumed]
-                            break
-
-                        self.n_past += 1
-                        self.n_session_consumed += 1
-
-                        if self.n_session_consumed >= len(self.session_tokens):
-                            i += 1
-                            break
-
-                    if i > 0:
-                        self.embd = self.embd[i:]
-
-                # evaluate tokens in batches
-                # embd is typically prepared beforehand to fit within a batch, but not always
-                # TODO BUG: The batching code causes nonsensical generation
-                """for i in range(0, len(self.embd), self.params.n_batch):
-                    n_eval = self.params.n_batch
-                    _arr = (llama_cpp.llama_token * n_eval)(*self.embd[i:i + n_eval])
-                    if llama_cpp.llama_eval(self.ctx, _arr, n_eval, self.n_past, self.params.n_threads) != 0:
-                        print(f"failed to eval")
-                        return
-                    
-                    self.n_past += n_eval"""
+            self._eval_embd()
 
-                if (
-                    llama_cpp.llama_eval(
-                        self.ctx,
-                        (llama_cpp.llama_token * len(self.embd))(*self.embd),
-                        len(self.embd),
-                        self.n_past,
-                        self.params.n_threads,
-                    )
-                    != 0
-                ):
-                    raise Exception("Failed to llama_eval!")
-
-                if len(self.embd) > 0 and len(self.params.path_session) > 0:
-                    self.session_tokens.extend(self.embd)
-                    self.n_session_consumed = len(self.session_tokens)
-
-            self.n_past += len(self.embd)
-            self.embd = []
             if len(self.embd_inp) <= self.input_consumed:  # && !is_interacting
                 # out of user input, sample next token
-                top_k = llama_cpp.llama_n_vocab(self.ctx) if self.params.top_k <= 0 else self.params.top_k
-                repeat_last_n = self.n_ctx if self.params.repeat_last_n < 0 else self.params.repeat_last_n
-
                 # optionally save the session on first sample (for faster prompt loading next time)
                 if len(self.params.path_session) > 0 and self.need_to_save_session:
-                    self.need_to_save_session = False
-                    llama_cpp.llama_save_session_file(
-                        self.ctx,
-                        self.params.path_session.encode("utf8"),
-                        (llama_cpp.llama_token * len(self.session_tokens))(*self.session_tokens),
-                        len(self.session_tokens),
-                    )
-
-                id = 0
-
-                logits = llama_cpp.llama_get_logits(self.ctx)
-                n_vocab = llama_cpp.llama_n_vocab(self.ctx)
-
-                # Apply params.logit_bias map
-                for key, value in self.params.logit_bias.items():
-                    logits[key] += value
-
-                _arr = (llama_cpp.llama_token_data * n_vocab)(
-                    *[llama_cpp.llama_token_data(token_id, logits[token_id], 0.0) for token_id in range(n_vocab)]
-                )
-                candidates_p = llama_cpp.ctypes.pointer(llama_cpp.llama_token_data_array(_arr, len(_arr), False))
+                    self.save_session()
 
-                # Apply penalties
-                nl_logit = logits[llama_cpp.llama_token_nl()]
-                last_n_repeat = min(len(self.last_n_tokens), repeat_last_n, self.n_ctx)
-
-                _arr = (llama_cpp.llama_token * last_n_repeat)(
-                    *self.last_n_tokens[len(self.last_n_tokens) - last_n_repeat :]
-                )
-                llama_cpp.llama_sample_repetition_penalty(
-                    self.ctx, candidates_p, _arr, last_n_repeat, llama_cpp.c_float(self.params.repeat_penalty)
-                )
-                llama_cpp.llama_sample_frequency_and_presence_penalties(
-                    self.ctx,
-                    candidates_p,
-                    _arr,
-                    last_n_repeat,
-                    llama_cpp.c_float(self.params.frequency_penalty),
-                    llama_cpp.c_float(self.params.presence_penalty),
-                )
-
-                if not self.params.penalize_nl:
-                    logits[llama_cpp.llama_token_nl()] = nl_logit
-
-                if self.params.temp <= 0:
-                    # Greedy sampling
-                    id = llama_cpp.llama_sample_token_greedy(self.ctx, candidates_p)
+                if self.timed:
+                    _start = perf_counter()
+                    id = self._sample()
+                    self.t_sample += perf_counter() - _start
                 else:
-                    if self.params.mirostat == 1:
-                        mirostat_mu = 2.0 * self.params.mirostat_tau
-                        mirostat_m = 100
-                        llama_cpp.llama_sample_temperature(self.ctx, candidates_p, llama_cpp.c_float(self.params.temp))
-                        id = llama_cpp.llama_sample_token_mirostat(
-                            self.ctx,
-                            candidates_p,
-                            llama_cpp.c_float(self.params.mirostat_tau),
-                            llama_cpp.c_float(self.params.mirostat_eta),
-                            llama_cpp.c_int(mirostat_m),
-                            llama_cpp.c_float(mirostat_mu),
-                        )
-                    elif self.params.mirostat == 2:
-                        mirostat_mu = 2.0 * self.params.mirostat_tau
-                        llama_cpp.llama_sample_temperature(self.ctx, candidates_p, llama_cpp.c_float(self.params.temp))
-                        id = llama_cpp.llama_sample_token_mirostat_v2(
-                            self.ctx,
-                            candidates_p,
-                            llama_cpp.c_float(self.params.mirostat_tau),
-                            llama_cpp.c_float(self.params.mirostat_eta),
-                            llama_cpp.c_float(mirostat_mu),
-                        )
-                    else:
-                        # Temperature sampling
-                        llama_cpp.llama_sample_top_k(self.ctx, candidates_p, top_k, min_keep=llama_cpp.c_size_t(1))
-                        llama_cpp.llama_sample_tail_free(
-                            self.ctx, candidates_p, llama_cpp.c_float(self.params.tfs_z), min_keep=llama_cpp.c_size_t(1)
-                        )
-                        llama_cpp.llama_sample_typical(
-                            self.ctx,
-                            candidates_p,
-                            llama_cpp.c_float(self.params.typical_p),
-                            min_keep=llama_cpp.c_size_t(1),
-                        )
-                        llama_cpp.llama_sample_top_p(
-                            self.ctx, candidates_p, llama_cpp.c_float(self.params.top_p), min_keep=llama_cpp.c_size_t(1)
-                        )
-                        llama_cpp.llama_sample_temperature(self.ctx, candidates_p, llama_cpp.c_float(self.params.temp))
-                        id = llama_cpp.llama_sample_token(self.ctx, candidates_p)
-                # print("`{}`".format(candidates_p.size))
-
-                self.last_n_tokens.pop(0)
-                self.last_n_tokens.append(id)
+                    id = self._sample()
+
+                self._push_last(id)
 
                 # replace end of text token with newline token when in interactive mode
                 if id == llama_cpp.llama_token_eos() and self.params.interactive and not self.params.instruct:
@@ -471,6 +619,7 @@ n_keep = {self.params.n_keep}
 
                 # decrement remaining sampling budget
                 self.remaining_tokens -= 1
+                self.n_sampled += 1
             else:
                 # output to console if input echo is on
                 self.output_echo = self.params.input_echo
@@ -478,8 +627,7 @@ n_keep = {self.params.n_keep}
                 # some user input remains from prompt or interaction, forward it to processing
                 while len(self.embd_inp) > self.input_consumed:
                     self.embd.append(self.embd_inp[self.input_consumed])
-                    self.last_n_tokens.pop(0)
-                    self.last_n_tokens.append(self.embd_inp[self.input_consumed])
+                    self._push_last(self.embd_inp[self.input_consumed])
                     self.input_consumed += 1
                     if len(self.embd) >= self.params.n_batch:
                         break
@@ -500,7 +648,7 @@ n_keep = {self.params.n_keep}
             if self.params.interactive and len(self.embd_inp) <= self.input_consumed:
                 # if antiprompt is present, stop
                 if self.use_antiprompt():
-                    if True in [i == self.last_n_tokens[-len(i) :] for i in self.first_antiprompt]:
+                    if self.antiprompt_matcher.match is not None:
                         break
 
                 # if we are using instruction mode, and we have processed the initial prompt
@@ -533,16 +681,18 @@ n_keep = {self.params.n_keep}
 
     def exit(self):
         llama_cpp.llama_free(self.ctx)
+        self.state_buf = None
+        if self.draft is not None:
+            self.draft.exit()
         self.set_color(util.CONSOLE_COLOR_DEFAULT)
 
     # return past text
     def past(self):
-        for id in self.last_n_tokens[-self.n_past :]:
-            yield llama_cpp.llama_token_to_str(self.ctx, id).decode("utf8", errors="ignore")
+        yield self.vocab.detokenize(self.last_n_tokens[-self.n_past :]).decode("utf8", errors="ignore")
 
     # write input
     def input(self, prompt: str):
-        if self.params.instruct and self.last_n_tokens[-len(self.inp_prefix) :] != self.inp_prefix:
+        if self.params.instruct and not self.last_n_tokens.endswith(self.inp_prefix):
             self.embd_inp += self.inp_prefix
         self.embd_inp += self._tokenize(prompt)
         if self.params.instruct:
@@ -551,30 +701,17 @@ n_keep = {self.params.n_keep}
     # write output
     def output(self):
         self.remaining_tokens = self.params.n_predict
+        decode = self.utf8_decoder.decode
+        pieces = self.vocab.pieces
         for id in self.generate():
-            cur_char = llama_cpp.llama_token_to_str(self.ctx, id)
-
-            # Add remainder of missing bytes
-            if None in self.multibyte_fix:
-                self.multibyte_fix[self.multibyte_fix.index(None)] = cur_char
-
-            # Return completed utf char
-            if len(self.multibyte_fix) > 0 and None not in self.multibyte_fix:
-                yield (b"".join(self.multibyte_fix)).decode("utf8")
-                self.multibyte_fix = []
-                continue
-
-            # Contains multi-byte UTF8
-            for num, pattern in [(2, 192), (3, 224), (4, 240)]:
-                # Bitwise AND check
-                if pattern & int.from_bytes(cur_char, 'little') == pattern:
-                    self.multibyte_fix = [cur_char] + ([None] * (num - 1))
-
-            # Stop incomplete bytes from passing
-            if len(self.multibyte_fix) > 0:
-                continue
-
-            yield cur_char.decode("utf8")
+            if self.timed:
+                _start = perf_counter()
+                text = decode(pieces[id])
+                self.t_detokenize += perf_counter() - _start
+            else:
+                text = decode(pieces[id])
+            if text:
+                yield text
 
     # read user input
     def read_input(self):
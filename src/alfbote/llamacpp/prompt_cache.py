@@ -0,0 +1,152 @@
+"""
+Managed llama session files for the prompt prefix, reused across restarts.
+
+Entries are keyed on the model file hash, the prompt text and the context parameters that affect the KV state.
+A prompt whose end changes between runs (e.g. it has the time in it) is keyed on the part before that, and
+LLaMAInteract evaluates the rest after restoring the matching prefix.
+Each entry is a <key>.session file written by llama_save_session_file plus a <key>.json with its metadata.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from .common import GptParams
+
+
+class PromptCache:
+    VERSION = 1
+
+    def __init__(self, cache_dir: Path | str, max_entries: int = 4):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.index_file = self.dir / "models.json"
+
+    # sha256 of the model file, remembered per (size, mtime) so it is only computed when the file changes
+    def model_hash(self, model: str) -> str:
+        model = str(Path(model).resolve())
+        stat = os.stat(model)
+        index = self._read_json(self.index_file) or {}
+        entry = index.get(model)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+
+        print(f"PromptCache: hashing model file '{model}'", file=sys.stderr)
+        h = hashlib.sha256()
+        with open(model, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        index[model] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": h.hexdigest()}
+        self._write_json(self.index_file, index)
+        return h.hexdigest()
+
+    # Everything except the prompt that has to match for a saved KV state to be usable
+    def context(self, params: GptParams) -> dict:
+        return {
+            "version": PromptCache.VERSION,
+            "model": self.model_hash(params.model),
+            "n_ctx": params.n_ctx,
+            "memory_f16": params.memory_f16,
+            "lora_adapter": params.lora_adapter,
+            "lora_base": params.lora_base,
+        }
+
+    # static_prompt is the start of params.prompt that stays the same between runs, the whole prompt if None
+    def key(self, params: GptParams, static_prompt: str | None = None) -> str:
+        return self._key(self.context(params), params.prompt if static_prompt is None else static_prompt)
+
+    # Path to use as params.path_session for this prompt.
+    # On a miss, the newest entry with the same model and context is taken over, so LLaMAInteract
+    # reuses whatever prefix of it still matches and saves the result under the new key.
+    def session_path(self, params: GptParams, static_prompt: str | None = None) -> str:
+        if static_prompt is not None and not params.prompt.startswith(static_prompt):
+            raise ValueError("static_prompt has to be the start of the prompt")
+        self.evict_stale()
+
+        context = self.context(params)
+        key = self.key(params, static_prompt)
+        path = self._session_file(key)
+        if path.exists():
+            print(f"PromptCache: hit {key[:12]}", file=sys.stderr)
+        else:
+            # an entry's session file only exists once its prompt was evaluated
+            compatible = [
+                e
+                for e in self.entries()
+                if e["context"] == context and e["key"] != key and self._session_file(e["key"]).exists()
+            ]
+            if compatible:
+                newest = max(compatible, key=lambda e: e["last_used"])
+                print(f"PromptCache: miss {key[:12]}, reusing prefix of {newest['key'][:12]}", file=sys.stderr)
+                os.replace(self._session_file(newest["key"]), path)
+                self.evict(newest["key"])
+            else:
+                print(f"PromptCache: miss {key[:12]}", file=sys.stderr)
+
+        now = time.time()
+        meta = self._read_json(self._meta_file(key)) or {"created": now}
+        meta.update(key=key, model_path=str(Path(params.model).resolve()), context=context, last_used=now)
+        self._write_json(self._meta_file(key), meta)
+
+        self.evict_lru()
+        return str(path)
+
+    def entries(self) -> list[dict]:
+        entries = []
+        for meta_file in self.dir.glob("*.json"):
+            if meta_file != self.index_file and (meta := self._read_json(meta_file)) is not None:
+                entries.append(meta)
+        return entries
+
+    def evict(self, key: str):
+        for file in (self._session_file(key), self._meta_file(key)):
+            file.unlink(missing_ok=True)
+
+    # Drop entries whose model file is gone or changed, or that were written by another cache version
+    def evict_stale(self):
+        hashes = {}
+        for entry in self.entries():
+            model = entry.get("model_path", "")
+            if model not in hashes:
+                hashes[model] = self.model_hash(model) if os.path.exists(model) else None
+            context = entry.get("context", {})
+            if context.get("version") != PromptCache.VERSION or context.get("model") != hashes[model]:
+                print(f"PromptCache: evicting stale {entry.get('key', '?')[:12]}", file=sys.stderr)
+                self.evict(entry["key"])
+
+        # session files left without metadata
+        for session_file in self.dir.glob("*.session"):
+            if not self._meta_file(session_file.stem).exists():
+                session_file.unlink(missing_ok=True)
+
+    def evict_lru(self):
+        entries = sorted(self.entries(), key=lambda e: e["last_used"], reverse=True)
+        for entry in entries[self.max_entries :]:
+            self.evict(entry["key"])
+
+    def _key(self, context: dict, prompt: str) -> str:
+        return hashlib.sha256(json.dumps({**context, "prompt": prompt}, sort_keys=True).encode("utf8")).hexdigest()
+
+    def _session_file(self, key: str) -> Path:
+        return self.dir / f"{key}.session"
+
+    def _meta_file(self, key: str) -> Path:
+        return self.dir / f"{key}.json"
+
+    @staticmethod
+    def _read_json(file: Path) -> dict | None:
+        try:
+            with open(file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(file: Path, data: dict):
+        tmp = file.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, file)
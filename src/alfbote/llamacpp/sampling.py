@@ -0,0 +1,148 @@
+import ctypes
+from typing import Callable
+
+import numpy as np
+
+import llama_cpp
+from .common import GptParams
+
+
+# Preallocated llama_token_data buffer that is refilled every sample.
+# llama_sample_* sorts and truncates the candidates in place, so the buffer is rewritten each time,
+# but with NumPy over the shared memory instead of building n_vocab Python objects per token.
+class CandidateBuffer:
+    def __init__(self, n_vocab: int, logit_bias: dict[int, float] | None = None):
+        self.n_vocab = n_vocab
+        self.data = (llama_cpp.llama_token_data * n_vocab)()
+        self.array = llama_cpp.llama_token_data_array(self.data, n_vocab, False)
+        self.pointer = ctypes.pointer(self.array)
+
+        # Structured view over self.data: fields "id", "logit" and "p"
+        self.view = np.ctypeslib.as_array(self.data)
+        self.token_ids = np.arange(n_vocab, dtype=self.view.dtype["id"])
+        self.set_logit_bias(logit_bias or {})
+
+    def set_logit_bias(self, logit_bias: dict[int, float]):
+        self.bias_ids = np.fromiter(logit_bias.keys(), dtype=np.intp, count=len(logit_bias))
+        self.bias_values = np.fromiter(logit_bias.values(), dtype=np.float32, count=len(logit_bias))
+
+    # Fill the first len(ids) candidates, already ordered by descending logit when is_sorted
+    def set(self, ids: np.ndarray, logits: np.ndarray, is_sorted: bool = False):
+        n = len(ids)
+        self.view["id"][:n] = ids
+        self.view["logit"][:n] = logits
+        self.view["p"][:n] = 0.0
+        self.array.size = n
+        self.array.sorted = is_sorted
+        return self.pointer
+
+
+# The sampling chain of llama.cpp's main example, built once from GptParams.
+# Stages that are no-ops for the parameters (tfs_z = 1, typical_p = 1, top_p = 1, temp = 1, penalties of 1 or 0)
+# are left out, and the penalties and top-k are done in NumPy over the logits in one pass,
+# so the llama_sample_* calls that are left only see top_k candidates instead of the whole vocabulary.
+# Picks the same tokens as the chain for the same rng state.
+class SamplerPipeline:
+    def __init__(self, params: GptParams, n_vocab: int, n_ctx: int):
+        self.params = params
+        self.n_vocab = n_vocab
+        self.candidates = CandidateBuffer(n_vocab, params.logit_bias)
+        self.logits = np.empty(n_vocab, dtype=np.float32)
+        self.last_n = n_ctx if params.repeat_last_n < 0 else min(params.repeat_last_n, n_ctx)
+        self.nl = None if params.penalize_nl else llama_cpp.llama_token_nl()
+
+        self.repeat_penalty = np.float32(params.repeat_penalty) if params.repeat_penalty != 1.0 else None
+        self.alpha_frequency = np.float32(params.frequency_penalty)
+        self.alpha_presence = np.float32(params.presence_penalty)
+        self.frequency = params.frequency_penalty != 0.0 or params.presence_penalty != 0.0
+
+        # after the penalties: greedy, top-k then the stages, or the whole vocabulary for mirostat
+        self.greedy = params.temp <= 0
+        self.top_k = None
+        self.stages: list[Callable] = []
+        # mirostat's target surprise, adjusted after every token and carried over to the next like in llama.cpp
+        self.mirostat_mu = llama_cpp.c_float(2.0 * params.mirostat_tau)
+        self.mirostat_mu_p = ctypes.pointer(self.mirostat_mu)
+        min_keep = llama_cpp.c_size_t(1)
+        if self.greedy:
+            pass
+        elif params.mirostat == 1:
+            self.stages.append(self._temperature)
+            self.pick = self._mirostat
+        elif params.mirostat == 2:
+            self.stages.append(self._temperature)
+            self.pick = self._mirostat_v2
+        else:
+            self.top_k = n_vocab if params.top_k <= 0 else min(params.top_k, n_vocab)
+            if params.tfs_z < 1.0:
+                tfs_z = llama_cpp.c_float(params.tfs_z)
+                self.stages.append(lambda ctx, p: llama_cpp.llama_sample_tail_free(ctx, p, tfs_z, min_keep=min_keep))
+            if params.typical_p < 1.0:
+                typical_p = llama_cpp.c_float(params.typical_p)
+                self.stages.append(lambda ctx, p: llama_cpp.llama_sample_typical(ctx, p, typical_p, min_keep=min_keep))
+            if params.top_p < 1.0:
+                top_p = llama_cpp.c_float(params.top_p)
+                self.stages.append(lambda ctx, p: llama_cpp.llama_sample_top_p(ctx, p, top_p, min_keep=min_keep))
+            if params.temp != 1.0:
+                self.stages.append(self._temperature)
+            self.pick = llama_cpp.llama_sample_token
+
+    # Sample from logits_ptr, penalizing the tokens in last (the last_n newest tokens)
+    def __call__(self, ctx, logits_ptr, last: np.ndarray) -> int:
+        logits = self.penalized(logits_ptr, last)
+        if self.greedy:
+            return int(np.argmax(logits))
+
+        if self.top_k is None:
+            candidates_p = self.candidates.set(self.candidates.token_ids, logits)
+        else:
+            k = self.top_k
+            top = np.argpartition(-logits, k - 1)[:k] if k < self.n_vocab else self.candidates.token_ids
+            top = top[np.argsort(-logits[top], kind="stable")]
+            candidates_p = self.candidates.set(top, logits[top], is_sorted=True)
+        for stage in self.stages:
+            stage(ctx, candidates_p)
+        return self.pick(ctx, candidates_p)
+
+    # Logits with the logit bias and the repetition, frequency and presence penalties
+    def penalized(self, logits_ptr, last: np.ndarray) -> np.ndarray:
+        logits = self.logits
+        logits[:] = np.ctypeslib.as_array(logits_ptr, shape=(self.n_vocab,))
+        candidates = self.candidates
+        if len(candidates.bias_ids) > 0:
+            logits[candidates.bias_ids] += candidates.bias_values
+        if len(last) == 0 or (self.repeat_penalty is None and not self.frequency):
+            return logits
+
+        nl_logit = logits[self.nl] if self.nl is not None else None
+        ids, counts = np.unique(last, return_counts=True)
+        if self.repeat_penalty is not None:
+            hit = logits[ids]
+            logits[ids] = np.where(hit <= 0, hit * self.repeat_penalty, hit / self.repeat_penalty)
+        if self.frequency:
+            logits[ids] -= counts.astype(np.float32) * self.alpha_frequency + self.alpha_presence
+        if nl_logit is not None:
+            logits[self.nl] = nl_logit
+        return logits
+
+    def _temperature(self, ctx, candidates_p):
+        llama_cpp.llama_sample_temperature(ctx, candidates_p, llama_cpp.c_float(self.params.temp))
+
+    def _mirostat(self, ctx, candidates_p) -> int:
+        return llama_cpp.llama_sample_token_mirostat(
+            ctx,
+            candidates_p,
+            llama_cpp.c_float(self.params.mirostat_tau),
+            llama_cpp.c_float(self.params.mirostat_eta),
+            llama_cpp.c_int(100),
+            self.mirostat_mu_p,
+        )
+
+    def _mirostat_v2(self, ctx, candidates_p) -> int:
+        return llama_cpp.llama_sample_token_mirostat_v2(
+            ctx,
+            candidates_p,
+            llama_cpp.c_float(self.params.mirostat_tau),
+            llama_cpp.c_float(self.params.mirostat_eta),
+            self.mirostat_mu_p,
+        )
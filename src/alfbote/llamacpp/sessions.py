@@ -0,0 +1,111 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from .low_level_api_chat_cpp import LLaMAInteract, LLaMAState
+
+
+# Inactive conversations of one or more contexts of the same model.
+# Snapshots are evicted least recently used first once they don't fit in budget_bytes.
+# Contexts sharing a store hand conversations to each other, so a conversation can continue on any of them.
+class SessionStore:
+    def __init__(self, budget_bytes: int = 2048 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.snapshots: OrderedDict[Hashable, LLaMAState] = OrderedDict()
+        self.managers: list["SessionManager"] = []
+        self.lock = threading.RLock()
+        self.n_evictions = 0
+        self.n_migrations = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(state.nbytes for state in self.snapshots.values())
+
+    def evict(self):
+        while self.snapshots and self.nbytes > self.budget_bytes:
+            key, _ = self.snapshots.popitem(last=False)
+            self.n_evictions += 1
+            print(f"SessionManager: evicted conversation {key}", file=sys.stderr)
+
+    # Take key's state out of the snapshots or out of the context that has it active
+    def take(self, key: Hashable, taker: "SessionManager") -> LLaMAState | None:
+        state = self.snapshots.pop(key, None)
+        if state is not None:
+            return state
+        for manager in self.managers:
+            # A context only switches conversation in activate (under the lock), and a conversation is never
+            # generated on two contexts at once, so the one holding key is idle and safe to copy
+            if manager is not taker and manager.active == key:
+                manager.active = None
+                self.n_migrations += 1
+                return manager.model.get_state()
+        return None
+
+
+# Many conversations sharing one LLaMAInteract.
+# The active conversation lives in the llama context, the others are kept as snapshots in the store.
+# A new (or evicted) conversation starts from the prompt state taken when the manager was created.
+class SessionManager:
+    def __init__(
+        self, model: LLaMAInteract, budget_bytes: int = 2048 * 1024 * 1024, store: SessionStore | None = None
+    ):
+        self.model = model
+        self.store = store if store is not None else SessionStore(budget_bytes)
+        self.base: LLaMAState = model.get_state()
+        self.active: Hashable | None = None
+        with self.store.lock:
+            self.store.managers.append(self)
+
+        self.n_restores = 0
+        self.n_prompt_restores = 0
+
+    @property
+    def snapshots(self) -> OrderedDict[Hashable, LLaMAState]:
+        return self.store.snapshots
+
+    @property
+    def nbytes(self) -> int:
+        return self.store.nbytes
+
+    # Make key the conversation in the llama context
+    def activate(self, key: Hashable):
+        with self.store.lock:
+            if key == self.active:
+                return
+
+            prompt_intact = self._prompt_intact()
+            if self.active is not None:
+                self.store.snapshots[self.active] = self.model.get_state()
+
+            state = self.store.take(key, self)
+            if state is None:
+                self.model.set_state(self.base, kv=not prompt_intact)
+                self.n_prompt_restores += 1
+            else:
+                self.model.set_state(state)
+                self.n_restores += 1
+            self.active = key
+            self.store.evict()
+
+    # Before the context is freed: its conversation goes to the snapshots, where any other context on the store
+    # (e.g. one loaded again with other settings) picks it up, and the store forgets this manager
+    def close(self):
+        with self.store.lock:
+            if self.active is not None:
+                self.store.snapshots[self.active] = self.model.get_state()
+                self.active = None
+            self.store.managers.remove(self)
+            self.store.evict()
+
+    # Forget a conversation, the next activate starts it from the prompt again
+    def reset(self, key: Hashable):
+        with self.store.lock:
+            self.store.snapshots.pop(key, None)
+            if key == self.active:
+                self.model.set_state(self.base, kv=not self._prompt_intact())
+
+    # The prompt is still at the start of the KV cache unless the conversation in the context swapped context
+    # without pinning all of it (n_keep)
+    def _prompt_intact(self) -> bool:
+        return self.model.n_context_swaps == 0 or self.model.params.n_keep >= self.base.n_past
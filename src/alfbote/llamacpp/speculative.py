@@ -0,0 +1,75 @@
+import numpy as np
+
+import llama_cpp
+from .common import GptParams
+
+
+# Small model with the same vocabulary that guesses how the main model continues (params.model_draft).
+# It keeps its KV cache in step with whatever token history it is asked to continue, re-evaluating only
+# from where that history differs from the last one.
+class DraftModel:
+    def __init__(self, params: GptParams, n_vocab: int, model: "llama_cpp.llama_model_p | None" = None):
+        self.params = params
+        self.lparams = llama_cpp.llama_context_default_params()
+        self.lparams.n_ctx = params.n_ctx
+        self.lparams.seed = params.seed
+        self.lparams.use_mmap = params.use_mmap
+        self.lparams.n_gpu_layers = params.n_gpu_layers
+
+        # weights can be shared between the drafts of a pool like the main model's
+        if model is None and hasattr(llama_cpp, "llama_load_model_from_file"):
+            model = llama_cpp.llama_load_model_from_file(params.model_draft.encode("utf8"), self.lparams)
+            if not model:
+                raise RuntimeError(f"error: failed to load draft model '{params.model_draft}'")
+        self.model = model
+
+        if self.model is not None:
+            self.ctx = llama_cpp.llama_new_context_with_model(self.model, self.lparams)
+        else:
+            self.ctx = llama_cpp.llama_init_from_file(params.model_draft.encode("utf8"), self.lparams)
+        if not self.ctx:
+            raise RuntimeError(f"error: failed to load draft model '{params.model_draft}'")
+        if llama_cpp.llama_n_vocab(self.ctx) != n_vocab:
+            raise RuntimeError(f"error: draft model '{params.model_draft}' has a different vocabulary")
+
+        self.n_vocab = n_vocab
+        self.tokens: list[int] = []  # in the draft's KV cache
+        self.n_eval_tokens = 0
+
+    def _eval(self, tokens: list[int]):
+        n_batch = max(self.params.n_batch, 1)
+        for i in range(0, len(tokens), n_batch):
+            chunk = tokens[i : i + n_batch]
+            _arr = (llama_cpp.llama_token * len(chunk))(*chunk)
+            if llama_cpp.llama_eval(self.ctx, _arr, len(chunk), len(self.tokens), self.params.n_threads) != 0:
+                raise Exception("Failed to llama_eval the draft model!")
+            self.tokens.extend(chunk)
+            self.n_eval_tokens += len(chunk)
+
+    # Greedily guess the k tokens following history, with the main model's repetition penalty
+    def propose(self, history: list[int], k: int) -> list[int]:
+        n_common = 0
+        n_max = min(len(self.tokens), len(history) - 1)  # the last token is evaluated again for its logits
+        if n_max > 0:
+            differs = np.flatnonzero(np.asarray(self.tokens[:n_max]) != np.asarray(history[:n_max]))
+            n_common = int(differs[0]) if len(differs) > 0 else n_max
+        del self.tokens[n_common:]
+        self._eval(history[n_common:])
+
+        penalty = self.params.repeat_penalty
+        n_recent = min(len(history), self.params.repeat_last_n if self.params.repeat_last_n >= 0 else len(history))
+        recent = history[len(history) - n_recent :]
+        drafted: list[int] = []
+        for i in range(k):
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(self.ctx), shape=(self.n_vocab,)).copy()
+            if penalty != 1.0 and n_recent > 0:
+                ids = np.unique(recent + drafted)
+                logits[ids] = np.where(logits[ids] <= 0, logits[ids] * penalty, logits[ids] / penalty)
+            id = int(np.argmax(logits))
+            drafted.append(id)
+            if i < k - 1:
+                self._eval([id])
+        return drafted
+
+    def exit(self):
+        llama_cpp.llama_free(self.ctx)
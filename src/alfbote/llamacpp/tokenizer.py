@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+import llama_cpp
+
+
+# llama_tokenize with an LRU cache keyed on (text, bos) and one growable token buffer per context.
+# Antiprompts, newline and instruct markers are tokenized over and over, so most calls are cache hits.
+# Texts longer than max_text_len are tokenized but not cached.
+class Tokenizer:
+    def __init__(self, ctx: llama_cpp.llama_context_p, max_entries: int = 256, max_text_len: int = 1024):
+        self.ctx = ctx
+        self.max_entries = max_entries
+        self.max_text_len = max_text_len
+        self.cache: OrderedDict[tuple[str, bool], tuple[int, ...]] = OrderedDict()
+        self.buffer = (llama_cpp.llama_token * 256)()
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __call__(self, text: str, bos: bool = True) -> list[int]:
+        return list(self._lookup(text, bos))
+
+    # Tokenize many strings in one pass: the buffer is sized once for the longest, and a text that repeats in
+    # the batch is looked up (or tokenized) once
+    def tokenize_batch(self, texts: list[str], bos: bool = True) -> list[list[int]]:
+        self._reserve(max((len(text.encode("utf8", errors="ignore")) + 2 for text in texts), default=0))
+        found: dict[str, tuple[int, ...]] = {}
+        for text in texts:
+            if text not in found:
+                found[text] = self._lookup(text, bos)
+        return [list(found[text]) for text in texts]
+
+    def _lookup(self, text: str, bos: bool) -> tuple[int, ...]:
+        key = (text, bos)
+        tokens = self.cache.get(key)
+        if tokens is not None:
+            self.cache.move_to_end(key)
+            self.n_hits += 1
+            return tokens
+
+        self.n_misses += 1
+        tokens = tuple(self._tokenize(text, bos))
+        if len(text) <= self.max_text_len:
+            self.cache[key] = tokens
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return tokens
+
+    def _reserve(self, n_tokens: int):
+        if n_tokens > len(self.buffer):
+            self.buffer = (llama_cpp.llama_token * max(n_tokens, 2 * len(self.buffer)))()
+
+    def _tokenize(self, text: str, bos: bool) -> list[int]:
+        data = text.encode("utf8", errors="ignore")
+        # Every token covers at least one byte, plus bos and the leading space sentencepiece adds
+        self._reserve(len(data) + 2)
+        n = llama_cpp.llama_tokenize(self.ctx, data, self.buffer, len(self.buffer), bos)
+        if n < 0:
+            self._reserve(-n)
+            n = llama_cpp.llama_tokenize(self.ctx, data, self.buffer, len(self.buffer), bos)
+        return self.buffer[:n]
@@ -1,3 +1,7 @@
+from collections import deque
+
+import numpy as np
+
 ANSI_COLOR_RESET = "\x1b[0m"
 ANSI_COLOR_YELLOW = "\x1b[33m"
 ANSI_BOLD = "\x1b[1m"
@@ -8,86 +12,172 @@ CONSOLE_COLOR_PROMPT = ANSI_COLOR_YELLOW
 CONSOLE_COLOR_USER_INPUT = ANSI_BOLD + ANSI_COLOR_GREEN
 
 
+# Streaming Aho-Corasick matcher over any hashable symbols (token ids or characters)
+# push() is O(1) amortized per symbol no matter how many patterns there are.
+# After each push, match is the index of a pattern the stream now ends with, or None.
+class StopMatcher:
+    def __init__(self, patterns):
+        self.patterns = [list(p) for p in patterns]
+        self.goto: list[dict] = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.out = [None]
+
+        # trie
+        for n, pattern in enumerate(self.patterns):
+            if len(pattern) == 0:
+                continue
+            state = 0
+            for symbol in pattern:
+                nxt = self.goto[state].get(symbol)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.out.append(None)
+                    self.goto[state][symbol] = nxt
+                state = nxt
+            if self.out[state] is None:
+                self.out[state] = n
+
+        # failure links, breadth first so shallower states are done first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for symbol, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and symbol not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(symbol, 0)
+                if self.out[nxt] is None:
+                    self.out[nxt] = self.out[self.fail[nxt]]
+
+        self.state = 0
+        self.match = None
+
+    def push(self, symbol) -> int | None:
+        state = self.state
+        while state and symbol not in self.goto[state]:
+            state = self.fail[state]
+        self.state = self.goto[state].get(symbol, 0)
+        self.match = self.out[self.state]
+        return self.match
+
+    # Length of the longest stream suffix that could still become a match
+    def partial(self) -> int:
+        return self.depth[self.state]
+
+    def reset(self):
+        self.state = 0
+        self.match = None
+
+
 # Iterative search
-# Actively searches and prevents a pattern from being returned
-class IterSearch:
-    def __init__(self, pattern):
-        self.pattern = list(pattern)
+# Actively searches and prevents any of the patterns from being returned.
+# Symbols that might start a pattern are held back until they either complete it (and are dropped) or can't.
+# With line_start, a pattern only matches at the start of the stream or of a line (after any spaces),
+# so e.g. a speaker tag is dropped but the same word in the middle of a sentence is kept.
+class IterSearch(StopMatcher):
+    def __init__(self, *patterns, line_start: bool = False):
+        self.line_start = line_start
+        if line_start:
+            patterns = [["\n", *pattern] for pattern in patterns]
+        super().__init__(patterns)
         self.buffer = []
+        self._start_line()
+
+    # The stream starts a line, as if it came after a newline
+    def _start_line(self):
+        self.reset()
+        if self.line_start:
+            self.push("\n")
+            self.line_state = self.state
 
     def __call__(self, char):
-        self.buffer += [char]
+        if self.line_start and char == " " and self.state == self.line_state:
+            return [char]
+
+        self.buffer.append(char)
+        match = self.push(char)
+        if match is not None:
+            # the leading newline of a line_start pattern was never held back
+            del self.buffer[len(self.buffer) - len(self.patterns[match]) + self.line_start :]
+            self.reset()
+
+        n_release = len(self.buffer) - max(0, self.partial() - self.line_start)
+        _tmp = self.buffer[:n_release]
+        del self.buffer[:n_release]
+        return _tmp
 
-        if self.pattern[: len(self.buffer)] == self.buffer:
-            if len(self.buffer) >= len(self.pattern):
-                self.buffer.clear()
-            return []
+    # Filter a string one character at a time
+    def feed(self, text: str) -> str:
+        return "".join(c for char in text for c in self(char))
 
-        _tmp = self.buffer[:]
-        self.buffer.clear()
+    # Release whatever is still held back
+    def flush(self):
+        _tmp = self.buffer
+        self.buffer = []
+        self._start_line()
         return _tmp
 
 
+# Fixed size ring buffer backed by an array twice its size.
+# Every element is written at i and i + maxsize, so the newest elements are always contiguous
+# and can be handed to ctypes without copying.
 class Circle:
-    def __init__(self, size, default=0):
-        self.list = [default] * size
+    def __init__(self, size, default=0, dtype=np.intc):
+        self.buffer = np.full(2 * size, default, dtype=dtype)
         self.maxsize = size
         self.size = 0
         self.offset = 0
 
     def append(self, elem):
         if self.size < self.maxsize:
-            self.list[self.size] = elem
+            pos = self.size
             self.size += 1
         else:
-            self.list[self.offset] = elem
+            pos = self.offset
             self.offset = (self.offset + 1) % self.maxsize
+        self.buffer[pos] = elem
+        self.buffer[pos + self.maxsize] = elem
+
+    def extend(self, elems):
+        for elem in elems:
+            self.append(elem)
+
+    def __len__(self):
+        return self.size
+
+    def copy(self) -> "Circle":
+        other = Circle.__new__(Circle)
+        other.buffer = self.buffer.copy()
+        other.maxsize, other.size, other.offset = self.maxsize, self.size, self.offset
+        return other
+
+    # Contiguous view of the elements, oldest first
+    def view(self) -> np.ndarray:
+        return self.buffer[self.offset : self.offset + self.size]
+
+    # Contiguous view of the newest n elements
+    def tail(self, n) -> np.ndarray:
+        return self.view()[self.size - min(n, self.size) :]
+
+    # O(k) check that the newest elements equal pattern
+    def endswith(self, pattern) -> bool:
+        k = len(pattern)
+        if k > self.size:
+            return False
+        return k == 0 or self.buffer[self.offset + self.size - k : self.offset + self.size].tolist() == list(pattern)
 
     def __getitem__(self, val):
         if isinstance(val, int):
             if 0 > val or val >= self.size:
                 raise IndexError('Index out of range')
-            return self.list[val] if self.size < self.maxsize else self.list[(self.offset + val) % self.maxsize]
+            return self.buffer[self.offset + val].item()
         elif isinstance(val, slice):
-            start, stop, step = val.start, val.stop, val.step
-            if step is None:
-                step = 1
-            if start is None:
-                start = 0
-            if stop is None:
-                stop = self.size
-            if start < 0:
-                start = self.size + start
-            if stop < 0:
-                stop = self.size + stop
-
-            indices = range(start, stop, step)
-            return [self.list[(self.offset + i) % self.maxsize] for i in indices if i < self.size]
+            return self.view()[val].tolist()
         else:
             raise TypeError('Invalid argument type')
 
-
-if __name__ == "__main__":
-    c = Circle(5)
-
-    c.append(1)
-    print(c.list)
-    print(c[:])
-    assert c[0] == 1
-    assert c[:5] == [1]
-
-    for i in range(2, 5 + 1):
-        c.append(i)
-    print(c.list)
-    print(c[:])
-    assert c[0] == 1
-    assert c[:5] == [1, 2, 3, 4, 5]
-
-    for i in range(5 + 1, 9 + 1):
-        c.append(i)
-    print(c.list)
-    print(c[:])
-    assert c[0] == 5
-    assert c[:5] == [5, 6, 7, 8, 9]
-    # assert c[:-5] == [5,6,7,8,9]
-    assert c[:10] == [5, 6, 7, 8, 9]
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import llama_cpp
+
+_vocabs: dict[str, "Vocab"] = {}
+
+
+# Token id -> bytes for a whole model, read once through llama_token_to_str.
+# Detokenizing is then a list lookup with no FFI call per token.
+# The table only depends on the model file, so every context of the same model shares one (see for_model).
+class Vocab:
+    def __init__(self, ctx: llama_cpp.llama_context_p):
+        n_vocab = llama_cpp.llama_n_vocab(ctx)
+        self.pieces: list[bytes] = [llama_cpp.llama_token_to_str(ctx, id) for id in range(n_vocab)]
+
+    @classmethod
+    def for_model(cls, ctx: llama_cpp.llama_context_p, model: str) -> "Vocab":
+        key = str(Path(model).resolve())
+        vocab = _vocabs.get(key)
+        if vocab is None or len(vocab) != llama_cpp.llama_n_vocab(ctx):
+            vocab = _vocabs[key] = cls(ctx)
+            print(f"Vocab: {len(vocab)} tokens loaded for '{model}'", file=sys.stderr)
+        return vocab
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __getitem__(self, id: int) -> bytes:
+        return self.pieces[id]
+
+    def detokenize(self, ids) -> bytes:
+        return b"".join(map(self.pieces.__getitem__, ids))
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from time import monotonic
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+REASONS = ("watermark", "idle", "handoff")
+
+
+# When to give the allocator's cached device memory back (torch.cuda.empty_cache).
+# Keeping the cache between images saves the next one from allocating it all again, so it is only emptied
+# - after a batch that left more than watermark of the device in use,
+# - once the pipeline has been idle for idle seconds,
+# - before the device is handed to something else (ChatGen's LLaMA layers).
+# Nothing is reclaimed twice: after a reclaim, only new work makes the cache worth emptying again.
+class ReclaimPolicy:
+    def __init__(self, watermark: float = 0.85, idle: float = 120.0, clock: Callable[[], float] = monotonic):
+        self.watermark = watermark
+        self.idle = idle
+        self.clock = clock
+        self.last_used = clock()
+        self.cached = False  # work since the last reclaim
+        self.n_reclaims = dict.fromkeys(REASONS, 0)
+
+    # After a batch, with the device memory in use and in total. Returns the reason to reclaim, if any.
+    def after_batch(self, used: int, total: int) -> str | None:
+        self.last_used = self.clock()
+        self.cached = True
+        if total > 0 and used > self.watermark * total:
+            return "watermark"
+        return None
+
+    def idle_due(self) -> bool:
+        return self.cached and self.clock() - self.last_used >= self.idle
+
+    # Whether reclaiming for reason is worth it right now
+    def wants(self, reason: str) -> bool:
+        if reason == "idle":
+            return self.idle_due()
+        return self.cached
+
+    def reclaimed(self, reason: str):
+        self.cached = False
+        self.n_reclaims[reason] += 1
+
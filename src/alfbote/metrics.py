@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+from bisect import bisect_left
+from contextlib import nullcontext
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# Upper bounds of the histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (1e-6, 1e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, registry: Registry, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.value = 0.0
+        self.labelnames = labelnames
+        self.children: dict[str, Counter] = {}  # rendered labels -> counter, with labelnames
+
+    # The counter for one combination of labels, e.g. reclaims.labels(reason="idle").inc()
+    def labels(self, **labels) -> Counter:
+        key = ",".join(f'{name}="{labels[name]}"' for name in self.labelnames)
+        if key not in self.children:
+            self.children[key] = Counter(self.registry, self.name, self.help)
+        return self.children[key]
+
+    def inc(self, n: float = 1):
+        if self.registry.enabled:
+            self.value += n
+
+    def render(self) -> list[str]:
+        if self.labelnames:
+            return [f"{self.name}{{{key}}} {_format(child.value)}" for key, child in self.children.items()]
+        return [f"{self.name} {_format(self.value)}"]
+
+    def summary(self) -> str:
+        if self.labelnames:
+            return " ".join(f"{key} {_format(child.value)}" for key, child in self.children.items()) or "-"
+        return _format(self.value)
+
+
+class Histogram:
+    def __init__(self, registry: Registry, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # per bucket, not cumulative, the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    # n observations of value, e.g. the per-token mean of a reply for each of its tokens
+    def observe(self, value: float, n: int = 1):
+        if not self.registry.enabled or n <= 0:
+            return
+        self.counts[bisect_left(self.buckets, value)] += n
+        self.sum += value * n
+        self.count += n
+
+    # Observes the seconds spent in the with block, nothing at all while metrics are disabled
+    def time(self) -> _Timer | nullcontext:
+        return _Timer(self) if self.registry.enabled else _NULL_TIMER
+
+    # Upper bound of the bucket holding the q quantile
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {total}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {_format(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def summary(self) -> str:
+        if self.count == 0:
+            return "-"
+        return (
+            f"n={self.count} mean={self.sum / self.count:.4g} "
+            f"p50<={self.quantile(0.5):g} p95<={self.quantile(0.95):g}"
+        )
+
+
+# Read when the metrics are rendered, e.g. the length of a queue
+class Gauge:
+    def __init__(self, registry: Registry, name: str, help: str, read: Callable[[], float]):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {_format(self.read())}"]
+
+    def summary(self) -> str:
+        return _format(self.read())
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+_NULL_TIMER = nullcontext()
+
+
+# Counters and histograms for the bot, in the Prometheus text format.
+# Disabled (the default), observing is a single attribute check and timers are a shared no-op,
+# so the instrumented code paths cost about nothing.
+# Values are only observed from the event loop, the model threads keep their own totals (see Llama2.counters).
+class Registry:
+    TYPES = {Counter: "counter", Histogram: "histogram", Gauge: "gauge"}
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics: dict[str, Counter | Histogram | Gauge] = {}
+        self.server: asyncio.AbstractServer | None = None
+
+    def _add(self, cls, name: str, *args):
+        # Declaring a metric again returns the existing one, modules declare theirs at import
+        if name not in self.metrics:
+            self.metrics[name] = cls(self, name, *args)
+        return self.metrics[name]
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram, name, help, buckets)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        gauge = self._add(Gauge, name, help, read)
+        gauge.read = read  # the latest owner, e.g. a reloaded cog
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {self.TYPES[type(metric)]}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # One line per metric, for the stats command
+    def summary(self) -> str:
+        return "\n".join(f"{metric.name}: {metric.summary()}" for metric in self.metrics.values())
+
+    # The summary as a Discord message, cut to fit in one
+    def stats_message(self, max_len: int = 1900) -> str:
+        summary = self.summary()
+        if len(summary) > max_len:
+            summary = summary[:max_len] + "\n..."
+        return f"```\n{summary}\n```"
+
+    # Prometheus endpoint, every GET gets the metrics
+    async def serve(self, port: int, host: str = "127.0.0.1"):
+        if self.server is not None:
+            return
+        self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            if request.startswith(b"GET "):
+                body = self.render().encode()
+                status = "200 OK"
+            else:
+                body = b""
+                status = "405 Method Not Allowed"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Registry()
+
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from alfbote.inference import InferenceWorker
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Callable, Hashable
+    from typing import Any
+
+
+@dataclass(eq=False)
+class PoolSlot:
+    model: Any
+    worker: InferenceWorker
+    busy: bool = False
+    last_used: float = 0.0
+    n_requests: int = 0
+    n_tokens: int = 0
+    busy_time: float = 0.0
+
+
+# Several models (e.g. Llama2 contexts over shared weights), each driven by its own inference thread.
+# A request takes whichever slot is free, preferring the one whose affinity matches its key
+# (the conversation already loaded in that context).
+class ModelPool:
+    def __init__(self, models: list, name: str = "pool", affinity: Callable[[Any], Hashable] | None = None):
+        self.slots = [PoolSlot(model, InferenceWorker(name=f"{name}-{i}")) for i, model in enumerate(models)]
+        self.affinity = affinity
+        self.free = asyncio.Condition()
+        self.started: float | None = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable | None = None) -> AsyncIterator[PoolSlot]:
+        async with self.free:
+            await self.free.wait_for(lambda: any(not slot.busy for slot in self.slots))
+            slot = self._pick(key)
+            slot.busy = True
+
+        start = perf_counter()
+        if self.started is None:
+            self.started = start
+        try:
+            yield slot
+        finally:
+            slot.last_used = perf_counter()
+            slot.busy_time += slot.last_used - start
+            slot.n_requests += 1
+            async with self.free:
+                slot.busy = False
+                self.free.notify()
+
+    # Stops the inference threads, the models are the owner's to free afterwards
+    def close(self):
+        for slot in self.slots:
+            slot.worker.close()
+        for slot in self.slots:
+            slot.worker.thread.join()
+
+    def stats(self) -> dict:
+        elapsed = perf_counter() - self.started if self.started is not None else 0.0
+        n_tokens = sum(slot.n_tokens for slot in self.slots)
+        return {
+            "size": len(self.slots),
+            "busy": sum(slot.busy for slot in self.slots),
+            "requests": sum(slot.n_requests for slot in self.slots),
+            "tokens": n_tokens,
+            "tokens_per_sec": n_tokens / elapsed if elapsed > 0 else 0.0,
+            "utilization": sum(slot.busy_time for slot in self.slots) / (elapsed * len(self.slots)) if elapsed else 0.0,
+        }
+
+    # Free slot with the same affinity, otherwise the one idle the longest
+    def _pick(self, key: Hashable | None) -> PoolSlot:
+        free = [slot for slot in self.slots if not slot.busy]
+        if key is not None and self.affinity is not None:
+            for slot in free:
+                if self.affinity(slot.model) == key:
+                    return slot
+        return min(free, key=lambda slot: slot.last_used)
+
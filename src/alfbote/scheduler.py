@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Hashable
+    from typing import Any
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+@dataclass(eq=False)
+class Job:
+    user: Hashable
+    run: Callable[[], Awaitable[Any]]
+    on_position: Callable[[int], Awaitable[None]] | None = None
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+    task: asyncio.Task | None = None
+    position: int = 0
+    submitted: float = field(default_factory=perf_counter)
+    started: float | None = None
+    finished: float | None = None
+
+    # Wait for the job, returns None if it was cancelled
+    async def result(self) -> Any | None:
+        await asyncio.wait({self.future})
+        if self.future.cancelled():
+            return None
+        return self.future.result()
+
+
+# Bounded asyncio job queue with round-robin fairness between users.
+# Each user gets at most max_per_user queued jobs, and at most concurrency jobs run at once,
+# never two of the same user (their jobs share a conversation).
+class RequestScheduler:
+    def __init__(self, max_depth: int = 8, max_per_user: int = 2, concurrency: int = 1):
+        self.max_depth = max_depth
+        self.max_per_user = max_per_user
+        self.concurrency = concurrency
+        self.queues: OrderedDict[Hashable, deque[Job]] = OrderedDict()
+        self.running: set[Job] = set()
+        self.workers: list[asyncio.Task] = []
+        self.wakeup = asyncio.Event()
+        self._callbacks: set[asyncio.Task] = set()
+
+        self.n_rejected = 0
+        self.n_cancelled = 0
+        self.finished: deque[Job] = deque(maxlen=1000)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    # Queue a job, returns None if the queue (or the user's share of it) is full
+    def submit(
+        self, user: Hashable, run: Callable[[], Awaitable[Any]], on_position: Callable[[int], Awaitable[None]] = None
+    ) -> Job | None:
+        if len(self) >= self.max_depth or len(self.queues.get(user, ())) >= self.max_per_user:
+            self.n_rejected += 1
+            return None
+
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+        job = Job(user=user, run=run, on_position=on_position)
+        self.queues.setdefault(user, deque()).append(job)
+        self._notify_positions()
+        self.wakeup.set()
+        return job
+
+    def cancel(self, job: Job):
+        queue = self.queues.get(job.user)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self.queues[job.user]
+            job.future.cancel()
+            self.n_cancelled += 1
+            self._notify_positions()
+        elif job.task is not None:
+            job.task.cancel()
+
+    # Queued jobs in the order they will run
+    def order(self) -> list[Job]:
+        queues = [list(queue) for queue in self.queues.values()]
+        jobs = []
+        for i in range(max(map(len, queues), default=0)):
+            jobs.extend(queue[i] for queue in queues if i < len(queue))
+        return jobs
+
+    # 0 if running, otherwise the 1-based place in the queue
+    def position(self, job: Job) -> int:
+        if job in self.running:
+            return 0
+        return self.order().index(job) + 1
+
+    def stats(self) -> dict:
+        finished = [job for job in self.finished if not job.future.cancelled()]
+        latency = [job.finished - job.submitted for job in finished]
+        wait = [job.started - job.submitted for job in finished]
+        elapsed = finished[-1].finished - min(job.submitted for job in finished) if finished else 0.0
+        return {
+            "queued": len(self),
+            "running": len(self.running),
+            "completed": len(finished),
+            "rejected": self.n_rejected,
+            "cancelled": self.n_cancelled,
+            "throughput": len(finished) / elapsed if elapsed > 0 else 0.0,
+            "latency_p50": percentile(latency, 50),
+            "latency_p95": percentile(latency, 95),
+            "wait_p95": percentile(wait, 95),
+        }
+
+    def _next(self) -> Job | None:
+        running = {job.user for job in self.running}
+        user = next((user for user in self.queues if user not in running), None)
+        if user is None:
+            return None
+        queue = self.queues[user]
+        job = queue.popleft()
+        # Round robin: the user goes to the back of the line
+        del self.queues[user]
+        if queue:
+            self.queues[user] = queue
+        return job
+
+    # Tell queued jobs their new position, only while they actually have to wait for a worker
+    def _notify_positions(self):
+        if len(self.running) < self.concurrency:
+            return
+        for position, job in enumerate(self.order(), 1):
+            if job.on_position is not None and job.position != position:
+                job.position = position
+                task = asyncio.ensure_future(job.on_position(position))
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+
+    async def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            job.started = perf_counter()
+            job.task = asyncio.ensure_future(job.run())
+            self.running.add(job)
+            self._notify_positions()
+            try:
+                await asyncio.wait({job.task})
+            finally:
+                self.running.discard(job)
+                job.finished = perf_counter()
+                # the user's next job may be waiting for this one
+                self.wakeup.set()
+
+            if job.task.cancelled():
+                job.future.cancel()
+                self.n_cancelled += 1
+            elif job.task.exception() is not None:
+                job.future.set_exception(job.task.exception())
+            else:
+                job.future.set_result(job.task.result())
+            self.finished.append(job)
+
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from alfbote.metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from discord import Message
+
+SEND_SECONDS = metrics.histogram("discord_send_seconds", "Time to send the first message of a stream")
+EDIT_SECONDS = metrics.histogram("discord_edit_seconds", "Time to edit a streamed message, rate limit waits excluded")
+EDITS = metrics.counter("discord_edits_total", "Streamed message edits")
+
+
+# Local mirror of Discord's message edit rate limit (roughly 5 edits per 5 seconds per channel)
+# Sliding window: never more than rate edits in any per seconds.
+class RateLimitBucket:
+    def __init__(self, rate: int = 5, per: float = 5.0):
+        self.rate = rate
+        self.per = per
+        self.edits: deque[float] = deque(maxlen=rate)
+
+    # Seconds until an edit is allowed
+    def delay(self) -> float:
+        if len(self.edits) < self.rate:
+            return 0.0
+        return max(0.0, self.edits[0] + self.per - monotonic())
+
+    def take(self):
+        self.edits.append(monotonic())
+
+
+_channel_buckets: dict[int, RateLimitBucket] = {}
+
+
+# Edits in the same channel share a bucket
+def channel_bucket(channel_id: int) -> RateLimitBucket:
+    return _channel_buckets.setdefault(channel_id, RateLimitBucket())
+
+
+# Text built up from many small pieces (streamed tokens).
+# Appending is O(1), the pieces are only joined when the text is read, so reading it once per edit
+# instead of once per token keeps a long reply linear.
+class TextAccumulator:
+    def __init__(self, text: str = ""):
+        self.parts: list[str] = [text] if text else []
+        self.length = len(text)
+
+    def append(self, piece: str):
+        self.parts.append(piece)
+        self.length += len(piece)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+# Shows text that keeps growing (a streamed reply) in one Discord message.
+# Edits are coalesced: at most one per interval and only while the rate limit bucket allows it.
+# Text that arrives while edits are held back is flushed by a timer, so a slow stream never looks stale,
+# and finish() always shows the final text.
+class MessageStreamer:
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[Message]],
+        message: Message | None = None,
+        interval: float = 1.0,
+        bucket: RateLimitBucket | None = None,
+    ):
+        self.send = send
+        self.message = message
+        self.interval = interval
+        self.bucket = bucket if bucket is not None else RateLimitBucket()
+        self.text = TextAccumulator()
+        self.version = 0  # bumped on every change, so unchanged text is never compared or rejoined
+        self.shown = -1
+        self.last_edit = float("-inf")
+        self.lock = asyncio.Lock()
+        self.timer: asyncio.Task | None = None
+        self.editing: asyncio.Future | None = None
+        self.n_edits = 0
+
+    def _delay(self) -> float:
+        return max(self.last_edit + self.interval - monotonic(), self.bucket.delay())
+
+    # Add a piece to the end of the text
+    async def append(self, piece: str):
+        self.text.append(piece)
+        self.version += 1
+        await self._schedule()
+
+    # Replace the whole text
+    async def update(self, text: str):
+        self.text = TextAccumulator(text)
+        self.version += 1
+        await self._schedule()
+
+    async def finish(self, text: str | None = None, **kwargs) -> Message | None:
+        if text is not None:
+            self.text = TextAccumulator(text)
+            self.version += 1
+        if self.timer is not None:
+            # a pending flush is dropped, an edit already underway completes and _flush waits for it
+            self.timer.cancel()
+            self.timer = None
+        await self._flush(**kwargs)
+        return self.message
+
+    async def _schedule(self):
+        if self.message is None or self._delay() <= 0:
+            await self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while (delay := self._delay()) > 0:
+            await asyncio.sleep(delay)
+        self.timer = None
+        await self._flush()
+
+    async def _flush(self, **kwargs):
+        async with self.lock:
+            if self.version == self.shown and not kwargs:
+                return
+            version, text = self.version, str(self.text)
+            if not text.strip():
+                return
+            if self.message is None:
+                with SEND_SECONDS.time():
+                    self.message = await self.send(text)
+            else:
+                # An edit is never cancelled halfway (e.g. by finish() stopping the timer),
+                # and the next one only starts once it is done, so the last edit shows the final text
+                if self.editing is not None:
+                    await asyncio.wait({self.editing})
+                self.editing = asyncio.ensure_future(self._edit(text, **kwargs))
+                await asyncio.shield(self.editing)
+            self.shown = version
+            self.last_edit = monotonic()
+
+    async def _edit(self, text: str, **kwargs):
+        # The bucket may be shared with other messages in the channel
+        while (delay := self.bucket.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.bucket.take()
+        with EDIT_SECONDS.time():
+            await self.message.edit(content=text, **kwargs)
+        self.n_edits += 1
+        EDITS.inc()
+
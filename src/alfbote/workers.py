@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import importlib
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections.abc import Iterator
+from time import sleep
+from typing import TYPE_CHECKING
+
+from rich import print
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+    from typing import Any
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+# Import "package.module:attr.path" and call it
+def _load(target: str, args: tuple, kwargs: dict) -> list:
+    module, _, path = target.partition(":")
+    factory = importlib.import_module(module)
+    for name in path.split("."):
+        factory = getattr(factory, name)
+    objects = factory(*args, **kwargs)
+    return objects if isinstance(objects, list) else [objects]
+
+
+# Worker process main: one thread per object, requests for the same object run one at a time.
+# Messages are (kind, request id, payload) tuples in both directions.
+def _serve(conn: Connection, target: str, args: tuple, kwargs: dict):
+    objects = _load(target, args, kwargs)
+    send_lock = threading.Lock()
+    cancelled: dict[int, threading.Event] = {}
+    queues = [queue.Queue() for _ in objects]
+
+    def send(kind: str, req_id: int | None, payload: Any = None):
+        with send_lock:
+            try:
+                conn.send((kind, req_id, payload))
+            except Exception as exc:
+                # Unpicklable payloads become an error instead of taking the worker down
+                conn.send(("error", req_id, WorkerCrashed(f"cannot send {kind}: {exc!r}")))
+
+    def run(obj: Any, requests: queue.Queue):
+        while True:
+            req_id, method, args, kwargs = requests.get()
+            event = cancelled[req_id]
+            try:
+                result = getattr(obj, method)(*args, **kwargs)
+                if not isinstance(result, Iterator):
+                    send("result", req_id, result)
+                    continue
+                try:
+                    for item in result:
+                        if event.is_set():
+                            break
+                        send("item", req_id, item)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                counters = obj.counters() if hasattr(obj, "counters") else None
+                send("end", req_id, counters)
+            except Exception as exc:
+                send("error", req_id, exc)
+            finally:
+                cancelled.pop(req_id, None)
+
+    for obj, requests in zip(objects, queues):
+        threading.Thread(target=run, args=(obj, requests), daemon=True).start()
+    send("ready", None, len(objects))
+
+    while True:
+        try:
+            kind, req_id, payload = conn.recv()
+        except (EOFError, OSError):
+            # The bot is gone
+            os._exit(0)
+        if kind == "call":
+            slot, method, args, kwargs = payload
+            cancelled[req_id] = threading.Event()
+            queues[slot].put((req_id, method, args, kwargs))
+        elif kind == "cancel" and req_id in cancelled:
+            cancelled[req_id].set()
+
+
+# Hosts the objects returned by target (e.g. "alfbote.llamacpp.chat:Llama2.pool") in a separate process,
+# so model loading and inference don't share the GIL with the discord client.
+# Calls block the calling thread (an inference thread or executor), never the event loop.
+# A worker that dies fails its pending calls with WorkerCrashed and is started again.
+class ProcessWorker:
+    def __init__(self, target: str, *args, name: str = "worker", restart: bool = True, **kwargs):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name
+        self.restart = restart
+        self.mp = multiprocessing.get_context("spawn")  # fork doesn't mix with CUDA or the bot's threads
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending: dict[int, queue.Queue] = {}
+        self.ready = threading.Event()
+        self.stopped = False
+        self.size = 0
+        self.n_restarts = 0
+        self._start()
+
+    def _start(self):
+        conn, child_conn = self.mp.Pipe()
+        process = self.mp.Process(
+            target=_serve, args=(child_conn, self.target, self.args, self.kwargs), name=self.name, daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self.conn = conn
+        self.process = process
+        threading.Thread(target=self._read, args=(conn, process), name=f"{self.name}-reader", daemon=True).start()
+
+    def _read(self, conn: Connection, process: multiprocessing.Process):
+        while True:
+            try:
+                kind, req_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                self.size = payload
+                self.ready.set()
+                print(f"[green] {self.name}: worker process {process.pid} ready")
+                continue
+            if (requests := self.pending.get(req_id)) is not None:
+                requests.put((kind, payload))
+
+        process.join(timeout=5)
+        with self.lock:
+            self.ready.clear()
+            pending, self.pending = self.pending, {}
+        exc = WorkerCrashed(f"{self.name}: worker process exited with code {process.exitcode}")
+        for requests in pending.values():
+            requests.put(("error", exc))
+        if self.stopped or not self.restart:
+            return
+
+        print(f"[red] {exc}, restarting")
+        self.n_restarts += 1
+        sleep(min(2**self.n_restarts, 60) * 0.1)
+        with self.lock:
+            if not self.stopped:
+                self._start()
+
+    def _submit(self, slot: int, method: str, args: tuple, kwargs: dict) -> tuple[int, queue.Queue]:
+        self.ready.wait()
+        requests = queue.Queue()
+        with self.lock:
+            req_id = next(self.ids)
+            self.pending[req_id] = requests
+            try:
+                self.conn.send(("call", req_id, (slot, method, args, kwargs)))
+            except OSError as exc:
+                # died after ready was checked
+                del self.pending[req_id]
+                raise WorkerCrashed(f"{self.name}: worker process is gone") from exc
+        return req_id, requests
+
+    def _finish(self, req_id: int, cancel: bool = False):
+        with self.lock:
+            if self.pending.pop(req_id, None) is not None and cancel:
+                try:
+                    self.conn.send(("cancel", req_id, None))
+                except OSError:
+                    pass
+
+    # Call method on the slot-th object. A result that is an iterator comes back as a generator over the items
+    # as the worker produces them, returning the object's counters() at the end.
+    # Closing it early cancels the call in the worker.
+    def call(self, slot: int, method: str, *args, **kwargs) -> Any:
+        req_id, requests = self._submit(slot, method, args, kwargs)
+        kind, payload = requests.get()
+        if kind != "item" and kind != "end":
+            self._finish(req_id)
+            if kind == "error":
+                raise payload
+            return payload
+        return self._stream(req_id, requests, kind, payload)
+
+    def _stream(self, req_id: int, requests: queue.Queue, kind: str, payload: Any) -> Iterator:
+        done = False
+        try:
+            while kind == "item":
+                yield payload
+                kind, payload = requests.get()
+            done = True
+            if kind == "error":
+                raise payload
+            return payload
+        finally:
+            self._finish(req_id, cancel=not done)
+
+    def stop(self):
+        self.stopped = True
+        self.process.kill()
+
+
+# Calls go to one object in a worker process, e.g. remote.generate_jpeg(prompt)
+class RemoteObject:
+    def __init__(self, worker: ProcessWorker, slot: int = 0):
+        self.worker = worker
+        self.slot = slot
+
+    def __getattr__(self, method: str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.worker.call(self.slot, method, *args, **kwargs)
+
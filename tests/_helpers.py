@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: MIT
+"""The chat prompt and LLaMAInteract settings shared by the tests and tests/bench.py."""
+
+USER_NAME = "user"
+AI_NAME = "alfbote"
+PROMPT = (
+    f"Text transcript of a never ending dialog, where {USER_NAME} interacts with an AI assistant named {AI_NAME}.\n"
+    + "".join(f"{USER_NAME}: Question number {i}?\n{AI_NAME}: Answer number {i}.\n" for i in range(20))
+    + f"{USER_NAME}:"
+)
+
+
+# LLaMAInteract on the fake backend, with the chat settings and a prompt long enough to split into chunks
+def interact(context_policy=None, model=None, **kwargs):
+    # imported here so llama_cpp resolves to fake_llama_cpp once it's installed
+    from alfbote.llamacpp.common import GptParams
+    from alfbote.llamacpp.low_level_api_chat_cpp import LLaMAInteract
+
+    params = dict(
+        seed=1,
+        n_ctx=2048,
+        n_batch=512,
+        n_predict=64,
+        repeat_last_n=256,
+        top_p=0.5,
+        repeat_penalty=1.2,
+        prompt=PROMPT,
+        interactive=True,
+        antiprompt=[f"{USER_NAME}:"],
+        input_echo=False,
+    )
+    params.update(kwargs)
+    return LLaMAInteract(GptParams(**params), context_policy=context_policy, model=model)
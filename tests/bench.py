@@ -0,0 +1,838 @@
+"""
+Micro-benchmarks for the LLaMA chat hot loop, run against tests/fake_llama_cpp.py so no model is needed.
+
+Usage, from the repository root with alfbote installed (or PYTHONPATH=src):
+python -m tests.bench [benchmark [argument=value ...] ...]
+"""
+import asyncio
+import codecs
+import ctypes
+import gc
+import sys
+import tracemalloc
+from ast import literal_eval
+from time import perf_counter
+from types import SimpleNamespace
+
+from tests import fake_llama_cpp
+
+fake_llama_cpp.install()
+
+from tests import legacy_sampling  # noqa: E402
+from tests._helpers import PROMPT, USER_NAME, interact  # noqa: E402
+
+import llama_cpp  # noqa: E402  (resolves to fake_llama_cpp)
+import numpy as np  # noqa: E402
+from alfbote.llamacpp.common import GptParams  # noqa: E402
+from alfbote.llamacpp.context import HalfContext, TurnWindow  # noqa: E402
+from alfbote.llamacpp.sampling import CandidateBuffer, SamplerPipeline  # noqa: E402
+from alfbote.llamacpp import util  # noqa: E402
+from alfbote.llamacpp.tokenizer import Tokenizer  # noqa: E402
+from alfbote.llamacpp.vocab import Vocab  # noqa: E402
+from alfbote.streaming import RateLimitBucket, TextAccumulator, _channel_buckets  # noqa: E402
+
+def _per_call(fn, iters: int) -> float:
+    fn()  # warm up
+    start = perf_counter()
+    for _ in range(iters):
+        fn()
+    return (perf_counter() - start) / iters
+
+
+def _report(name: str, seconds: float, baseline: float | None = None):
+    line = f"{name:<40} {seconds * 1e6:>10.1f} us"
+    if baseline is not None:
+        line += f"  ({baseline / seconds:.1f}x)"
+    print(line)
+
+
+# Per-token candidate construction, the way LLaMAInteract.generate used to do it
+def _legacy_candidates(ctx, logit_bias: dict[int, float]):
+    logits = llama_cpp.llama_get_logits(ctx)
+    n_vocab = llama_cpp.llama_n_vocab(ctx)
+    for key, value in logit_bias.items():
+        logits[key] += value
+    _arr = (llama_cpp.llama_token_data * n_vocab)(
+        *[llama_cpp.llama_token_data(token_id, logits[token_id], 0.0) for token_id in range(n_vocab)]
+    )
+    return ctypes.pointer(llama_cpp.llama_token_data_array(_arr, len(_arr), False))
+
+
+def bench_candidates(n_vocab: int = 32000, iters: int = 50):
+    print(f"candidate construction per sampled token (n_vocab = {n_vocab})")
+    fake_llama_cpp.config.n_vocab = n_vocab
+    ctx = llama_cpp.llama_init_from_file(b"fake", llama_cpp.llama_context_default_params())
+    llama_cpp.llama_eval(ctx, (llama_cpp.llama_token * 1)(1), 1, 0, 1)
+    logit_bias = {llama_cpp.llama_token_eos(): -float("inf")}
+
+    legacy = _per_call(lambda: _legacy_candidates(ctx, {}), iters)
+    _report("before: list of llama_token_data", legacy)
+
+    buffer = CandidateBuffer(n_vocab, logit_bias)
+    logits_ptr = llama_cpp.llama_get_logits(ctx)
+    fill = legacy_sampling.fill
+    _report("after: CandidateBuffer over the logits", _per_call(lambda: fill(buffer, logits_ptr), iters * 10), legacy)
+
+
+# SamplerPipeline against the old chain, time per sampled token (tests/test_sampling.py checks they pick the same)
+def bench_sampling(n_tokens: int = 300, n_ctx: int = 2048):
+    print(f"sampling per token (n_vocab = {fake_llama_cpp.config.n_vocab}, {n_tokens} tokens)")
+    eos = llama_cpp.llama_token_eos()
+    for name, params in (
+        ("chat defaults", GptParams(temp=0.8, top_k=40, top_p=0.5, repeat_penalty=1.2, repeat_last_n=256)),
+        ("greedy", GptParams(temp=0, repeat_penalty=1.2, repeat_last_n=256)),
+        ("GptParams defaults", GptParams()),
+        (
+            "penalties, no nl, logit bias",
+            GptParams(frequency_penalty=0.5, presence_penalty=0.3, penalize_nl=False, logit_bias={eos: -float("inf")}),
+        ),
+        ("whole vocab, temp 1", GptParams(top_k=0, top_p=1.0, temp=1.0, repeat_penalty=1.0)),
+        ("mirostat 2", GptParams(mirostat=2)),
+    ):
+        lparams = llama_cpp.llama_context_default_params()
+        lparams.seed = 1
+        ctxs = [llama_cpp.llama_init_from_file(b"fake", lparams) for _ in range(2)]
+        logits = np.random.default_rng(0).standard_normal((n_tokens, fake_llama_cpp.config.n_vocab), dtype=np.float32)
+        logits_ptrs = [row.ctypes.data_as(ctypes.POINTER(ctypes.c_float)) for row in logits]
+
+        candidates = CandidateBuffer(fake_llama_cpp.config.n_vocab, params.logit_bias)
+        mirostat_mu = ctypes.pointer(llama_cpp.c_float(2.0 * params.mirostat_tau))
+        sampler = SamplerPipeline(params, fake_llama_cpp.config.n_vocab, n_ctx)
+        ids, times = [], [0.0, 0.0]
+        last_n_tokens = util.Circle(n_ctx)
+        last_n_tokens.extend([0] * n_ctx)
+        for logits_ptr in logits_ptrs:
+            start = perf_counter()
+            legacy_sampling.sample(ctxs[0], params, candidates, logits_ptr, last_n_tokens, n_ctx, mirostat_mu)
+            times[0] += perf_counter() - start
+            start = perf_counter()
+            id = sampler(ctxs[1], logits_ptr, last_n_tokens.tail(min(len(last_n_tokens), sampler.last_n)))
+            times[1] += perf_counter() - start
+            ids.append(id)
+            last_n_tokens.append(id)
+        print(f"{name} ({len(set(ids))} distinct tokens)")
+        _report("before: full llama_sample_* chain", times[0] / n_tokens)
+        _report("after: SamplerPipeline", times[1] / n_tokens, times[0] / n_tokens)
+
+
+# Prompt prefill time by n_batch (tests/test_eval_chunking.py checks the chunks give the same logits)
+def bench_prefill(n_batches: tuple[int, ...] = (4096, 512, 64, 7)):
+    for i, n_batch in enumerate(n_batches):
+        m = interact(n_batch=n_batch)
+        if i == 0:
+            print(f"prompt prefill ({len(m.embd_inp)} tokens)")
+        start = perf_counter()
+        m._eval(m.embd_inp)
+        elapsed = perf_counter() - start
+        _report(f"n_batch = {n_batch:<5} max eval = {m.ctx.max_eval_batch:<5} calls = {m.ctx.n_eval_calls}", elapsed)
+
+
+# Per-token repetition window work: push, penalty array and antiprompt suffix check
+def bench_repetition(n_ctxs: tuple[int, ...] = (2048, 8192), repeat_last_n: int = 256, iters: int = 2000):
+    antiprompt = [3 + b for b in b"user:"]
+    for n_ctx in n_ctxs:
+        print(f"repetition window per token (n_ctx = {n_ctx}, repeat_last_n = {repeat_last_n})")
+        tokens = [0] * n_ctx
+
+        def legacy():
+            tokens.pop(0)
+            tokens.append(42)
+            _arr = (llama_cpp.llama_token * repeat_last_n)(*tokens[len(tokens) - repeat_last_n :])
+            return _arr, True in [i == tokens[-len(i) :] for i in [antiprompt]]
+
+        ring = util.Circle(n_ctx)
+        ring.extend([0] * n_ctx)
+
+        def circle():
+            ring.append(42)
+            _last = ring.tail(repeat_last_n)
+            _arr = _last.ctypes.data_as(ctypes.POINTER(llama_cpp.llama_token))
+            return _arr, any(ring.endswith(i) for i in [antiprompt])
+
+        baseline = _per_call(legacy, iters)
+        _report("before: list.pop(0) + ctypes copy", baseline)
+        _report("after: Circle + tail view", _per_call(circle, iters), baseline)
+
+
+# Token pieces to text, the way LLaMAInteract.output used to do it
+def _legacy_decode(pieces: list[bytes]):
+    multibyte_fix = []
+    for cur_char in pieces:
+        if None in multibyte_fix:
+            multibyte_fix[multibyte_fix.index(None)] = cur_char
+        if len(multibyte_fix) > 0 and None not in multibyte_fix:
+            yield (b"".join(multibyte_fix)).decode("utf8")
+            multibyte_fix = []
+            continue
+        for num, pattern in [(2, 192), (3, 224), (4, 240)]:
+            if pattern & int.from_bytes(cur_char, 'little') == pattern:
+                multibyte_fix = [cur_char] + ([None] * (num - 1))
+        if len(multibyte_fix) > 0:
+            continue
+        yield cur_char.decode("utf8")
+
+
+# Decoding a streamed reply and building the message text, tokens are word pieces with some multi-byte characters
+# split into one token per byte like llama's byte fallback does
+def bench_streaming(n_tokens: tuple[int, ...] = (256, 2048, 8192), edit_every: int = 32):
+    words = [b" the", b" reply", b" keeps", b" going", b",", b"\n"] + [bytes([b]) for b in "é€😀".encode("utf8")]
+    for n in n_tokens:
+        print(f"streamed reply of {n} tokens (one message edit per {edit_every} tokens)")
+        pieces = [words[i % len(words)] for i in range(n)]
+
+        def legacy():
+            output = []
+            for token in _legacy_decode(pieces):
+                output.append(token)
+                current_msg = "".join(output)
+            return current_msg
+
+        def incremental():
+            decode = codecs.getincrementaldecoder("utf-8")(errors="ignore").decode
+            text = TextAccumulator()
+            for i, piece in enumerate(pieces):
+                if piece := decode(piece):
+                    text.append(piece)
+                if i % edit_every == 0:
+                    str(text)
+            return str(text)
+
+        assert legacy() == incremental() == b"".join(pieces).decode("utf8")
+        iters = max(1, 20000 // n)
+        baseline = _per_call(legacy, iters)
+        _report("before: multibyte_fix + join per token", baseline)
+        _report("after: incremental decoder + accumulator", _per_call(incremental, iters), baseline)
+
+
+# Token id to text, per generated token and for a whole history like past()
+def bench_detokenize(n_tokens: int = 2048, iters: int = 20):
+    print(f"detokenize per token ({n_tokens} token reply)")
+    ctx = llama_cpp.llama_init_from_file(b"fake", llama_cpp.llama_context_default_params())
+    start = perf_counter()
+    vocab = Vocab(ctx)
+    print(f"vocab table: {len(vocab)} tokens built in {(perf_counter() - start) * 1000:.1f} ms")
+    ids = np.random.default_rng(0).integers(3, len(vocab), n_tokens).tolist()
+
+    def ffi():
+        decode = codecs.getincrementaldecoder("utf-8")(errors="ignore").decode
+        for id in ids:
+            decode(llama_cpp.llama_token_to_str(ctx, id))
+
+    def table():
+        decode = codecs.getincrementaldecoder("utf-8")(errors="ignore").decode
+        pieces = vocab.pieces
+        for id in ids:
+            decode(pieces[id])
+
+    # the fake llama_token_to_str is plain Python, a real one also pays a ctypes call per token
+    libc = ctypes.CDLL(None)
+    libc.strlen.restype = ctypes.c_size_t
+
+    def ctypes_call():
+        for _ in ids:
+            libc.strlen(b"piece")
+
+    baseline = _per_call(ffi, iters) / n_tokens
+    _report("before: llama_token_to_str + decode", baseline)
+    _report("after: vocab table + decode", _per_call(table, iters) / n_tokens, baseline)
+    _report("(ctypes call overhead alone)", _per_call(ctypes_call, iters) / n_tokens)
+
+    print(f"past() over {n_tokens} tokens")
+
+    def past_ffi():
+        return "".join(llama_cpp.llama_token_to_str(ctx, id).decode("utf8", errors="ignore") for id in ids)
+
+    baseline = _per_call(past_ffi, iters)
+    _report("before: per token FFI + decode", baseline)
+    past_table = lambda: vocab.detokenize(ids).decode("utf8", errors="ignore")  # noqa: E731
+    _report("after: detokenize + one decode", _per_call(past_table, iters), baseline)
+
+
+# Tokenizing the strings a chat turn needs, the way LLaMAInteract._tokenize used to do it
+def _legacy_tokenize(ctx, prompt: str, bos: bool = True) -> list[int]:
+    _arr = (llama_cpp.llama_token * ((len(prompt) + 1) * 4))()
+    _n = llama_cpp.llama_tokenize(ctx, prompt.encode("utf8", errors="ignore"), _arr, len(_arr), bos)
+    return _arr[:_n]
+
+
+def bench_tokenize(iters: int = 2000):
+    ctx = llama_cpp.llama_init_from_file(b"fake", llama_cpp.llama_context_default_params())
+    repeated = [(f"{USER_NAME}:", False), ("\n", False), (" [end of text]\n", False), ("\n\n### Response:\n\n", False)]
+    messages = [(f"Question number {i}, what is {i} + {i}?\n", True) for i in range(50)]
+
+    tokenizer = Tokenizer(ctx)
+    texts = [text for text, _ in messages] + ["", "é€😀" * 200]
+    assert tokenizer.tokenize_batch(texts) == [_legacy_tokenize(ctx, text) for text in texts]
+    for text, bos in repeated + messages:
+        assert tokenizer(text, bos) == _legacy_tokenize(ctx, text, bos)
+
+    # the cache only holds the markers, so every new message is a miss through the scratch buffer
+    for name, strings in (("repeated markers", repeated), ("new user messages", messages)):
+        print(f"tokenize per call ({name})")
+        tokenizer = Tokenizer(ctx, max_entries=len(repeated))
+        baseline = _per_call(lambda: [_legacy_tokenize(ctx, text, bos) for text, bos in strings], iters // 10)
+        baseline /= len(strings)
+        _report("before: new ctypes array per call", baseline)
+        after = _per_call(lambda: [tokenizer(text, bos) for text, bos in strings], iters // 10)
+        _report("after: Tokenizer", after / len(strings), baseline)
+        print(f"cache hits {tokenizer.n_hits}, misses {tokenizer.n_misses}")
+
+
+# A long conversation that overflows the context many times
+def bench_context(n_turns: int = 40):
+    print(f"context overflow over {n_turns} turns (n_ctx = 2048)")
+    for name, n_keep, policy in (
+        ("before: n_keep = 0, keep half", 0, HalfContext()),
+        ("after: pinned prompt, last 4 turns", -1, TurnWindow(max_turns=4)),
+    ):
+        m = interact(context_policy=policy, n_keep=n_keep)
+        m.prefill()
+        prompt = list(m.ctx.kv)
+        n_eval_tokens = m.ctx.n_eval_tokens
+        for i in range(n_turns):
+            m.input(f" Tell me a long story about the number {i}, with as many details as you can.\n")
+            for _ in m.output():
+                pass
+        n_swaps = max(m.n_context_swaps, 1)
+        intact = m.ctx.kv[: len(prompt)] == prompt
+        print(
+            f"{name:<40} {m.n_context_swaps} swaps, {m.n_swap_tokens / n_swaps:.0f} tokens re-evaluated per swap, "
+            f"{m.ctx.n_eval_tokens - n_eval_tokens} evaluated in total, prompt intact: {intact}"
+        )
+
+
+# Replies with and without a draft model. The fake draft sees the main model's logits plus noise and evals
+# in a tenth of the time, the main model costs about the same for one token or a few (memory bound, like on CPU).
+def bench_speculative(
+    n_drafts: tuple[int, ...] = (2, 4, 8),
+    n_turns: int = 4,
+    n_predict: int = 48,
+    noise: float = 0.3,
+    eval_latency: float = 0.03,
+    token_latency: float = 0.001,
+):
+    print(
+        f"speculative decoding, {n_turns} replies of {n_predict} tokens "
+        f"({eval_latency * 1000:.0f} ms per eval + {token_latency * 1000:.0f} ms per token, draft 10x faster)"
+    )
+    fake_llama_cpp.config.noise["draft"] = noise
+    fake_llama_cpp.config.latency_scale["draft"] = 0.1
+    for name, temp in (("greedy", 0.0), ("temp 0.8", 0.8)):
+        baseline = None
+        for n_draft in (0,) + n_drafts:
+            m = interact(n_predict=n_predict, temp=temp, model_draft="draft" if n_draft else "", n_draft=n_draft)
+            m.prefill()
+            fake_llama_cpp.config.eval_latency = eval_latency
+            fake_llama_cpp.config.token_latency = token_latency
+            start = perf_counter()
+            for i in range(n_turns):
+                m.input(f" Tell me about the number {i}.\n")
+                for _ in m.output():
+                    pass
+            elapsed = perf_counter() - start
+            fake_llama_cpp.config.eval_latency = fake_llama_cpp.config.token_latency = 0.0
+
+            tokens_per_sec = m.n_sampled / elapsed
+            if baseline is None:
+                baseline = tokens_per_sec
+                print(f"{name:<10} no draft    {tokens_per_sec:6.1f} tok/s")
+                continue
+            print(
+                f"{name:<10} n_draft = {n_draft} {tokens_per_sec:6.1f} tok/s ({tokens_per_sec / baseline:.2f}x), "
+                f"{m.n_accepted / m.n_drafted:.0%} of drafted tokens accepted, "
+                f"{m.n_sampled / m.n_draft_evals:.1f} tokens per main model eval"
+            )
+            m.exit()
+    fake_llama_cpp.config.noise.clear()
+    fake_llama_cpp.config.latency_scale.clear()
+
+
+# Stands in for the Discord message and command context of ChatGen.run_chat_message
+class _FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+    async def edit(self, content: str, **kwargs):
+        self.content = content
+
+
+class _FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class _FakeContext:
+    def __init__(self):
+        self.author = SimpleNamespace(id=1, voice=None)
+        self.message = SimpleNamespace(id=1, author=self.author)
+        self.channel = SimpleNamespace(id=1)
+        self.guild = None
+
+    async def send(self, content: str, **kwargs) -> _FakeMessage:
+        return _FakeMessage(content)
+
+    def typing(self) -> _FakeTyping:
+        return _FakeTyping()
+
+
+# Each layer of a chat reply gets the same turns: LLaMAInteract.output, then Llama2.generate on top of it
+# (speaker tags, word buffering), then ChatGen.run_chat_message on top of that (inference thread, message streaming).
+# Every turn starts from the evaluated prompt so they all cost the same.
+# overhead is the time spent outside the fake model's evals per token sampled, i.e. our Python;
+# memory comes from a second run under tracemalloc: the peak above where it started, and what it still holds after
+# per token (growth that a leak in the hot loop shows up as).
+def bench_pipeline(
+    n_turns: int = 8,
+    n_predict: int = 64,
+    n_vocab: int = 32000,
+    eval_latency: float = 0.0,
+    token_latency: float = 0.0,
+):
+    from alfbote.llamacpp.chat import Llama2
+
+    print(
+        f"chat pipeline, {n_turns} replies of up to {n_predict} tokens, vocab {n_vocab} "
+        f"({eval_latency * 1000:.0f} ms per eval + {token_latency * 1000:.1f} ms per token)"
+    )
+    fake_llama_cpp.config.n_vocab = n_vocab
+    llama_kwargs = dict(model_file="fake", prompt_cache_dir=None, n_predict=n_predict)
+
+    def llama_interact():
+        m = interact(n_predict=n_predict)
+
+        def turn(i: int):
+            m.input(f" Tell me about the number {i}.\n")
+            return "".join(m.output())
+
+        return m, turn
+
+    def llama2():
+        llama2 = Llama2(n_threads=1, n_gpu_layers=0, **llama_kwargs)
+        return llama2.m, lambda i: "".join(llama2.generate(f"Tell me about the number {i}."))
+
+    def chatgen():
+        try:
+            from alfbote.chatgen import ChatGen
+        except ImportError as exc:
+            print(f"{'ChatGen.run_chat_message':<26} skipped, {exc}")
+            return None
+
+        loop = asyncio.new_event_loop()
+        ctx = _FakeContext()
+        # a benchmark of Discord's edit rate limit would only measure sleeping
+        _channel_buckets[ctx.channel.id] = RateLimitBucket(rate=1 << 30)
+        chat = ChatGen(SimpleNamespace(loop=loop), n_threads=1, **llama_kwargs)
+        pool = loop.run_until_complete(chat.models.get())
+        m = pool.slots[0].model.m
+        return m, lambda i: loop.run_until_complete(chat.run_chat_message(ctx, f"Tell me about the number {i}."))
+
+    print(f"{'':<26} {'tok/s':>8} {'overhead':>12} {'peak':>10} {'retained':>12}")
+    for name, setup in (
+        ("LLaMAInteract.output", llama_interact),
+        ("Llama2.generate", llama2),
+        ("ChatGen.run_chat_message", chatgen),
+    ):
+        if (layer := setup()) is None:
+            continue
+        m, turn = layer
+        m.prefill()
+        base = m.get_state()
+
+        def run(turns: range) -> tuple[float, int]:
+            elapsed, n_sampled = 0.0, m.n_sampled
+            for i in turns:
+                m.set_state(base)
+                start = perf_counter()
+                turn(i)
+                elapsed += perf_counter() - start
+            return elapsed, m.n_sampled - n_sampled
+
+        run(range(1))  # warm up
+        fake_llama_cpp.config.eval_latency = eval_latency
+        fake_llama_cpp.config.token_latency = token_latency
+        t_eval = m.ctx.t_eval
+        elapsed, n_tokens = run(range(n_turns))
+        t_eval = m.ctx.t_eval - t_eval
+        fake_llama_cpp.config.eval_latency = fake_llama_cpp.config.token_latency = 0.0
+
+        tracemalloc.start()
+        run(range(1))  # caches filled on first use aren't growth
+        gc.collect()
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        _, n_traced = run(range(n_turns, 2 * n_turns))
+        gc.collect()
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(
+            f"{name:<26} {n_tokens / elapsed:8.1f} {(elapsed - t_eval) / n_tokens * 1e6:9.1f} us "
+            f"{(peak - start) / 1024:6.0f} KiB {(held - start) / n_traced:8.1f} B/tok"
+        )
+    fake_llama_cpp.config.n_vocab = 32000
+
+
+# Aggregate tokens/sec and per-request latency as the pool grows, with the fake taking token_latency per
+# evaluated token (the sleep releases the GIL like llama_eval does). Latency is from asking for a slot to the
+# first token and to the end of the reply, queueing for a busy pool included.
+def bench_pool(sizes: tuple[int, ...] = (1, 2, 4), n_users: int = 8, n_turns: int = 2, token_latency: float = 0.01):
+    from alfbote.llamacpp.chat import Llama2
+    from alfbote.pool import ModelPool
+
+    async def serve(pool: ModelPool) -> tuple[float, list[float], list[float]]:
+        first_token, reply = [], []
+
+        async def chat(user: int):
+            for turn in range(n_turns):
+                start = perf_counter()
+                async with pool.acquire(user) as slot:
+                    n_sampled = slot.model.n_sampled
+                    first = None
+                    async for _ in slot.worker.stream(lambda: slot.model.generate(f"Hello {turn}", session=user)):
+                        first = first if first is not None else perf_counter() - start
+                    slot.n_tokens += slot.model.n_sampled - n_sampled
+                first_token.append(first)
+                reply.append(perf_counter() - start)
+
+        await asyncio.gather(*(chat(user) for user in range(n_users)))
+        return pool.stats()["tokens_per_sec"], sorted(first_token), sorted(reply)
+
+    print(f"model pool, {n_users} users x {n_turns} turns, {token_latency * 1000:.0f} ms per evaluated token")
+    for size in sizes:
+        n_loads = fake_llama_cpp.FakeModel.n_loads
+        models = Llama2.pool(size, n_threads=1, n_predict=32, prompt_cache_dir=None)
+        loads = fake_llama_cpp.FakeModel.n_loads - n_loads
+        pool = ModelPool(models, affinity=lambda model: model.active_session)
+        fake_llama_cpp.config.token_latency = token_latency
+        tokens_per_sec, first_token, reply = asyncio.run(serve(pool))
+        fake_llama_cpp.config.token_latency = 0.0
+        pool.close()
+        Llama2.close_pool(models)
+        migrations = models[0].sessions.store.n_migrations
+        print(
+            f"pool size {size}: {tokens_per_sec:6.1f} tok/s aggregate, weights loaded {loads}x, "
+            f"{migrations} conversations moved between contexts"
+        )
+        p95 = int(len(reply) * 0.95)
+        print(
+            f"{'':<13} first token p50 {first_token[len(first_token) // 2] * 1000:5.0f} ms "
+            f"p95 {first_token[p95] * 1000:5.0f} ms, reply p50 {reply[len(reply) // 2] * 1000:5.0f} ms "
+            f"p95 {reply[p95] * 1000:5.0f} ms"
+        )
+
+
+# The cost of an instrumented point (a timer around a counter), against the same call without one
+def bench_metrics(n: int = 1_000_000):
+    from timeit import timeit
+
+    from alfbote.metrics import Registry
+
+    registry = Registry()
+    histogram = registry.histogram("bench_seconds", "Benchmark latency")
+    counter = registry.counter("bench_total", "Benchmark events")
+
+    def instrumented():
+        with histogram.time():
+            counter.inc()
+
+    print(f"metrics per instrumented point ({n} calls)")
+    base = timeit(lambda: None, number=n)
+    _report("disabled", (timeit(instrumented, number=n) - base) / n)
+    registry.enabled = True
+    _report("enabled", (timeit(instrumented, number=n) - base) / n)
+
+
+# Chat requests from a few users against a fake model that takes gen_time per reply, arriving a bit faster
+# than they are answered
+def bench_scheduler(n_users: int = 6, n_requests: int = 60, gen_time: float = 0.02, max_depth: int = 16):
+    import random
+
+    from alfbote.scheduler import RequestScheduler
+
+    async def main():
+        scheduler = RequestScheduler(max_depth=max_depth, max_per_user=4)
+        rng = random.Random(0)
+        jobs = []
+        for _ in range(n_requests):
+            job = scheduler.submit(rng.randrange(n_users), lambda: asyncio.sleep(gen_time * rng.uniform(0.5, 1.5)))
+            if job is not None:
+                jobs.append(job)
+            await asyncio.sleep(gen_time * 0.8)
+        for job in jobs:
+            await job.result()
+        return scheduler.stats()
+
+    stats = asyncio.run(main())
+    print(f"request queue, {n_users} users, {n_requests} requests, ~{gen_time * 1000:.0f} ms per reply, ", end="")
+    print(f"depth {max_depth}")
+    print(f"completed {stats['completed']}, rejected {stats['rejected']}, {stats['throughput']:.1f} replies/s")
+    print(f"latency p50 {stats['latency_p50'] * 1000:.0f} ms, p95 {stats['latency_p95'] * 1000:.0f} ms")
+    print(f"queue wait p95 {stats['wait_p95'] * 1000:.0f} ms")
+
+
+# Stubbed image pipeline: a call costs step_time per step for the first image and batch_cost of that for each
+# image after it, about how a GPU that isn't saturated by one image behaves.
+# Users ask for images faster than they can be drawn one at a time.
+def bench_imagequeue(
+    n_users: int = 6,
+    n_requests: int = 24,
+    arrival: float = 0.02,
+    iterations: int = 25,
+    step_time: float = 0.004,
+    batch_cost: float = 0.35,
+):
+    import random
+
+    from alfbote.imagequeue import ImageQueue, ImageRequest
+
+    async def run_batch(batch: list[ImageRequest]) -> list[str]:
+        await asyncio.sleep(iterations * step_time * (1 + batch_cost * (len(batch) - 1)))
+        return [f"{request.prompt} {request.seed}" for request in batch]
+
+    async def main(max_batch: int) -> tuple[dict, list[float]]:
+        queue = ImageQueue(run_batch, max_batch=max_batch, max_depth=n_requests, max_per_user=n_requests)
+        rng = random.Random(0)
+        requests = []
+        for i in range(n_requests):
+            requests.append(queue.submit(rng.randrange(n_users), f"prompt {i}", seed=i))
+            await asyncio.sleep(arrival * rng.uniform(0.5, 1.5))
+        for request in requests:
+            await request.result()
+        queue.close()
+        return queue.stats(), sorted(request.started - request.submitted for request in requests)
+
+    print(
+        f"image queue, {n_requests} requests from {n_users} users every {arrival * 1000:.0f} ms, "
+        f"{iterations * step_time * 1000:.0f} ms per image alone, +{batch_cost:.0%} per extra image in a batch"
+    )
+    for max_batch in (1, 2, 4, 8):
+        stats, wait = asyncio.run(main(max_batch))
+        print(
+            f"max batch {max_batch}: {stats['images_per_minute']:6.0f} images/min, "
+            f"{stats['mean_batch']:.1f} images per batch, "
+            f"queue wait p95 {wait[int(len(wait) * 0.95)] * 1000:4.0f} ms"
+        )
+
+
+# Simulated restart: the gateway takes connect seconds, the model load seconds, and a user asks something
+# ask seconds after the process started. Eager is how the cogs used to load, before bot.run.
+# Then the lazy model sits idle past idle_unload and the next request pays a cold start.
+def bench_lazy(connect: float = 0.1, load: float = 1.0, ask: float = 0.3, reply: float = 0.05, idle: float = 0.5):
+    from time import sleep
+
+    from alfbote.lazy import LazyModel
+
+    def load_model() -> str:
+        sleep(load)
+        return "model"
+
+    async def respond(model: LazyModel, start: float) -> float:
+        async with model.use():
+            await asyncio.sleep(reply)
+        model.responded()
+        return perf_counter() - start
+
+    async def main():
+        print(f"lazy loading, gateway {connect:.1f}s, model load {load:.1f}s, first request at {ask:.1f}s, ", end="")
+        print(f"reply {reply:.2f}s")
+
+        start = perf_counter()
+        load_model()
+        await asyncio.sleep(connect)
+        online = perf_counter() - start
+        await asyncio.sleep(max(0.0, ask - online))
+        await asyncio.sleep(reply)
+        print(f"eager: online after {online:.2f}s, first request answered {perf_counter() - start - ask:.2f}s after it")
+
+        start = perf_counter()
+        model = LazyModel("simulated", load_model, idle_unload=idle)
+        await asyncio.sleep(connect)
+        online = perf_counter() - start
+        model.start()  # on_ready
+        await asyncio.sleep(ask - online)
+        first = await respond(model, perf_counter())
+        print(f"lazy:  online after {online:.2f}s, first request answered {first:.2f}s after it (warming up)")
+
+        warm = await respond(model, perf_counter())
+        # the idle check runs about once a second
+        await asyncio.sleep(idle + 1.5)
+        cold = await respond(model, perf_counter())
+        print(f"lazy:  warm request {warm:.2f}s, after idle unload {cold:.2f}s (cold start)")
+        model.unloader.cancel()
+
+    asyncio.run(main())
+
+
+# Simulated 8 GB device shared by chat (5 GB of layers, 4x slower on the CPU, reloaded to move) and images
+# (3.5 GB UNet, device only). Chat alone, then images alone, then both: the scheduler against the old rule,
+# which kept chat on the CPU whenever image generation was enabled.
+def bench_device(n_requests: int = 30, seed: int = 0):
+    import random
+
+    from alfbote.device import DeviceScheduler
+
+    async def simulate(scheduled: bool) -> dict:
+        moves = {"chat": 0, "image": 0}
+        latency = {"chat": [], "image": []}
+        queued = {"chat": 0, "image": 0}
+
+        def mover(name: str, cost: float):
+            async def place(on_device: bool):
+                moves[name] += 1
+                await asyncio.sleep(cost)
+
+            return place
+
+        scheduler = DeviceScheduler(capacity_mb=8192, hold=0.05)
+        chat = scheduler.register("chat", 5000, mover("chat", 0.05), lambda: queued["chat"], cpu_fallback=True)
+        scheduler.register("image", 3500, mover("image", 0.01), lambda: queued["image"])
+        if not scheduled:
+            chat.on_device = False
+            # no other tenant ever needs chat's share, so chat never gets it either
+            chat.memory_mb = float("inf")
+
+        locks = {"chat": asyncio.Lock(), "image": asyncio.Lock()}
+
+        async def request(name: str):
+            start = perf_counter()
+            queued[name] += 1
+            async with locks[name]:
+                queued[name] -= 1
+                async with scheduler.reserve(name) as on_device:
+                    await asyncio.sleep({"chat": 0.01, "image": 0.02}[name] * (1 if on_device else 4))
+            latency[name].append(perf_counter() - start)
+
+        rng = random.Random(seed)
+        tasks = []
+        for phase in (("chat",), ("image",), ("chat", "image")):
+            for _ in range(n_requests):
+                tasks.append(asyncio.create_task(request(rng.choice(phase))))
+                await asyncio.sleep(0.015)
+            await asyncio.gather(*tasks)
+            await asyncio.sleep(0.1)
+        return {name: (sum(times) / len(times) * 1000, moves[name]) for name, times in latency.items()}
+
+    print(f"shared device, {n_requests} chat, then image, then mixed requests")
+    for name, scheduled in (("chat always on the CPU", False), ("device scheduler", True)):
+        for tenant, (ms, n) in asyncio.run(simulate(scheduled)).items():
+            print(f"{name:<24} {tenant:<6} {ms:6.1f} ms mean, {n} moves")
+
+
+# Stubbed text encoder costing encode_time per call plus text_time per text, about CLIP on a CPU.
+# Each image encodes its prompt and the shared negative prompt; prompts are drawn with Zipf-like
+# popularity (people repeat and retry popular prompts) and sometimes retyped with other case or spacing.
+def bench_embedcache(n_images: int = 300, n_prompts: int = 400, encode_time: float = 0.005, text_time: float = 0.02):
+    import random
+    from time import sleep
+
+    from alfbote.embedcache import EmbeddingCache
+
+    rng = random.Random(0)
+    weights = [1 / (rank + 1) for rank in range(n_prompts)]
+    prompts = []
+    for _ in range(n_images):
+        prompt = f"a photo of thing {rng.choices(range(n_prompts), weights)[0]}"
+        prompts.append(prompt.upper() if rng.random() < 0.1 else prompt.replace(" ", "  ", 1))
+    negative = "visual artifacts, nsfw, (deformed, distorted, disfigured:1.3), poorly drawn, bad anatomy"
+
+    def encode(texts: list[str]) -> list[str]:
+        sleep(encode_time + text_time * len(texts))
+        return [f"embedding of {text}" for text in texts]
+
+    both = (encode_time + 2 * text_time) * 1000
+    print(f"prompt encodings, {n_images} images, {n_prompts} distinct prompts, ", end="")
+    print(f"{both:.0f} ms to encode a prompt and the negative one")
+    for max_entries in (0, 64, 256):
+        cache = EmbeddingCache(max_entries)
+        start = perf_counter()
+        for prompt in prompts:
+            cache.lookup([prompt, negative], encode)
+        per_image = (perf_counter() - start) / n_images * 1000
+        print(f"{max_entries:>3} entries: hit rate {cache.stats()['hit_rate']:4.0%}, {per_image:5.1f} ms per image")
+
+
+# Largest event loop stall while tokens are generated on a thread of this process or in a worker process,
+# by tokens that hold the GIL while they are computed
+def bench_workers(n_tokens: int = 40, interval: float = 0.005):
+    from alfbote.inference import InferenceWorker
+    from alfbote.workers import ProcessWorker, RemoteObject, WorkerCrashed
+    from tests.fake_worker import LoadTest
+
+    async def max_lag(generate) -> tuple[float, int]:
+        stream = InferenceWorker().stream(generate)
+        lag = 0.0
+        n = 0
+
+        async def tick():
+            nonlocal lag
+            while True:
+                start = perf_counter()
+                await asyncio.sleep(interval)
+                lag = max(lag, perf_counter() - start - interval)
+
+        ticker = asyncio.create_task(tick())
+        async for _ in stream:
+            n += 1
+        ticker.cancel()
+        return lag, n
+
+    async def main():
+        worker = ProcessWorker("tests.fake_worker:LoadTest", name="loadtest")
+        remote = RemoteObject(worker)
+        local = LoadTest()
+
+        print(f"event loop lag while generating {n_tokens} tokens")
+        lag, n = await max_lag(lambda: local.tokens(n_tokens))
+        print(f"in-process thread: {n} tokens, worst event loop lag {lag * 1000:.1f} ms")
+        lag, n = await max_lag(lambda: remote.tokens(n_tokens))
+        print(f"worker process:    {n} tokens, worst event loop lag {lag * 1000:.1f} ms")
+
+        try:
+            await asyncio.to_thread(remote.crash)
+        except WorkerCrashed as exc:
+            print(f"crash: {exc}")
+        lag, n = await max_lag(lambda: remote.tokens(5))
+        print(f"after restart:     {n} tokens, {worker.n_restarts} restart")
+        worker.stop()
+
+    asyncio.run(main())
+
+
+BENCHMARKS = {
+    "candidates": bench_candidates,
+    "prefill": bench_prefill,
+    "repetition": bench_repetition,
+    "streaming": bench_streaming,
+    "detokenize": bench_detokenize,
+    "tokenize": bench_tokenize,
+    "context": bench_context,
+    "speculative": bench_speculative,
+    "sampling": bench_sampling,
+    "pipeline": bench_pipeline,
+    "pool": bench_pool,
+    "metrics": bench_metrics,
+    "scheduler": bench_scheduler,
+    "imagequeue": bench_imagequeue,
+    "lazy": bench_lazy,
+    "device": bench_device,
+    "embedcache": bench_embedcache,
+    "workers": bench_workers,
+}
+
+
+# python -m tests.bench pipeline n_vocab=8000 eval_latency=0.01 sampling
+if __name__ == "__main__":
+    runs: list[tuple[str, dict]] = []
+    for arg in sys.argv[1:]:
+        if "=" in arg and runs:
+            key, value = arg.split("=", 1)
+            runs[-1][1][key] = literal_eval(value)
+        else:
+            runs.append((arg, {}))
+    sys.argv = sys.argv[:1]  # the chat prompt appends command line arguments
+    for name, kwargs in runs or [(name, {}) for name in BENCHMARKS]:
+        BENCHMARKS[name](**kwargs)
+        print()
@@ -0,0 +1,23 @@
+# SPDX-License-Identifier: MIT
+import sys
+
+import pytest
+
+from tests import _helpers, fake_llama_cpp
+
+# before anything imports llama_cpp
+fake_llama_cpp.install()
+sys.argv = sys.argv[:1]  # the chat prompt appends command line arguments
+
+
+@pytest.fixture(autouse=True)
+def fake_config():
+    config = fake_llama_cpp.config
+    fake_llama_cpp.config = fake_llama_cpp.FakeConfig()
+    yield fake_llama_cpp.config
+    fake_llama_cpp.config = config
+
+
+@pytest.fixture
+def interact():
+    return _helpers.interact
@@ -0,0 +1,431 @@
+"""
+Deterministic in-process stand-in for the parts of llama_cpp used by LLaMAInteract.
+
+Used by the tests and by the benchmarks in tests/bench.py, so the hot loop can be measured without a real model.
+Call install() before importing low_level_api_chat_cpp to make `import llama_cpp` resolve to this module.
+
+Behaviour:
+ * Tokens 3..258 are single bytes (token = byte + 3, so "\\n" is 13 like LLaMA), higher ids are short words
+ * Logits depend only on the evaluated token history, so the same sequence always gives the same logits
+   no matter how it was split across llama_eval calls
+ * `config.eval_latency` / `config.token_latency` add a fixed sleep per llama_eval call / per evaluated token,
+   and each context adds up the time its evals took (the model's share of the work) in t_eval
+ * `config.noise` / `config.latency_scale` give a model path noisier logits (a draft model that mostly agrees)
+   and faster evals (a smaller model)
+ * The mirostat samplers update the target surprise behind their mu pointer like llama.cpp does
+"""
+import ctypes
+import json
+import sys
+from ctypes import c_bool, c_float, c_int, c_size_t, POINTER
+from dataclasses import dataclass, field
+from time import perf_counter, sleep
+
+import numpy as np
+
+llama_token = c_int
+
+BYTE_OFFSET = 3
+_WORDS = [b" the", b" and", b" of", b" to", b" is", b" cat", b" blue", b" time", b" year", b" it"]
+
+
+@dataclass
+class FakeConfig:
+    n_vocab: int = 32000
+    eval_latency: float = 0.0  # seconds per llama_eval call
+    token_latency: float = 0.0  # seconds per evaluated token
+    noise: dict[str, float] = field(default_factory=dict)  # model path -> stddev of extra logit noise
+    latency_scale: dict[str, float] = field(default_factory=dict)  # model path -> factor on the latencies
+
+
+config = FakeConfig()
+
+
+class llama_token_data(ctypes.Structure):
+    _fields_ = [("id", llama_token), ("logit", c_float), ("p", c_float)]
+
+
+class llama_token_data_array(ctypes.Structure):
+    _fields_ = [("data", POINTER(llama_token_data)), ("size", c_size_t), ("sorted", c_bool)]
+
+
+class llama_context_params:
+    def __init__(self):
+        self.n_ctx = 512
+        self.n_threads = 4
+        self.n_parts = -1
+        self.seed = 0
+        self.memory_f16 = True
+        self.use_mlock = False
+        self.use_mmap = True
+        self.n_gpu_layers = 0
+        self.low_vram = False
+        self.logits_all = False
+
+
+# Weights, loaded once and shared by the contexts made with llama_new_context_with_model
+class FakeModel:
+    n_loads = 0
+    n_frees = 0
+
+    def __init__(self, path: str, params: llama_context_params):
+        self.path = path
+        self.n_gpu_layers = params.n_gpu_layers
+        FakeModel.n_loads += 1
+
+
+class FakeContext:
+    def __init__(self, model: FakeModel, params: llama_context_params):
+        self.weights = model
+        self.model = model.path
+        self.n_ctx = params.n_ctx
+        self.n_vocab = config.n_vocab
+        self.rng = np.random.default_rng(params.seed)
+        self.kv: list[int] = []
+        self.kv_hash: list[int] = []
+        self.logits_all = params.logits_all  # a row of logits for every token of the last llama_eval
+        self.logits = (c_float * self.n_vocab)()
+        self.n_eval_calls = 0
+        self.n_eval_tokens = 0
+        self.max_eval_batch = 0
+        self.t_eval = 0.0
+
+        # Favour printable ascii so generations look like text
+        bias = np.zeros(self.n_vocab, dtype=np.float32)
+        bias[BYTE_OFFSET + 32 : BYTE_OFFSET + 127] = 4.0
+        bias[llama_token_eos()] = -8.0
+        self.bias = bias
+
+
+llama_context_p = FakeContext
+llama_model_p = FakeModel
+
+
+def install():
+    sys.modules["llama_cpp"] = sys.modules[__name__]
+
+
+def _value(x):
+    return getattr(x, "value", x)
+
+
+_TOKEN_DATA = np.dtype([("id", np.intc), ("logit", np.float32), ("p", np.float32)])
+
+
+# Structured view of a llama_token_data pointer, without numpy parsing the ctypes format on every call
+def _token_data(data, n: int) -> np.ndarray:
+    address = ctypes.cast(data, ctypes.c_void_p).value
+    return np.frombuffer((ctypes.c_char * (n * _TOKEN_DATA.itemsize)).from_address(address), dtype=_TOKEN_DATA)
+
+
+def _candidates(candidates_p) -> np.ndarray:
+    arr = candidates_p.contents
+    return _token_data(arr.data, arr.size)
+
+
+def _set_candidates(candidates_p, cand: np.ndarray, is_sorted: bool):
+    arr = candidates_p.contents
+    view = _token_data(arr.data, arr.size)
+    view[: len(cand)] = cand
+    arr.size = len(cand)
+    arr.sorted = is_sorted
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    p = np.exp(logits - logits.max())
+    return p / p.sum()
+
+
+# Model and context
+
+
+def llama_context_default_params() -> llama_context_params:
+    return llama_context_params()
+
+
+def llama_init_from_file(path_model: bytes, params: llama_context_params) -> FakeContext:
+    return FakeContext(FakeModel(path_model.decode("utf8"), params), params)
+
+
+def llama_load_model_from_file(path_model: bytes, params: llama_context_params) -> FakeModel:
+    return FakeModel(path_model.decode("utf8"), params)
+
+
+def llama_new_context_with_model(model: FakeModel, params: llama_context_params) -> FakeContext:
+    return FakeContext(model, params)
+
+
+def llama_free(ctx: FakeContext):
+    pass
+
+
+def llama_free_model(model: FakeModel):
+    FakeModel.n_frees += 1
+
+
+def llama_apply_lora_from_file(ctx, path_lora, path_base_model, n_threads) -> int:
+    return 0
+
+
+def llama_print_system_info() -> bytes:
+    return b"FAKE = 1"
+
+
+def llama_print_timings(ctx: FakeContext):
+    print(f"fake eval: {ctx.n_eval_calls} calls, {ctx.n_eval_tokens} tokens", file=sys.stderr)
+
+
+def llama_n_ctx(ctx: FakeContext) -> int:
+    return ctx.n_ctx
+
+
+def llama_n_vocab(ctx: FakeContext) -> int:
+    return ctx.n_vocab
+
+
+def llama_token_bos() -> int:
+    return 1
+
+
+def llama_token_eos() -> int:
+    return 2
+
+
+def llama_token_nl() -> int:
+    return BYTE_OFFSET + ord("\n")
+
+
+# Tokenizer
+
+
+def llama_tokenize(ctx: FakeContext, text: bytes, tokens, n_max_tokens: int, add_bos: bool) -> int:
+    ids = ([llama_token_bos()] if add_bos else []) + [b + BYTE_OFFSET for b in text]
+    if len(ids) > n_max_tokens:
+        return -len(ids)
+    for i, id in enumerate(ids):
+        tokens[i] = id
+    return len(ids)
+
+
+def llama_token_to_str(ctx: FakeContext, token: int) -> bytes:
+    if token < BYTE_OFFSET:
+        return b""
+    if token < BYTE_OFFSET + 256:
+        return bytes([token - BYTE_OFFSET])
+    return _WORDS[token % len(_WORDS)]
+
+
+# Evaluation
+
+
+def _append(kv: list[int], kv_hash: list[int], token: int) -> int:
+    h = ((kv_hash[-1] if kv_hash else 0) * 1000003 + token + 1) & 0xFFFFFFFF
+    kv.append(token)
+    kv_hash.append(h)
+    return h
+
+
+def _logits(ctx: FakeContext, h: int) -> np.ndarray:
+    logits = np.random.default_rng(h).standard_normal(ctx.n_vocab, dtype=np.float32)
+    logits += ctx.bias
+    if noise := config.noise.get(ctx.model):
+        logits += noise * np.random.default_rng(h + 1).standard_normal(ctx.n_vocab, dtype=np.float32)
+    return logits
+
+
+def _forward(ctx: FakeContext, tokens, n_tokens: int, n_past: int, logits_all: bool = False):
+    del ctx.kv[n_past:]
+    del ctx.kv_hash[n_past:]
+    h = ctx.kv_hash[-1] if ctx.kv_hash else 0
+    if logits_all and len(ctx.logits) < n_tokens * ctx.n_vocab:
+        ctx.logits = (c_float * (n_tokens * ctx.n_vocab))()
+    rows = np.ctypeslib.as_array(ctx.logits)
+    for i in range(n_tokens):
+        h = _append(ctx.kv, ctx.kv_hash, tokens[i])
+        if logits_all:
+            rows[i * ctx.n_vocab : (i + 1) * ctx.n_vocab] = _logits(ctx, h)
+    if not logits_all:
+        rows[: ctx.n_vocab] = _logits(ctx, h)
+
+
+# Time spent on the device for one eval of n_tokens
+def _compute(ctx: FakeContext, n_tokens: int):
+    ctx.n_eval_calls += 1
+    ctx.n_eval_tokens += n_tokens
+    ctx.max_eval_batch = max(ctx.max_eval_batch, n_tokens)
+    if config.eval_latency or config.token_latency:
+        sleep((config.eval_latency + config.token_latency * n_tokens) * config.latency_scale.get(ctx.model, 1.0))
+
+
+def llama_eval(ctx: FakeContext, tokens, n_tokens: int, n_past: int, n_threads: int) -> int:
+    if n_past > len(ctx.kv) or n_past + n_tokens > ctx.n_ctx:
+        return 1
+
+    start = perf_counter()
+    _forward(ctx, tokens, n_tokens, n_past, ctx.logits_all)
+    _compute(ctx, n_tokens)
+    ctx.t_eval += perf_counter() - start
+    return 0
+
+
+# A bare pointer like the C function returns, casting the array itself would keep every pointer alive in it
+def llama_get_logits(ctx: FakeContext):
+    return ctypes.cast(ctypes.addressof(ctx.logits), POINTER(c_float))
+
+
+# Sessions
+
+
+def llama_save_session_file(ctx: FakeContext, path_session: bytes, tokens, n_token_count: int) -> int:
+    with open(path_session, "w") as f:
+        json.dump({"model": ctx.model, "n_ctx": ctx.n_ctx, "kv": ctx.kv, "tokens": list(tokens[:n_token_count])}, f)
+    return 1
+
+
+def llama_load_session_file(ctx: FakeContext, path_session: bytes, tokens_out, n_token_capacity, n_token_count_out):
+    try:
+        with open(path_session) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if session["n_ctx"] != ctx.n_ctx or len(session["tokens"]) > n_token_capacity:
+        return 0
+    _forward(ctx, session["kv"], len(session["kv"]), 0)
+    for i, id in enumerate(session["tokens"]):
+        tokens_out[i] = id
+    n_token_count_out._obj.value = len(session["tokens"])
+    return 1
+
+
+# State
+
+
+def llama_get_state_size(ctx: FakeContext) -> int:
+    return 1024 + 16 * ctx.n_ctx
+
+
+def llama_copy_state_data(ctx: FakeContext, dst) -> int:
+    data = json.dumps({"kv": ctx.kv, "rng": ctx.rng.bit_generator.state}).encode("utf8")
+    ctypes.memmove(dst, data, len(data))
+    return len(data)
+
+
+def llama_set_state_data(ctx: FakeContext, src) -> int:
+    state = json.loads(bytes(src))
+    _forward(ctx, state["kv"], len(state["kv"]), 0)
+    ctx.rng.bit_generator.state = state["rng"]
+    return len(src)
+
+
+# Sampling
+
+
+def llama_sample_repetition_penalty(ctx, candidates_p, last_tokens_data, last_tokens_size, penalty):
+    penalty = _value(penalty)
+    if last_tokens_size == 0 or penalty == 1.0:
+        return
+    cand = _candidates(candidates_p)
+    last = np.unique(np.ctypeslib.as_array(last_tokens_data, shape=(_value(last_tokens_size),)))
+    hit = np.isin(cand["id"], last)
+    logit = cand["logit"]
+    logit[hit] = np.where(logit[hit] <= 0, logit[hit] * penalty, logit[hit] / penalty)
+    candidates_p.contents.sorted = False
+
+
+def llama_sample_frequency_and_presence_penalties(
+    ctx, candidates_p, last_tokens_data, last_tokens_size, alpha_frequency, alpha_presence
+):
+    alpha_frequency, alpha_presence = _value(alpha_frequency), _value(alpha_presence)
+    if last_tokens_size == 0 or (alpha_frequency == 0.0 and alpha_presence == 0.0):
+        return
+    cand = _candidates(candidates_p)
+    last = np.ctypeslib.as_array(last_tokens_data, shape=(_value(last_tokens_size),))
+    ids, counts = np.unique(last, return_counts=True)
+    pos = np.searchsorted(ids, cand["id"]).clip(max=len(ids) - 1)
+    count = np.where(ids[pos] == cand["id"], counts[pos], 0)
+    # in float like llama.cpp
+    cand["logit"] -= count.astype(np.float32) * np.float32(alpha_frequency) + (count > 0) * np.float32(alpha_presence)
+    candidates_p.contents.sorted = False
+
+
+def llama_sample_softmax(ctx, candidates_p):
+    cand = _candidates(candidates_p)
+    cand = cand[np.argsort(-cand["logit"], kind="stable")]
+    cand["p"] = _softmax(cand["logit"])
+    _set_candidates(candidates_p, cand, True)
+
+
+def llama_sample_top_k(ctx, candidates_p, k, min_keep=1):
+    k = max(_value(k), _value(min_keep))
+    cand = _candidates(candidates_p)
+    k = min(k, len(cand))
+    # partial sort like llama.cpp, only the top k are ordered
+    top = np.argpartition(-cand["logit"], k - 1)[:k] if k < len(cand) else np.arange(len(cand))
+    cand = cand[top[np.argsort(-cand["logit"][top], kind="stable")]]
+    _set_candidates(candidates_p, cand, True)
+
+
+def llama_sample_tail_free(ctx, candidates_p, z, min_keep=1):
+    # Only the disabled (z >= 1.0) case is used by the bot
+    pass
+
+
+def llama_sample_typical(ctx, candidates_p, p, min_keep=1):
+    # Only the disabled (p >= 1.0) case is used by the bot
+    pass
+
+
+def llama_sample_top_p(ctx, candidates_p, p, min_keep=1):
+    p, min_keep = _value(p), _value(min_keep)
+    if p >= 1.0:
+        return
+    llama_sample_softmax(ctx, candidates_p)
+    cand = _candidates(candidates_p)
+    last = max(int(np.searchsorted(np.cumsum(cand["p"]), p)) + 1, min_keep)
+    _set_candidates(candidates_p, cand[:last].copy(), True)
+
+
+def llama_sample_temperature(ctx, candidates_p, temp):
+    _candidates(candidates_p)["logit"] /= _value(temp)
+
+
+def llama_sample_token_greedy(ctx, candidates_p) -> int:
+    cand = _candidates(candidates_p)
+    return int(cand["id"][np.argmax(cand["logit"])])
+
+
+def llama_sample_token(ctx, candidates_p) -> int:
+    llama_sample_softmax(ctx, candidates_p)
+    cand = _candidates(candidates_p)
+    return int(cand["id"][ctx.rng.choice(len(cand), p=cand["p"] / cand["p"].sum())])
+
+
+# Mirostat as in llama.cpp: truncate by the target surprise mu, sample, then move mu towards tau.
+# mu is a pointer to a c_float that carries over between tokens.
+def _mirostat_update(ctx, candidates_p, tau, eta, mu) -> int:
+    token = llama_sample_token(ctx, candidates_p)
+    cand = _candidates(candidates_p)
+    surprise = -np.log2(cand["p"][np.flatnonzero(cand["id"] == token)[0]])
+    mu.contents.value -= _value(eta) * (surprise - _value(tau))
+    return token
+
+
+def llama_sample_token_mirostat(ctx, candidates_p, tau, eta, m, mu) -> int:
+    llama_sample_softmax(ctx, candidates_p)
+    p = _candidates(candidates_p)["p"].astype(np.float64)
+    n = min(_value(m) - 1, len(p) - 1)
+    t = np.log(np.arange(2, n + 2) / np.arange(1, n + 1))
+    s_hat = np.dot(t, np.log(p[:n] / p[1 : n + 1])) / np.dot(t, t)
+    epsilon_hat = s_hat - 1
+    k = ((epsilon_hat * 2 ** mu.contents.value) / (1 - len(p) ** -epsilon_hat)) ** (1 / s_hat)
+    llama_sample_top_k(ctx, candidates_p, int(min(k, len(p))), 1)
+    return _mirostat_update(ctx, candidates_p, tau, eta, mu)
+
+
+def llama_sample_token_mirostat_v2(ctx, candidates_p, tau, eta, mu) -> int:
+    llama_sample_softmax(ctx, candidates_p)
+    cand = _candidates(candidates_p)
+    # the candidates are sorted, so the surprise only grows
+    keep = max(int(np.searchsorted(-np.log2(cand["p"]), mu.contents.value, side="right")), 1)
+    _set_candidates(candidates_p, cand[:keep].copy(), True)
+    return _mirostat_update(ctx, candidates_p, tau, eta, mu)
@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: MIT
+"""
+Models for alfbote.workers.ProcessWorker to host in tests, e.g. "tests.fake_worker:LoadTest".
+"""
+import os
+
+
+class LoadTest:
+    def tokens(self, n: int, work: int = 200_000):
+        for i in range(n):
+            sum(range(work))  # holds the GIL like inference that doesn't release it
+            yield i
+
+    def crash(self):
+        os._exit(1)
+
+
+# Llama2.pool on the fake backend, in the worker process
+def llama2_pool(*args, **kwargs) -> list:
+    from tests import fake_llama_cpp
+
+    fake_llama_cpp.install()
+    from alfbote.llamacpp.chat import Llama2
+
+    return Llama2.pool(*args, **kwargs)
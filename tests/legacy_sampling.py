@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: MIT
+"""
+The sampling chain LLaMAInteract.generate used before SamplerPipeline, kept to check the pipeline against it
+and to benchmark it. Call fake_llama_cpp.install() first.
+"""
+import ctypes
+
+import llama_cpp
+import numpy as np
+
+from alfbote.llamacpp.common import GptParams
+from alfbote.llamacpp.sampling import CandidateBuffer
+
+
+# Every candidate from the llama_get_logits pointer, with the logit bias
+def fill(candidates: CandidateBuffer, logits_ptr):
+    logits = np.ctypeslib.as_array(logits_ptr, shape=(candidates.n_vocab,))
+    candidates.view["id"] = candidates.token_ids
+    candidates.view["logit"] = logits
+    candidates.view["p"] = 0.0
+    if len(candidates.bias_ids) > 0:
+        candidates.view["logit"][candidates.bias_ids] += candidates.bias_values
+    candidates.array.size = candidates.n_vocab
+    candidates.array.sorted = False
+    return candidates.pointer
+
+
+# Penalties and sampling of one token with the full llama_sample_* chain.
+# mirostat_mu points to the target surprise that carries over between tokens.
+def sample(ctx, params: GptParams, candidates: CandidateBuffer, logits_ptr, last_n_tokens, n_ctx: int, mirostat_mu):
+    top_k = candidates.n_vocab if params.top_k <= 0 else params.top_k
+    repeat_last_n = n_ctx if params.repeat_last_n < 0 else params.repeat_last_n
+    candidates_p = fill(candidates, logits_ptr)
+
+    nl = llama_cpp.llama_token_nl()
+    nl_logit = float(candidates.view["logit"][nl])
+    last_n_repeat = min(len(last_n_tokens), repeat_last_n, n_ctx)
+    _last = last_n_tokens.tail(last_n_repeat)
+    _arr = _last.ctypes.data_as(ctypes.POINTER(llama_cpp.llama_token))
+    llama_cpp.llama_sample_repetition_penalty(
+        ctx, candidates_p, _arr, last_n_repeat, llama_cpp.c_float(params.repeat_penalty)
+    )
+    llama_cpp.llama_sample_frequency_and_presence_penalties(
+        ctx,
+        candidates_p,
+        _arr,
+        last_n_repeat,
+        llama_cpp.c_float(params.frequency_penalty),
+        llama_cpp.c_float(params.presence_penalty),
+    )
+    if not params.penalize_nl:
+        # nothing has reordered the buffer yet
+        candidates.view["logit"][nl] = nl_logit
+
+    tau, eta = llama_cpp.c_float(params.mirostat_tau), llama_cpp.c_float(params.mirostat_eta)
+    if params.temp <= 0:
+        return llama_cpp.llama_sample_token_greedy(ctx, candidates_p)
+    if params.mirostat == 1:
+        llama_cpp.llama_sample_temperature(ctx, candidates_p, llama_cpp.c_float(params.temp))
+        return llama_cpp.llama_sample_token_mirostat(ctx, candidates_p, tau, eta, llama_cpp.c_int(100), mirostat_mu)
+    if params.mirostat == 2:
+        llama_cpp.llama_sample_temperature(ctx, candidates_p, llama_cpp.c_float(params.temp))
+        return llama_cpp.llama_sample_token_mirostat_v2(ctx, candidates_p, tau, eta, mirostat_mu)
+    min_keep = llama_cpp.c_size_t(1)
+    llama_cpp.llama_sample_top_k(ctx, candidates_p, top_k, min_keep=min_keep)
+    llama_cpp.llama_sample_tail_free(ctx, candidates_p, llama_cpp.c_float(params.tfs_z), min_keep=min_keep)
+    llama_cpp.llama_sample_typical(ctx, candidates_p, llama_cpp.c_float(params.typical_p), min_keep=min_keep)
+    llama_cpp.llama_sample_top_p(ctx, candidates_p, llama_cpp.c_float(params.top_p), min_keep=min_keep)
+    llama_cpp.llama_sample_temperature(ctx, candidates_p, llama_cpp.c_float(params.temp))
+    return llama_cpp.llama_sample_token(ctx, candidates_p)
@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: MIT
+import pytest
+
+from alfbote.llamacpp.context import ContextPolicy, HalfContext, TurnWindow
+
+PROMPT = "Transcript of a dialog.\nuser:"
+HISTORY = " one\nalfbote: A.\nuser: two\nalfbote: B.\nuser: three\nalfbote: C.\n"
+
+
+def _kept(m, policy, budget: int) -> str:
+    history = m._tokenize(HISTORY, False)
+    n = policy.keep(m, history, budget)
+    return m.vocab.detokenize(history[len(history) - n :]).decode("utf8")
+
+
+def test_policy_is_abstract():
+    with pytest.raises(TypeError):
+        ContextPolicy()
+
+
+def test_half_context_keeps_the_newer_half(interact):
+    m = interact(prompt=PROMPT)
+    assert _kept(m, HalfContext(), 1000) == HISTORY[len(HISTORY) - len(HISTORY) // 2 :]
+
+
+def test_turn_window_keeps_whole_turns(interact):
+    m = interact(prompt=PROMPT)
+    assert _kept(m, TurnWindow(max_turns=2), 1000) == " two\nalfbote: B.\nuser: three\nalfbote: C.\n"
+    # the budget is halved so the reply has room, only the last turn fits
+    assert _kept(m, TurnWindow(max_turns=4), 2 * 30) == " three\nalfbote: C.\n"
+    # not even the last turn fits
+    assert _kept(m, TurnWindow(max_turns=4), 2 * 10) == "\nalfbote: C.\n"[-10:]
+
+
+def test_context_swap_keeps_the_prompt_and_starts_at_a_turn(interact):
+    m = interact(prompt=PROMPT, n_ctx=256, n_predict=32, n_keep=-1, context_policy=TurnWindow(max_turns=4))
+    m.prefill()
+    prompt = list(m.ctx.kv)
+    for i in range(20):
+        m.input(f" Tell me about the number {i}.\n")
+        for _ in m.output():
+            pass
+        if m.n_context_swaps > 0:
+            break
+    assert m.n_context_swaps == 1
+    assert m.params.n_keep == len(prompt) and m.ctx.kv[: len(prompt)] == prompt
+    # the prompt ends with the turn marker, the kept history continues right after one
+    kept = m.vocab.detokenize(m.ctx.kv[len(prompt) :]).decode("utf8")
+    assert kept.startswith(" Tell me about the number ")
+    assert len(m.ctx.kv) <= 256
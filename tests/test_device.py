@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+
+import pytest
+
+from alfbote.device import DeviceScheduler
+
+
+def _scheduler(moved: dict[str, asyncio.Event]) -> DeviceScheduler:
+    def mover(name: str):
+        async def place(on_device: bool):
+            if name in moved:
+                await moved[name].wait()
+
+        return place
+
+    # a and b start on the device, c has to move one of them off
+    scheduler = DeviceScheduler(capacity_mb=8000, hold=30.0)
+    scheduler.register("a", 3000, mover("a"), cpu_fallback=True)
+    scheduler.register("b", 4000, mover("b"))
+    scheduler.register("c", 4000, mover("c"))
+    return scheduler
+
+
+async def _reserve(scheduler: DeviceScheduler, name: str) -> bool:
+    async with scheduler.reserve(name) as on_device:
+        return on_device
+
+
+def test_device_only_tenant_moves_the_least_recently_used_off():
+    async def main():
+        scheduler = _scheduler({})
+        assert await _reserve(scheduler, "c")
+        assert scheduler.stats()["a"]["on_device"] is False
+        assert scheduler.stats()["b"]["on_device"] is True
+        assert scheduler.resident_mb == 8000
+
+    asyncio.run(main())
+
+
+def test_reservations_go_on_while_a_model_moves():
+    async def main():
+        moved = {"a": asyncio.Event()}
+        scheduler = _scheduler(moved)
+        c = asyncio.create_task(_reserve(scheduler, "c"))
+        await asyncio.sleep(0.01)
+        assert not c.done() and scheduler.tenants["a"].moving
+
+        # b isn't moving, it is reserved without waiting for a's move
+        assert await asyncio.wait_for(_reserve(scheduler, "b"), 1.0)
+        # a is, its next reservation waits for the move and then runs off the device
+        a = asyncio.create_task(_reserve(scheduler, "a"))
+        await asyncio.sleep(0.01)
+        assert not a.done()
+
+        moved["a"].set()
+        assert await c
+        assert await a is False
+        assert not any(tenant.moving for tenant in scheduler.tenants.values())
+
+    asyncio.run(main())
+
+
+def test_a_failed_move_leaves_the_scheduler_usable():
+    async def main():
+        scheduler = _scheduler({})
+
+        async def fail(on_device: bool):
+            raise RuntimeError("out of memory")
+
+        scheduler.tenants["c"].place = fail
+        with pytest.raises(RuntimeError):
+            await _reserve(scheduler, "c")
+        assert not scheduler.tenants["c"].on_device and not scheduler.tenants["c"].moving
+        assert await asyncio.wait_for(_reserve(scheduler, "b"), 1.0)
+
+    asyncio.run(main())
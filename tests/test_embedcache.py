@@ -0,0 +1,37 @@
+# SPDX-License-Identifier: MIT
+from alfbote.embedcache import EmbeddingCache
+
+
+class Encoder:
+    def __init__(self):
+        self.calls: list[list[str]] = []
+
+    def __call__(self, texts: list[str]) -> list[str]:
+        self.calls.append(texts)
+        return [f"embedding of {text}" for text in texts]
+
+
+def test_missing_texts_are_encoded_together_once():
+    cache, encode = EmbeddingCache(), Encoder()
+    embeddings = cache.lookup(["A  cat", "a dog", "a cat"], encode)
+    assert embeddings == ["embedding of a cat", "embedding of a dog", "embedding of a cat"]
+    assert encode.calls == [["a cat", "a dog"]]
+    # case and spacing don't matter to the tokenizer, so they don't to the cache
+    assert cache.lookup(["A DOG"], encode) == ["embedding of a dog"]
+    assert len(encode.calls) == 1
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_least_recently_used_is_evicted():
+    cache, encode = EmbeddingCache(max_entries=2), Encoder()
+    cache.lookup(["a", "b"], encode)
+    cache.lookup(["a"], encode)
+    cache.lookup(["c"], encode)
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_zero_entries_caches_nothing():
+    cache, encode = EmbeddingCache(max_entries=0), Encoder()
+    cache.lookup(["a"], encode)
+    cache.lookup(["a"], encode)
+    assert len(cache) == 0 and len(encode.calls) == 2
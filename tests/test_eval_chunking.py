@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: MIT
+import llama_cpp
+import numpy as np
+import pytest
+
+N_BATCHES = (4096, 512, 64, 7)
+
+
+def _logits(m) -> np.ndarray:
+    return np.ctypeslib.as_array(llama_cpp.llama_get_logits(m.ctx), shape=(m.n_vocab,)).copy()
+
+
+def _prefill(interact, n_batch: int):
+    m = interact(n_batch=n_batch)
+    m._eval(m.embd_inp)
+    return m
+
+
+@pytest.mark.parametrize("n_batch", N_BATCHES[1:])
+def test_chunked_prefill_matches_single_shot(interact, n_batch):
+    single = _prefill(interact, N_BATCHES[0])
+    chunked = _prefill(interact, n_batch)
+    assert single.ctx.n_eval_calls == 1
+    assert chunked.ctx.max_eval_batch <= n_batch
+    assert chunked.n_past == len(chunked.embd_inp)
+    assert np.array_equal(_logits(single), _logits(chunked))
+
+
+def test_chunking_keeps_the_generated_text(interact):
+    outputs = set()
+    for n_batch in N_BATCHES:
+        m = interact(n_batch=n_batch)
+        prompt = "".join(m.output())
+        m.input(" Hello there\n")
+        outputs.add(prompt + "".join(m.output()))
+    assert len(outputs) == 1
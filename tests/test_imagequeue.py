@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+
+import pytest
+
+from alfbote.imagequeue import ImageQueue
+
+
+def _pipeline(batches: list[list[str]], gate: asyncio.Event | None = None):
+    async def run_batch(batch):
+        batches.append([request.prompt for request in batch])
+        if gate is not None:
+            await gate.wait()
+        await asyncio.sleep(0.01)
+        return [f"{request.prompt} {request.seed}" for request in batch]
+
+    return run_batch
+
+
+@pytest.mark.parametrize("max_batch", (1, 2, 4, 8))
+def test_every_requester_gets_their_own_image(max_batch):
+    async def main():
+        batches = []
+        queue = ImageQueue(_pipeline(batches), max_batch=max_batch, max_depth=16, max_per_user=16)
+        requests = [queue.submit(i % 3, f"prompt {i}", seed=i) for i in range(12)]
+        assert [await request.result() for request in requests] == [f"prompt {i} {i}" for i in range(12)]
+        assert max(map(len, batches)) <= max_batch
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_requests_queued_during_a_batch_make_up_the_next():
+    async def main():
+        batches, gate = [], asyncio.Event()
+        queue = ImageQueue(_pipeline(batches, gate), max_batch=4, max_depth=16, max_per_user=16)
+        first = queue.submit("a", "alone")
+        await asyncio.sleep(0)  # an idle queue starts right away
+        assert batches == [["alone"]]
+        requests = [queue.submit("b", f"prompt {i}") for i in range(5)]
+        long = queue.submit("c", "long", iterations=50)
+        gate.set()
+        await asyncio.gather(first.result(), long.result(), *(request.result() for request in requests))
+        # oldest first, and only requests with the same number of iterations share a call
+        assert batches == [["alone"], ["prompt 0", "prompt 1", "prompt 2", "prompt 3"], ["prompt 4"], ["long"]]
+        assert queue.stats()["images"] == 7
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_memory_budget_limits_the_batch():
+    async def run_batch(batch):
+        return []
+
+    assert ImageQueue(run_batch, max_batch=8, memory_budget=3.0, image_memory=1.0).max_batch == 3
+    assert ImageQueue(run_batch, max_batch=8, memory_budget=0.5, image_memory=1.0).max_batch == 1
+
+
+def test_rejects_and_cancels():
+    async def main():
+        batches, gate = [], asyncio.Event()
+        queue = ImageQueue(_pipeline(batches, gate), max_depth=3, max_per_user=2)
+        running = queue.submit("a", "running")
+        await asyncio.sleep(0)
+        queued = [queue.submit("a", "a1"), queue.submit("a", "a2")]
+        assert queue.submit("a", "a3") is None  # a's share is full
+        assert queue.submit("b", "b1") is not None
+        assert queue.submit("c", "c1") is None  # the queue is full
+        assert queue.stats()["rejected"] == 2
+        queue.cancel(queued[0])
+        assert await queued[0].result() is None
+        gate.set()
+        await running.result()
+        assert await queued[1].result() == f"a2 {queued[1].seed}"
+        assert not any("a1" in batch for batch in batches)
+        queue.close()
+
+    asyncio.run(main())
+
+
+def test_a_failed_batch_fails_its_requests():
+    async def main():
+        async def run_batch(batch):
+            raise RuntimeError("out of memory")
+
+        queue = ImageQueue(run_batch)
+        request = queue.submit("a", "prompt")
+        with pytest.raises(RuntimeError):
+            await request.result()
+        # the worker keeps going
+        assert queue.worker is not None and not queue.worker.done()
+        queue.close()
+
+    asyncio.run(main())
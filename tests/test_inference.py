@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from alfbote.chatgen import MyView
+from alfbote.inference import InferenceWorker
+
+
+def _press_stop(view: MyView):
+    async def edit_message(**kwargs):
+        pass
+
+    view.message = SimpleNamespace(content="reply")
+    return view.children[0].callback(SimpleNamespace(response=SimpleNamespace(edit_message=edit_message)))
+
+
+def test_tokens_stream_in_order(interact):
+    async def main():
+        m = interact(n_predict=16, temp=0)
+        m.prefill()
+        m.input(" Hello.\n")
+        expected = "".join(m.output())
+
+        m = interact(n_predict=16, temp=0)
+        m.prefill()
+        m.input(" Hello.\n")
+        worker = InferenceWorker()
+        assert "".join([token async for token in worker.stream(m.output)]) == expected
+        worker.close()
+
+    asyncio.run(main())
+
+
+def test_stop_button_cancels_mid_stream(interact):
+    async def main():
+        m = interact(n_predict=-1)
+        m.prefill()
+        m.input(" Tell me a long story.\n")
+        closed = []
+
+        def generate():
+            try:
+                yield from m.output()
+            finally:
+                closed.append(threading.current_thread().name)
+
+        worker = InferenceWorker(name="test-inference")
+        stream = worker.stream(generate)
+        view = MyView()
+        view.on_stop = stream.cancel
+        n_tokens = 0
+        async for _ in stream:
+            n_tokens += 1
+            if n_tokens == 5:
+                await _press_stop(view)
+        # the worker checks between tokens, a few more may already be queued
+        assert view.stop_pressed and 5 <= n_tokens < 50
+        assert stream.closed and closed == ["test-inference"]
+        worker.close()
+
+    asyncio.run(main())
+
+
+def test_worker_errors_reach_the_stream():
+    async def main():
+        def generate():
+            yield "a"
+            yield "b"
+            raise RuntimeError("llama_eval failed")
+
+        worker = InferenceWorker()
+        stream = worker.stream(generate)
+        tokens = []
+        with pytest.raises(RuntimeError, match="llama_eval failed"):
+            async for token in stream:
+                tokens.append(token)
+        assert tokens == ["a", "b"]
+        await stream.aclose()
+
+        # one that fails before producing anything, then the worker carries on with the next job
+        stream = worker.stream(lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            await stream.__anext__()
+        assert [token async for token in worker.stream(lambda: iter("ok"))] == ["o", "k"]
+        worker.close()
+
+    asyncio.run(main())
+
+
+def test_cancelled_before_it_starts_never_runs():
+    async def main():
+        worker = InferenceWorker()
+        gate = threading.Event()
+        first = worker.stream(lambda: iter([gate.wait(5)]))
+        ran = []
+        second = worker.stream(lambda: ran.append(True) or iter(()))
+        second.cancel()
+        gate.set()
+        assert [token async for token in first] == [True]
+        assert [token async for token in second] == [] and not ran
+        worker.close()
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+import threading
+
+import pytest
+
+from alfbote.lazy import LazyModel
+
+
+def test_requests_wait_for_one_background_load():
+    async def main():
+        loaded = threading.Event()
+
+        def load() -> str:
+            loaded.wait(5)
+            return "model"
+
+        model = LazyModel("test_wait", load)
+        assert model.start() is model.start()
+        assert model.state == "loading" and model.warming_up
+
+        async def use() -> str:
+            async with model.use() as m:
+                return m
+
+        requests = [asyncio.create_task(use()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert not any(request.done() for request in requests)
+        loaded.set()
+        assert await asyncio.gather(*requests) == ["model"] * 3
+        assert model.state == "ready" and model.n_loads == 1
+
+    asyncio.run(main())
+
+
+def test_drop_unloads_and_the_next_use_loads_again():
+    async def main():
+        unloaded = []
+        model = LazyModel("test_drop", lambda: object(), unloaded.append)
+        async with model.use() as first:
+            pass
+        await model.drop()
+        assert model.state == "unloaded" and unloaded == [first]
+        async with model.use() as second:
+            assert second is not first
+        assert model.n_loads == 2 and model.n_unloads == 1
+
+    asyncio.run(main())
+
+
+def test_failed_load_is_retried_by_the_next_request():
+    async def main():
+        attempts = []
+
+        def load() -> str:
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise OSError("model file missing")
+            return "model"
+
+        model = LazyModel("test_retry", load)
+        with pytest.raises(OSError):
+            await model.get()
+        await asyncio.sleep(0)
+        assert model.state == "unloaded"
+        assert await model.get() == "model"
+
+    asyncio.run(main())
+
+
+def test_idle_model_is_unloaded():
+    async def main():
+        model = LazyModel("test_idle", lambda: "model", idle_unload=0.01)
+        async with model.use():
+            pass
+        # the idle check runs about once a second
+        for _ in range(30):
+            if model.state == "unloaded":
+                break
+            await asyncio.sleep(0.1)
+        assert model.state == "unloaded" and model.n_unloads == 1
+        model.unloader.cancel()
+
+    asyncio.run(main())
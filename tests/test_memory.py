@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: MIT
+import random
+
+from alfbote.memory import ReclaimPolicy
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_reclaims_above_the_watermark_only():
+    policy = ReclaimPolicy(watermark=0.85, clock=Clock())
+    assert policy.after_batch(used=60, total=100) is None
+    assert policy.after_batch(used=90, total=100) == "watermark"
+    assert policy.after_batch(used=90, total=0) is None
+
+
+def test_idle_reclaim_is_due_once_after_work():
+    clock = Clock()
+    policy = ReclaimPolicy(idle=120.0, clock=clock)
+    clock.now = 500.0
+    assert not policy.wants("idle")  # nothing cached yet
+    policy.after_batch(used=10, total=100)
+    clock.now += 119.0
+    assert not policy.wants("idle")
+    clock.now += 1.0
+    assert policy.wants("idle")
+    policy.reclaimed("idle")
+    assert not policy.wants("idle") and not policy.wants("handoff")
+    assert policy.n_reclaims == {"watermark": 0, "idle": 1, "handoff": 0}
+
+
+def test_handoff_only_after_new_work():
+    policy = ReclaimPolicy(clock=Clock())
+    assert not policy.wants("handoff")
+    policy.after_batch(used=10, total=100)
+    assert policy.wants("handoff")
+    policy.reclaimed("handoff")
+    assert not policy.wants("handoff")
+
+
+# Simulated caching allocator: an image needs `blocks` blocks, cached blocks are reused for free and the rest
+# are allocated again. Requests come in bursts with long idle gaps now and then, and chat takes the device
+# before one in ten images. Emptying the cache after every image (the old torch_gc) against the policy.
+def _simulate(every_image: bool, n_images: int = 200, blocks: int = 40) -> tuple[float, dict]:
+    rng = random.Random(0)
+    clock = Clock()
+    policy = ReclaimPolicy(watermark=0.85, idle=120.0, clock=clock)
+    cache = n_requests = n_hits = 0
+    for _ in range(n_images):
+        clock.now += rng.choice((1.0, 1.0, 1.0, 300.0))
+        for reason in ("idle", "handoff") if rng.random() < 0.1 else ("idle",):
+            if policy.wants(reason):
+                cache = 0
+                policy.reclaimed(reason)
+
+        n_requests += blocks
+        n_hits += min(cache, blocks)
+        cache = blocks
+
+        # one image in flight fills 60% of the device, under the watermark
+        reason = policy.after_batch(used=60, total=100)
+        if every_image:
+            cache = 0
+            policy.cached = False
+        elif reason is not None:
+            cache = 0
+            policy.reclaimed(reason)
+    return n_hits / n_requests, policy.n_reclaims
+
+
+def test_policy_keeps_the_allocator_cache_warm():
+    hit_rate, _ = _simulate(every_image=True)
+    assert hit_rate == 0.0
+    hit_rate, n_reclaims = _simulate(every_image=False)
+    # every reclaim costs the next image its cache, the bursts between idle gaps and handoffs reuse it
+    assert hit_rate > 0.5
+    assert n_reclaims["watermark"] == 0 and 0 < n_reclaims["idle"] + n_reclaims["handoff"] < 100
+    assert hit_rate == 1 - (n_reclaims["idle"] + n_reclaims["handoff"] + 1) / 200
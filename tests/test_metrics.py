@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+
+from alfbote.metrics import Registry
+
+
+def _registry() -> Registry:
+    registry = Registry()
+    registry.enabled = True
+    return registry
+
+
+def test_disabled_observes_nothing():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test latency")
+    counter = registry.counter("test_total", "Test events")
+    with histogram.time():
+        counter.inc()
+    assert histogram.count == 0 and counter.value == 0
+
+
+def test_declaring_again_returns_the_same_metric():
+    registry = _registry()
+    assert registry.counter("test_total", "Test events") is registry.counter("test_total", "Test events")
+    # a gauge reads from its latest owner
+    registry.gauge("test_queue", "Test queue", lambda: 1)
+    registry.gauge("test_queue", "Test queue", lambda: 2)
+    assert "test_queue 2" in registry.render()
+
+
+def test_prometheus_text_format():
+    registry = _registry()
+    histogram = registry.histogram("test_seconds", "Test latency", buckets=(0.1, 1.0))
+    registry.counter("test_total", "Test events").inc(3)
+    registry.counter("test_labelled_total", "Test events by kind", ("kind",)).labels(kind="a").inc()
+    histogram.observe(0.05)
+    histogram.observe(0.5, n=2)
+    histogram.observe(5.0)
+    assert registry.render().splitlines() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 6.05",
+        "test_seconds_count 4",
+        "# HELP test_total Test events",
+        "# TYPE test_total counter",
+        "test_total 3",
+        "# HELP test_labelled_total Test events by kind",
+        "# TYPE test_labelled_total counter",
+        'test_labelled_total{kind="a"} 1',
+    ]
+    assert histogram.quantile(0.5) == 1.0 and histogram.quantile(1.0) == float("inf")
+
+
+def test_scrape_over_http():
+    async def main():
+        registry = _registry()
+        registry.counter("test_total", "Test events").inc()
+        await registry.serve(0)
+        port = registry.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+        registry.server.close()
+        return response
+
+    response = asyncio.run(main())
+    assert response.startswith("HTTP/1.0 200 OK")
+    assert response.split("\r\n\r\n", 1)[1] == "# HELP test_total Test events\n# TYPE test_total counter\ntest_total 1\n"
+
+
+def test_stats_message():
+    registry = _registry()
+    assert registry.stats_message() == "```\n\n```"
+    registry.histogram("test_seconds", "Test latency", buckets=(0.1, 1.0)).observe(0.5, n=2)
+    registry.counter("test_labelled_total", "Test events by kind", ("kind",)).labels(kind="a").inc()
+    registry.counter("test_total", "Test events")
+    assert registry.stats_message() == (
+        "```\n"
+        "test_seconds: n=2 mean=0.5 p50<=1 p95<=1\n"
+        'test_labelled_total: kind="a" 1\n'
+        "test_total: 0\n"
+        "```"
+    )
+    # cut to fit in a Discord message
+    for i in range(200):
+        registry.counter(f"test_{i}_total", "Test events")
+    message = registry.stats_message(max_len=100)
+    assert message.endswith("\n...\n```") and len(message) < 120
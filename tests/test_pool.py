@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+from types import SimpleNamespace
+
+from alfbote.pool import ModelPool
+
+
+def _pool(size: int) -> ModelPool:
+    models = [SimpleNamespace(name=i, session=None) for i in range(size)]
+    return ModelPool(models, affinity=lambda model: model.session)
+
+
+def test_request_goes_to_the_context_holding_its_conversation():
+    async def main():
+        pool = _pool(3)
+        pool.slots[1].model.session = "a"
+        pool.slots[2].model.session = "b"
+        async with pool.acquire("b") as slot:
+            assert slot.model.name == 2
+        async with pool.acquire("a") as slot:
+            assert slot.model.name == 1
+        pool.close()
+
+    asyncio.run(main())
+
+
+def test_otherwise_the_slot_idle_the_longest():
+    async def main():
+        pool = _pool(3)
+        picked = []
+        for _ in range(4):
+            async with pool.acquire("new") as slot:
+                picked.append(slot.model.name)
+        assert picked == [0, 1, 2, 0]
+        # its context is busy, so the conversation goes to a free one
+        pool.slots[0].model.session = "a"
+        async with pool.acquire("a") as first, pool.acquire("a") as second:
+            assert first.model.name == 0 and second is not first
+        assert pool.stats()["requests"] == 6
+        pool.close()
+
+    asyncio.run(main())
+
+
+def test_waits_while_every_slot_is_busy():
+    async def main():
+        pool = _pool(2)
+        release = asyncio.Event()
+        order = []
+
+        async def request(i: int):
+            async with pool.acquire() as slot:
+                order.append((i, slot.model.name))
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(order) == 2 and pool.stats()["busy"] == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert [i for i, _ in order] == [0, 1, 2] and pool.stats()["busy"] == 0
+        pool.close()
+
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: MIT
+from alfbote.llamacpp.common import GptParams
+from alfbote.llamacpp.prompt_cache import PromptCache
+from tests._helpers import PROMPT
+
+STATIC = PROMPT[: PROMPT.rindex("user: Question number 19?")]
+
+
+def _prompt(time: str) -> str:
+    return f"{STATIC}user: What time is it?\nalfbote: It is {time}.\nuser:"
+
+
+def test_key_ignores_the_end_after_the_static_prompt(tmp_path):
+    model = tmp_path / "model.bin"
+    model.write_bytes(b"weights")
+    cache = PromptCache(tmp_path / "cache")
+    early = GptParams(model=str(model), prompt=_prompt("12:00"))
+    late = GptParams(model=str(model), prompt=_prompt("12:01"))
+    assert cache.key(early) != cache.key(late)
+    assert cache.key(early, STATIC) == cache.key(late, STATIC)
+    assert cache.session_path(early, STATIC) == cache.session_path(late, STATIC)
+
+
+# A restart a minute later restores the cached prefix and only evaluates the time line.
+# The session file isn't rewritten for that, it still matches everything before the time.
+def test_restart_evaluates_only_the_changed_end(interact, tmp_path):
+    model = tmp_path / "model.bin"
+    model.write_bytes(b"weights")
+    cache = PromptCache(tmp_path / "cache")
+
+    def start(time: str):
+        params = GptParams(model=str(model), prompt=_prompt(time))
+        m = interact(model=None, prompt=params.prompt, path_session=cache.session_path(params, STATIC))
+        m.prefill()
+        return m
+
+    first = start("12:00")
+    assert first.ctx.n_eval_tokens == len(first.embd_inp)
+    for time in ("12:01", "12:02"):
+        m = start(time)
+        assert 0 < m.ctx.n_eval_tokens < 20
+        assert m.n_past == len(m.embd_inp)
+    assert len(list(cache.dir.glob("*.session"))) == 1
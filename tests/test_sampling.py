@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: MIT
+import ctypes
+
+import llama_cpp
+import numpy as np
+import pytest
+
+from alfbote.llamacpp import util
+from alfbote.llamacpp.common import GptParams
+from alfbote.llamacpp.sampling import CandidateBuffer, SamplerPipeline
+from tests import legacy_sampling
+
+N_CTX = 2048
+EOS = llama_cpp.llama_token_eos()
+
+PARAMS = {
+    "chat defaults": GptParams(temp=0.8, top_k=40, top_p=0.5, repeat_penalty=1.2, repeat_last_n=256),
+    "greedy": GptParams(temp=0, repeat_penalty=1.2, repeat_last_n=256),
+    "GptParams defaults": GptParams(),
+    "penalties, no nl, logit bias": GptParams(
+        frequency_penalty=0.5, presence_penalty=0.3, penalize_nl=False, logit_bias={EOS: -float("inf")}
+    ),
+    "whole vocab, temp 1": GptParams(top_k=0, top_p=1.0, temp=1.0, repeat_penalty=1.0),
+    "mirostat": GptParams(mirostat=1),
+    "mirostat 2": GptParams(mirostat=2),
+}
+
+
+def _context():
+    lparams = llama_cpp.llama_context_default_params()
+    lparams.seed = 1
+    return llama_cpp.llama_init_from_file(b"fake", lparams)
+
+
+# Pointers to rows of random logits, and the array that owns them
+def _logits(n_tokens: int, n_vocab: int) -> tuple[list, np.ndarray]:
+    logits = np.random.default_rng(0).standard_normal((n_tokens, n_vocab), dtype=np.float32)
+    return [row.ctypes.data_as(ctypes.POINTER(ctypes.c_float)) for row in logits], logits
+
+
+# For the same seed the pipeline picks the tokens the full llama_sample_* chain picks
+@pytest.mark.parametrize("name", PARAMS)
+def test_pipeline_matches_the_sampling_chain(fake_config, name):
+    params = PARAMS[name]
+    fake_config.n_vocab = 2000
+    logits_ptrs, _rows = _logits(200, fake_config.n_vocab)
+    legacy_ctx, ctx = _context(), _context()
+    candidates = CandidateBuffer(fake_config.n_vocab, params.logit_bias)
+    mirostat_mu = ctypes.pointer(llama_cpp.c_float(2.0 * params.mirostat_tau))
+    sampler = SamplerPipeline(params, fake_config.n_vocab, N_CTX)
+    last_n_tokens = util.Circle(N_CTX)
+    last_n_tokens.extend([0] * N_CTX)
+    for i, logits_ptr in enumerate(logits_ptrs):
+        legacy = legacy_sampling.sample(legacy_ctx, params, candidates, logits_ptr, last_n_tokens, N_CTX, mirostat_mu)
+        id = sampler(ctx, logits_ptr, last_n_tokens.tail(min(len(last_n_tokens), sampler.last_n)))
+        assert id == legacy, f"token {i} is {id}, the chain picked {legacy}"
+        last_n_tokens.append(id)
+    assert sampler.mirostat_mu.value == pytest.approx(mirostat_mu.contents.value)
+
+
+@pytest.mark.parametrize("mirostat", (1, 2))
+def test_mirostat_adapts_mu(fake_config, mirostat):
+    params = GptParams(mirostat=mirostat)
+    fake_config.n_vocab = 2000
+    sampler = SamplerPipeline(params, fake_config.n_vocab, N_CTX)
+    ctx = _context()
+    logits_ptrs, _rows = _logits(50, fake_config.n_vocab)
+    mus = []
+    for logits_ptr in logits_ptrs:
+        sampler(ctx, logits_ptr, np.empty(0, dtype=np.intc))
+        mus.append(sampler.mirostat_mu.value)
+    assert len(set(mus)) > 1
+    assert mus[-1] != 2.0 * params.mirostat_tau
@@ -0,0 +1,85 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+
+from alfbote.scheduler import RequestScheduler
+
+
+def test_rejects_past_max_depth_and_per_user_share():
+    async def main():
+        scheduler = RequestScheduler(max_depth=3, max_per_user=2)
+        gate = asyncio.Event()
+        running = scheduler.submit("a", gate.wait)
+        await asyncio.sleep(0)  # a starts running and leaves the queue
+        assert scheduler.submit("a", gate.wait) is not None
+        assert scheduler.submit("a", gate.wait) is not None
+        assert scheduler.submit("a", gate.wait) is None  # a's share is full
+        assert scheduler.submit("b", gate.wait) is not None
+        assert scheduler.submit("c", gate.wait) is None  # the queue is full
+        assert scheduler.stats()["rejected"] == 2
+        gate.set()
+        await running.result()
+
+    asyncio.run(main())
+
+
+def test_users_take_turns():
+    async def main():
+        scheduler = RequestScheduler(max_depth=8, max_per_user=4)
+        ran = []
+
+        def reply(user, i):
+            async def run():
+                ran.append((user, i))
+
+            return run
+
+        jobs = [scheduler.submit("a", reply("a", i)) for i in range(3)]
+        jobs += [scheduler.submit("b", reply("b", i)) for i in range(2)]
+        await asyncio.gather(*(job.result() for job in jobs))
+        assert ran == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2)]
+
+    asyncio.run(main())
+
+
+def test_queued_jobs_learn_their_position():
+    async def main():
+        scheduler = RequestScheduler()
+        gate = asyncio.Event()
+        positions = {"b": [], "c": []}
+
+        def tell(user):
+            async def on_position(position: int):
+                positions[user].append(position)
+
+            return on_position
+
+        first = scheduler.submit("a", gate.wait)
+        await asyncio.sleep(0)
+        b = scheduler.submit("b", gate.wait, tell("b"))
+        c = scheduler.submit("c", gate.wait, tell("c"))
+        await asyncio.sleep(0)
+        assert (scheduler.position(first), scheduler.position(b), scheduler.position(c)) == (0, 1, 2)
+
+        scheduler.cancel(b)
+        await asyncio.sleep(0)
+        assert await b.result() is None
+        assert positions == {"b": [1], "c": [2, 1]}
+        gate.set()
+        await c.result()
+        assert scheduler.stats()["cancelled"] == 1
+
+    asyncio.run(main())
+
+
+def test_cancel_running_job():
+    async def main():
+        scheduler = RequestScheduler()
+        job = scheduler.submit("a", asyncio.Event().wait)
+        await asyncio.sleep(0)
+        assert scheduler.position(job) == 0
+        scheduler.cancel(job)
+        assert await job.result() is None
+        # the worker goes on with the next job
+        assert await scheduler.submit("a", lambda: asyncio.sleep(0, "reply")).result() == "reply"
+
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+# SPDX-License-Identifier: MIT
+from alfbote.llamacpp.chat import Llama2
+
+
+def _pool(**kwargs) -> list[Llama2]:
+    return Llama2.pool(2, n_threads=1, n_predict=16, n_gpu_layers=0, prompt_cache_dir=None, **kwargs)
+
+
+def _replies(llama2: Llama2, turns: list[tuple[str, str]]) -> dict[str, list[str]]:
+    replies = {}
+    for session, msg in turns:
+        replies.setdefault(session, []).append("".join(llama2.generate(msg, session=session)))
+    return replies
+
+
+def test_interleaved_conversations_match_solo_runs():
+    turns = {
+        "a": ["Tell me about cats.", "And dogs?", "Which is better?"],
+        "b": ["What is 2 + 2?", "And 3 + 3?", "Thanks."],
+    }
+    solo = {}
+    for session, msgs in turns.items():
+        llama2 = Llama2(temp=0, n_threads=1, n_predict=16, n_gpu_layers=0, prompt_cache_dir=None)
+        solo.update(_replies(llama2, [(session, msg) for msg in msgs]))
+        llama2.m.exit()
+
+    llama2 = Llama2(temp=0, n_threads=1, n_predict=16, n_gpu_layers=0, prompt_cache_dir=None)
+    interleaved = _replies(llama2, [(session, turns[session][i]) for i in range(3) for session in ("a", "b")])
+    assert interleaved == solo
+    # every switch after the first two restored a snapshot instead of evaluating the conversation again
+    assert llama2.sessions.n_restores == 4 and llama2.sessions.n_prompt_restores == 2
+    llama2.m.exit()
+
+
+def test_snapshots_reuse_one_buffer_and_keep_only_the_used_bytes():
+    llama2 = Llama2(n_threads=1, n_predict=16, n_gpu_layers=0, prompt_cache_dir=None)
+    first = llama2.m.get_state()
+    buf = llama2.m.state_buf
+    second = llama2.m.get_state()
+    assert llama2.m.state_buf is buf
+    assert first.llama_state == second.llama_state
+    assert 0 < first.nbytes < len(buf)
+    llama2.m.exit()
+
+
+def test_conversations_survive_loading_the_pool_again():
+    models = _pool()
+    store = models[0].sessions.store
+    "".join(models[0].generate("Hello there.", session="a"))
+    "".join(models[1].generate("Hi.", session="b"))
+    n_past = models[0].m.n_past
+    Llama2.close_pool(models)
+    assert set(store.snapshots) == {"a", "b"} and not store.managers
+
+    # e.g. ChatGen.place loading it again with other n_gpu_layers
+    models = _pool(session_store=store)
+    models[1].sessions.activate("a")
+    assert models[1].m.n_past == n_past
+    assert models[1].sessions.n_restores == 1 and models[1].sessions.n_prompt_restores == 0
+    assert "".join(models[1].generate("And again.", session="a"))
+    Llama2.close_pool(models)
@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: MIT
+import pytest
+
+
+def _replies(interact, n_turns: int = 3, **kwargs) -> tuple[list[str], object]:
+    m = interact(n_predict=32, **kwargs)
+    m.prefill()
+    replies = []
+    for i in range(n_turns):
+        m.input(f" Tell me about the number {i}.\n")
+        replies.append("".join(m.output()))
+    return replies, m
+
+
+# Sampling only ever sees the main model's logits, so a draft model can't change the replies
+@pytest.mark.parametrize("temp", (0.0, 0.8))
+@pytest.mark.parametrize("n_draft", (2, 4, 8))
+def test_draft_model_keeps_the_replies(interact, fake_config, temp, n_draft):
+    baseline, _ = _replies(interact, temp=temp)
+    fake_config.noise["draft"] = 0.3
+    replies, m = _replies(interact, temp=temp, model_draft="draft", n_draft=n_draft)
+    assert replies == baseline
+    assert 0 < m.n_accepted <= m.n_drafted
+    assert m.n_draft_evals < m.n_sampled
+
+
+def test_rejected_drafts_are_rolled_back(interact, fake_config):
+    baseline, _ = _replies(interact)
+    # a draft model that disagrees most of the time
+    fake_config.noise["draft"] = 100.0
+    replies, m = _replies(interact, model_draft="draft", n_draft=4)
+    assert replies == baseline
+    assert m.n_accepted < m.n_drafted
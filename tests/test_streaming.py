@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: MIT
+import asyncio
+from time import monotonic
+
+from alfbote.streaming import MessageStreamer, RateLimitBucket, TextAccumulator
+
+
+class FakeMessage:
+    def __init__(self, content: str, edit_time: float = 0.005):
+        self.content = content
+        self.edit_time = edit_time
+        self.edits: list[tuple[float, str]] = [(monotonic(), content)]
+
+    async def edit(self, content: str, **kwargs):
+        self.edits.append((monotonic(), content))
+        await asyncio.sleep(self.edit_time)
+        self.content = content
+
+
+async def stream(n_tokens: int, token_time: float, interval: float, bucket: RateLimitBucket) -> FakeMessage:
+    async def send(text: str) -> FakeMessage:
+        return FakeMessage(text)
+
+    streamer = MessageStreamer(send, interval=interval, bucket=bucket)
+    for i in range(n_tokens):
+        await streamer.append(f"w{i} ")
+        await asyncio.sleep(token_time)
+    return await streamer.finish()
+
+
+def test_text_accumulator():
+    text = TextAccumulator("a")
+    for piece in ("b", "cd"):
+        text.append(piece)
+    assert len(text) == 4
+    assert str(text) == "abcd"
+    assert str(TextAccumulator()) == ""
+
+
+def test_fast_stream_keeps_to_the_rate_limit():
+    message = asyncio.run(stream(n_tokens=500, token_time=0.002, interval=0.05, bucket=RateLimitBucket(5, 0.5)))
+    times = [t for t, _ in message.edits[1:]]
+    assert max(sum(1 for u in times if t <= u < t + 0.5) for t in times) <= 5
+    assert message.content == "".join(f"w{i} " for i in range(500))
+
+
+def test_slow_stream_shows_every_token():
+    message = asyncio.run(stream(n_tokens=5, token_time=0.2, interval=0.05, bucket=RateLimitBucket(5, 0.5)))
+    assert len(message.edits) - 1 >= 4
+    assert message.content == "".join(f"w{i} " for i in range(5))
+
+
+def test_finish_waits_for_an_edit_in_progress():
+    async def main():
+        async def send(text: str) -> FakeMessage:
+            return FakeMessage(text, edit_time=0.1)
+
+        streamer = MessageStreamer(send, interval=0.0, bucket=RateLimitBucket(5, 0.5))
+        await streamer.append("a")
+        message = streamer.message
+        # e.g. the reply task being cancelled by the stop button while it edits
+        editing = asyncio.create_task(streamer.append("b"))
+        await asyncio.sleep(0.01)
+        editing.cancel()
+        await streamer.finish("ab —")
+        assert [content for _, content in message.edits] == ["a", "ab", "ab —"]
+        assert message.edits[2][0] - message.edits[1][0] >= 0.1
+        assert message.content == "ab —"
+
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+import llama_cpp
+
+from alfbote.llamacpp.tokenizer import Tokenizer
+
+
+def _tokenizer(**kwargs) -> tuple[Tokenizer, object]:
+    ctx = llama_cpp.llama_init_from_file(b"fake", llama_cpp.llama_context_default_params())
+    return Tokenizer(ctx, **kwargs), ctx
+
+
+def _backend(ctx, text: str, bos: bool = True) -> list[int]:
+    _arr = (llama_cpp.llama_token * ((len(text) + 1) * 4))()
+    _n = llama_cpp.llama_tokenize(ctx, text.encode("utf8"), _arr, len(_arr), bos)
+    return _arr[:_n]
+
+
+def test_matches_the_backend_and_grows_the_buffer():
+    tokenizer, ctx = _tokenizer()
+    for text in ("", "user:", "é€😀" * 200):
+        assert tokenizer(text) == _backend(ctx, text)
+    assert len(tokenizer.buffer) >= len(("é€😀" * 200).encode("utf8")) + 1
+
+
+def test_repeated_text_is_a_hit():
+    tokenizer, _ = _tokenizer()
+    tokens = tokenizer("user:")
+    tokens.append(0)  # callers get their own list
+    assert tokenizer("user:") == tokens[:-1]
+    assert tokenizer.n_hits == 1 and tokenizer.n_misses == 1
+
+
+def test_bos_is_part_of_the_key():
+    tokenizer, _ = _tokenizer()
+    with_bos, without = tokenizer("\n", True), tokenizer("\n", False)
+    assert with_bos == [llama_cpp.llama_token_bos()] + without
+    assert tokenizer.n_misses == 2 and set(tokenizer.cache) == {("\n", True), ("\n", False)}
+
+
+def test_least_recently_used_is_evicted():
+    tokenizer, _ = _tokenizer(max_entries=2)
+    tokenizer("a")
+    tokenizer("b")
+    tokenizer("a")
+    tokenizer("c")
+    assert list(tokenizer.cache) == [("a", True), ("c", True)]
+    tokenizer("b")
+    assert tokenizer.n_misses == 4
+
+
+def test_long_texts_are_not_cached():
+    tokenizer, _ = _tokenizer(max_text_len=8)
+    tokenizer("a long user message")
+    tokenizer("a long user message")
+    assert tokenizer.n_misses == 2 and not tokenizer.cache
+
+
+def test_batch_tokenizes_each_distinct_text_once():
+    tokenizer, ctx = _tokenizer(max_text_len=8)
+    texts = ["user:", "a long user message", "user:", "a long user message", ""]
+    assert tokenizer.tokenize_batch(texts, bos=False) == [_backend(ctx, text, False) for text in texts]
+    assert tokenizer.n_misses == 3 and tokenizer.n_hits == 0
+    assert tokenizer.tokenize_batch(["user:"], bos=False) == [_backend(ctx, "user:", False)]
+    assert tokenizer.n_hits == 1
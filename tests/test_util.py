@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+import pytest
+
+from alfbote.llamacpp.util import Circle, IterSearch, StopMatcher
+
+
+def test_stop_matcher_reports_overlapping_patterns():
+    m = StopMatcher([[1, 2, 3], [2, 3, 4], [3]])
+    assert [m.push(t) for t in [1, 2, 3, 4, 5, 3]] == [None, None, 0, 1, None, 2]
+
+
+def test_patterns_are_dropped_anywhere():
+    s = IterSearch("user:", "alfbote:")
+    assert s.feed("hi user") == "hi "
+    assert s.feed(": yes alf") == " yes "
+    assert "".join(s.flush()) == "alf"
+    assert s.feed("alfbote: xuser:y") == " xy"
+
+
+def test_line_start_drops_tags_only_at_the_start_of_a_line():
+    s = IterSearch("user:", "alfbote:", line_start=True)
+    assert s.feed(" alfbote: Ask the user: anything\n") == "  Ask the user: anything\n"
+    assert s.feed("user: next\nalfbote:") == " next\n"
+    assert s.flush() == []
+
+
+def test_line_start_holds_back_a_partial_tag_until_it_cannot_match():
+    s = IterSearch("user:", "alfbote:", line_start=True)
+    assert s.feed("Sure\nuse") == "Sure\n"
+    assert s.feed("d it") == "used it"
+    assert s.feed("\nalf") == "\n"
+    assert "".join(s.flush()) == "alf"
+    # flush starts a new stream, which starts a line
+    assert s.feed("user: hi") == " hi"
+
+
+def test_circle_keeps_the_newest_elements():
+    c = Circle(5)
+    c.append(1)
+    assert c[0] == 1 and c[:5] == [1]
+    c.extend(range(2, 6))
+    assert c[0] == 1 and c[:5] == [1, 2, 3, 4, 5]
+    c.extend(range(6, 10))
+    assert c[0] == 5 and c[:5] == [5, 6, 7, 8, 9] and c[:10] == [5, 6, 7, 8, 9]
+    assert len(c) == 5
+    with pytest.raises(IndexError):
+        c[5]
+
+
+def test_circle_views_are_contiguous():
+    c = Circle(5)
+    c.extend(range(1, 10))
+    assert c.view().tolist() == [5, 6, 7, 8, 9]
+    assert c.tail(2).tolist() == [8, 9] and c.tail(10).tolist() == [5, 6, 7, 8, 9]
+    assert c.endswith([8, 9]) and not c.endswith([7, 9]) and c.endswith([])
+    assert not c.endswith(range(6))
+
+
+def test_circle_copy_is_independent():
+    c = Circle(3)
+    c.extend([1, 2, 3])
+    other = c.copy()
+    c.append(4)
+    assert other[:] == [1, 2, 3] and c[:] == [2, 3, 4]
@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+import llama_cpp
+
+from alfbote.llamacpp.vocab import Vocab
+from tests.fake_llama_cpp import BYTE_OFFSET
+
+TEXT = "é€😀 ok"
+
+
+# The fake falls back to one token per byte, so every multi-byte character is split over several tokens
+def _byte_tokens(text: str) -> list[int]:
+    return [BYTE_OFFSET + b for b in text.encode("utf8")]
+
+
+def _context():
+    return llama_cpp.llama_init_from_file(b"fake", llama_cpp.llama_context_default_params())
+
+
+def test_table_matches_the_backend(fake_config):
+    fake_config.n_vocab = 1000
+    ctx = _context()
+    vocab = Vocab(ctx)
+    assert len(vocab) == 1000
+    assert all(vocab[id] == llama_cpp.llama_token_to_str(ctx, id) for id in range(len(vocab)))
+    assert vocab.detokenize([BYTE_OFFSET + ord("h"), BYTE_OFFSET + ord("i"), 300]) == b"hi" + vocab[300]
+
+
+def test_detokenize_joins_partial_characters():
+    vocab = Vocab(_context())
+    ids = _byte_tokens(TEXT)
+    assert [len(vocab[id]) for id in ids] == [1] * len(TEXT.encode("utf8"))
+    assert vocab.detokenize(ids).decode("utf8") == TEXT
+
+
+def test_contexts_of_a_model_share_one_table(fake_config, tmp_path):
+    model = str(tmp_path / "model.bin")
+    vocab = Vocab.for_model(_context(), model)
+    assert Vocab.for_model(_context(), model) is vocab
+    # another model at the same path, e.g. the file was replaced
+    fake_config.n_vocab = 500
+    assert len(Vocab.for_model(_context(), model)) == 500
+
+
+def test_output_only_yields_whole_characters(interact):
+    m = interact()
+    m.generate = lambda: iter(_byte_tokens(TEXT))
+    assert list(m.output()) == ["é", "€", "😀", " ", "o", "k"]
+
+
+def test_a_character_split_across_a_conversation_switch(interact):
+    m = interact()
+    euro = _byte_tokens("€")
+    m.generate = lambda: iter(euro[:2])
+    assert list(m.output()) == []
+    snapshot = m.get_state(kv=False)
+
+    # another conversation in the context meanwhile
+    m.utf8_decoder.reset()
+    m.generate = lambda: iter(_byte_tokens("a"))
+    assert list(m.output()) == ["a"]
+
+    m.set_state(snapshot, kv=False)
+    m.generate = lambda: iter(euro[2:])
+    assert list(m.output()) == ["€"]
@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: MIT
+import pytest
+
+from alfbote.workers import ProcessWorker, RemoteObject, WorkerCrashed
+
+
+@pytest.fixture
+def worker():
+    worker = ProcessWorker("tests.fake_worker:LoadTest", name="test")
+    yield worker
+    worker.stop()
+
+
+def test_iterators_stream_back(worker):
+    remote = RemoteObject(worker)
+    assert list(remote.tokens(5, work=10)) == [0, 1, 2, 3, 4]
+    with pytest.raises(AttributeError):
+        remote._private
+
+
+def test_closing_a_stream_early_leaves_the_worker_usable(worker):
+    stream = RemoteObject(worker).tokens(1000, work=10)
+    assert next(stream) == 0
+    stream.close()
+    assert not worker.pending
+    assert list(RemoteObject(worker).tokens(2, work=10)) == [0, 1]
+
+
+def test_crashed_worker_fails_the_call_and_restarts(worker):
+    remote = RemoteObject(worker)
+    with pytest.raises(WorkerCrashed):
+        remote.crash()
+    assert list(remote.tokens(5, work=10)) == [0, 1, 2, 3, 4]
+    assert worker.n_restarts == 1
+
+
+def test_remote_llama2_counters_start_from_the_workers_totals():
+    from alfbote.chatgen import RemoteLlama2
+
+    worker = ProcessWorker(
+        "tests.fake_worker:llama2_pool", 1, name="test", n_predict=8, prompt_cache_dir=None, timed=True
+    )
+    worker.ready.wait()
+    try:
+        # a reply generated before this RemoteLlama2 existed
+        "".join(worker.call(0, "generate", "Hello.", session="a"))
+        model = RemoteLlama2(worker, 0)
+        before = model.counters()
+        assert before["n_sampled"] == model.n_sampled > 0
+        "".join(model.generate("Hello again.", session="a"))
+        after = model.counters()
+        delta = {key: value - before[key] for key, value in after.items()}
+        assert 0 < delta["n_sampled"] <= 8 < after["n_sampled"]
+        assert delta["n_prefill"] == after["n_prefill"] - before["n_prefill"] < after["n_prefill"]
+    finally:
+        worker.stop()